@@ -1,17 +1,21 @@
-from kani_utils.base_kanis import StreamlitKani
+from kani_utils.base_kanis import StreamlitKani, prefetchable
+from kani_utils.jobs import report_progress
+from kani_utils.memory_index import MemoryIndex
+from kani_utils.tables import ParquetTable, TableCatalog, csv_to_parquet, query_tables
 from kani import AIParam, ai_function
 import streamlit as st
 
 from typing import Annotated
-import pandas as pd
-import pdfplumber
+import contextlib
+import os
 import re
-import streamlit as st
-from kani import AIParam, ai_function
-from typing import Annotated
-import pandas as pd
-from pandasql import sqldf
-import requests
+import shutil
+import tempfile
+import uuid
+import weakref
+
+# pandas, pdfplumber, pandasql and requests are imported inside the functions that use them,
+# so that the app starts quickly and agents that never use them don't pay for the import
 
 # StreamlitKani agents are Kani agents and work the same
 # We must subclass StreamlitKani instead of Kani to get the Streamlit UI
@@ -39,9 +43,14 @@ class AuthorSearchKani(StreamlitKani):
         # we can define any other instance variables we need for the agent
         self.search_history = []
 
+    # prefetchable functions are started as soon as the model requests them, if the agent is created
+    # with prefetch_tools = True; a lookup is safe to start early
+    @prefetchable
     @ai_function()
     def search_author(self, query: Annotated[str, AIParam(desc="The query to search for.")]):
         """Search for an author and return their name and alternative names."""
+        import pandas as pd
+        import requests
 
         # add the search to the search history
         self.search_history.append(query)
@@ -91,6 +100,8 @@ class MemoryKani(StreamlitKani):
         self.description = "An agent with key/value memory storage."
 
         self.memory = {}
+        # trigram index of the memory keys and the start of their values, for search_memory
+        self.memory_index = MemoryIndex()
 
     ## StreamlitKanis can define render_sidebar methods, which 
     ## provide the UI elements to include in the sidebar that pertain to this agent
@@ -123,9 +134,20 @@ class MemoryKani(StreamlitKani):
         """Retrieve a value from memory."""
         return self.memory.get(key, None)
 
+    @ai_function()
+    def search_memory(self,
+                      query: Annotated[str, AIParam(desc="Words to look for in the keys and values, e.g. a file or table name or a topic.")],
+                      k: Annotated[int, AIParam(desc="The maximum number of entries to return.")] = 5):
+        """Find the memory entries most relevant to a query, by their keys and the start of their values. Prefer this to listing all keys."""
+        self.memory_index.sync(self.memory)
+        results = self.memory_index.search(query, k)
+        if not results:
+            return f"No memory entries match '{query}'."
+        return "\n".join(f"- '{key}': {snippet[:200]!r}" for key, snippet, _ in results)
+
     @ai_function()
     def list_memory_keys(self):
-        """List the keys currently stored in memory."""
+        """List all keys currently stored in memory."""
         return list(self.memory.keys())
     
     @ai_function()
@@ -141,7 +163,7 @@ class MemoryKani(StreamlitKani):
 ## Uses streamlit's file handling
 class FileKani(MemoryKani):
     """A Kani that can access the contents of uploaded files."""
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, background_job_min_bytes = 1024 * 1024, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.name = "File Agent"
@@ -151,6 +173,10 @@ class FileKani(MemoryKani):
 
         self.files = []
 
+        # files of at least background_job_min_bytes are processed in background jobs (see StreamlitKani.start_job),
+        # so that the reply isn't held up while they are read
+        self.background_job_min_bytes = background_job_min_bytes
+
     def render_sidebar(self):
         super().render_sidebar()
         st.divider()
@@ -180,8 +206,11 @@ class FileKani(MemoryKani):
                 if file.type.startswith("text"):
                     contents = file.read()
                 elif file.type == "application/pdf":
-                    with pdfplumber.open(file) as pdf:
-                        contents = "\n\n".join([page.extract_text() for page in pdf.pages])
+                    if self._run_in_background(file):
+                        # extracting a large PDF takes a while, so it runs as a background job
+                        job = self.start_job(f"Extract {file_name}", self._extract_pdf, file, file_name)
+                        return f"The PDF is being extracted in background job '{job.id}'. Its contents will be saved in memory key '{file_name}'; use check_job or await_job to get them."
+                    return self._extract_pdf(file, file_name)
                 elif file.type == "application/json":
                     contents = file.read()
 
@@ -192,11 +221,29 @@ class FileKani(MemoryKani):
         if isinstance(contents, bytes):
             contents = contents.decode("utf-8")
 
+        return self._save_file_contents(file_name, contents)
+
+    def _extract_pdf(self, file, file_name):
+        import pdfplumber
+
+        pages = []
+        with pdfplumber.open(file) as pdf:
+            for page_number, page in enumerate(pdf.pages):
+                # shown in the chat, when run as a background job
+                report_progress(page_number / len(pdf.pages), f"page {page_number + 1} of {len(pdf.pages)}")
+                pages.append(page.extract_text())
+
+        return self._save_file_contents(file_name, "\n\n".join(pages))
+
+    def _save_file_contents(self, file_name, contents):
         # save the contents in memory for later use
         self.memory[file_name] = contents
         message = f"Here are the contents of the file, which have also been saved in memory key '{file_name}' for further use:\n\n"
         return message + contents
 
+    def _run_in_background(self, file):
+        return getattr(file, "size", 0) >= self.background_job_min_bytes
+
 
     @ai_function()
     def list_current_files(self):
@@ -206,33 +253,51 @@ class FileKani(MemoryKani):
 
 class TableKani(FileKani):
     """A Kani that can run SQL queries on pandas dataframes stored in memory."""
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, disk_table_min_bytes = 100 * 1024 * 1024, table_dir = None, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.name = "Tabular Data Agent"
         self.greeting = "Hello, I'm a demo assistant. You can upload files and I can see their contents. If you upload CSV files, I can read them as data frames, store them in memory, and query them like an SQL database.\n\nAlternatively, you can ask me to generate and query some example data by asking '*Please generate a set of example relational tables, save them to your local database, and run an example query on them.*'"
         self.description = "An agent that can read CSV files and query them as SQL tables."
 
+        # schema, row counts and previews of the tables in memory, computed once per table
+        self.catalog = TableCatalog()
+
+        # CSV files of at least disk_table_min_bytes are converted to Parquet files in table_dir instead of being loaded
+        # in memory, if duckdb is installed. By default that is a temporary directory removed with the agent; with
+        # session checkpoints, pass a persistent directory that every worker can read, since checkpoints keep the
+        # files' paths
+        self.disk_table_min_bytes = disk_table_min_bytes
+        self.table_dir = table_dir
+        # Parquet files this agent wrote, removed once their tables are no longer in memory
+        self._table_files = set()
+
 
     def render_sidebar(self):
         super().render_sidebar()
         st.divider()
 
-        table_names = self.list_tables()
+        self.catalog.sync(self.memory)
+        table_names = [self.catalog.get(name).summary() for name in self.catalog.names()]
         if len(table_names) == 0:
             table_names = ["*None*"]
         sep = "\n- "
         st.markdown("### Tables")
         st.caption("Uploaded CSV files can be ingested as tables on request and later queried with SQL. The following tables are currently stored:")
         st.markdown("- " + sep.join(table_names))
+        for table_name in self.catalog.unavailable():
+            st.caption(f"⚠️ The data of table {table_name} is no longer available; please upload the file again.")
 
     @ai_function()
     def save_to_table(self, tbl_json: Annotated[str, AIParam(desc="The JSON string to save as a table. Uses pd.read_json()")]):
         """Save a JSON string as a table in memory."""
+        import pandas as pd
+
         try:
             df = pd.read_json(tbl_json)
             table_name = f"TABLE_{len(self.memory)}"
             self.memory[table_name] = df
+            self.catalog.register(table_name, df)
             return f"Table saved in memory key '{table_name}'."
         except Exception as e:
             return f"Error: {e}"
@@ -245,20 +310,16 @@ class TableKani(FileKani):
         for file in self.files:
             if file.name == file_name:
 
-                # assume the file is a csv, use pandas to read it
+                # assume the file is a csv
                 if file.type == "text/csv":
-                    df = pd.read_csv(file)
-
                     # create an SQL-compatible table name based on the filename, keeping only alphanumeric characters, dots to underscores, and uppercasing
                     table_name = re.sub(r"[^a-zA-Z0-9_]", "_", file_name).upper()
 
-                    sample = df.head(10)
-
-                    message = f"Here is a sample of the data: {sample.to_markdown()}.\n\nThere are {len(df)} rows total, and {len(df.columns)} columns named: {', '.join(df.columns)}."
-                    self.memory[table_name] = df
-                    message += f"\n\nThe data has been saved in memory key '{table_name}' for further use."
-
-                    return message
+                    if self._run_in_background(file):
+                        # large files take a while to ingest, so they are read in a background job
+                        job = self.start_job(f"Ingest {file_name}", self._ingest_csv, file, table_name)
+                        return f"The file is being read in background job '{job.id}'. It will be saved in memory key '{table_name}'; use check_job or await_job to get a sample of the data."
+                    return self._ingest_csv(file, table_name)
 
                 else:
                     return f"Error: file is not a CSV."
@@ -266,24 +327,90 @@ class TableKani(FileKani):
         return f"Error: file name not found in current uploaded file set."
 
 
+    def _ingest_csv(self, file, table_name):
+        import pandas as pd
+
+        if self._store_on_disk(file):
+            # large files are kept on disk and queried without loading them
+            report_progress(message = "converting to Parquet")
+            if self.table_dir is None:
+                self.table_dir = tempfile.mkdtemp(prefix = "kani_tables_")
+                # the temporary directory is removed with the agent, or at exit
+                weakref.finalize(self, shutil.rmtree, self.table_dir, ignore_errors = True)
+            self._remove_unused_table_files()
+            # a unique name, since a persistent table_dir is shared by all sessions
+            path = os.path.abspath(os.path.join(self.table_dir, f"{table_name}_{uuid.uuid4().hex}.parquet"))
+            os.makedirs(self.table_dir, exist_ok = True)
+            df = csv_to_parquet(file, path)
+            self._table_files.add(path)
+        else:
+            # use pandas to read it
+            df = pd.read_csv(file)
+
+        self.memory[table_name] = df
+        table = self.catalog.register(table_name, df)
+
+        message = f"Here is a sample of the data: {table.preview}.\n\nThere are {table.rows} rows total, and {len(table.columns)} columns: {table.schema()}."
+        message += f"\n\nThe data has been saved in memory key '{table_name}' for further use."
+
+        return message
+
+    def _remove_unused_table_files(self):
+        # Parquet files of tables since removed from memory or replaced, so that disk use is bounded by the tables
+        # in memory
+        in_use = {os.path.abspath(value.path) for value in list(self.memory.values()) if isinstance(value, ParquetTable)}
+        for path in self._table_files - in_use:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            self._table_files.discard(path)
+
+    def _store_on_disk(self, file):
+        if getattr(file, "size", 0) < self.disk_table_min_bytes:
+            return False
+        try:
+            import duckdb
+            return True
+        except ImportError:
+            return False
+
     @ai_function()
     def list_tables(self):
         """List pandas dataframes stored in memory, which can be queried and joined with SQL."""
-        pandas_tables = [k for k, v in self.memory.items() if isinstance(v, pd.DataFrame)]
-        return pandas_tables
+        self.catalog.sync(self.memory)
+        return self.catalog.names()
+
+    @ai_function()
+    def describe_table(self, table_name: Annotated[str, AIParam(desc="The name of the table to describe.")]):
+        """Describe a table stored in memory: its columns and types, row count, a preview, and summary statistics of each column."""
+        self.catalog.sync(self.memory)
+        table = self.catalog.get(table_name)
+        if table_name in self.catalog.unavailable():
+            return f"Error: the data of table '{table_name}' is no longer available: {self.catalog.unavailable()[table_name]}"
+        if table is None:
+            return f"Error: table '{table_name}' not found in memory."
+
+        return f"{table.summary()}\n\nColumns: {table.schema()}\n\nPreview:\n{table.preview}\n\nStatistics:\n{self.catalog.describe(table_name)}"
    
     @ai_function()
     def run_query(self,
                  query: Annotated[str, AIParam(desc="The query to run.")],
-                 save_result_to_memory_key: Annotated[str, AIParam(desc="Optional: the key to save the result to. If not provided, the result will not be saved.")] = None
+                 save_result_to_memory_key: Annotated[str, AIParam(desc="Optional: the key to save the result to. If not provided, the result will not be saved.")] = None,
+                 run_in_background: Annotated[bool, AIParam(desc="Optional: run the query as a background job, for slow queries over large tables. Its result is then retrieved with check_job or await_job.")] = False
                  ):
-        """Query the pandas dataframes store in memory as an SQL database. Use memory key names as table names. Results are returned as text."""
+        """Query the pandas dataframes store in memory as an SQL database. Use memory key names as table names. The SQL dialect is DuckDB's (SQLite's if DuckDB is not installed). Results are returned as text."""
+        if run_in_background:
+            job = self.start_job("SQL query", self._run_query, query, save_result_to_memory_key)
+            return f"The query is running in background job '{job.id}'; use check_job or await_job to get its result."
+        return self._run_query(query, save_result_to_memory_key)
+
+    def _run_query(self, query, save_result_to_memory_key):
         try:
-            memory_dfs = {k: v for k, v in self.memory.items() if isinstance(v, pd.DataFrame)}
-            result = sqldf(query, memory_dfs)
+            self.catalog.sync(self.memory)
+            result = query_tables(query, self.catalog.tables())
 
             if save_result_to_memory_key is not None:
                 self.memory[save_result_to_memory_key] = result
+                self.catalog.register(save_result_to_memory_key, result)
 
             return result.to_string(index=False)
         except Exception as e:
@@ -55,11 +55,11 @@ engine = OpenAIEngine(os.environ["OPENAI_API_KEY"], model="gpt-4o")
 # Agents are keyed by their name, which is what the user will see in the UI
 def get_agents():
     return {
-            "Author Search Agent": AuthorSearchKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015),
+            "Author Search Agent": AuthorSearchKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015, prefetch_tools = True),
             "Author Search Agent (No costs shown)": AuthorSearchKani(engine),
             "Memory Agent": MemoryKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015),
             "File Agent": FileKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015),
-            "Table Agent": TableKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015),
+            "Table Agent": TableKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015, cached_prompt_tokens_cost = 0.0025, stable_prompt_prefix = True),
             "Editable System Prompt": SystemPromptEditorKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015),
            }
 
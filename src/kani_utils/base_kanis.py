@@ -1,8 +1,45 @@
 
-from kani import Kani, ChatMessage
+import asyncio
+import functools
+import time
+from typing import Annotated
+
+from kani import AIParam, Kani, ChatMessage, ChatRole, ai_function
+from kani.engines.base import Completion
+from kani_utils.jobs import get_default_job_manager
 from kani_utils.kani_streamlit_server import UIOnlyMessage
+from kani_utils.response_cache import CachedCompletion, cacheable_response, cached_completion, response_cache_key
+from kani_utils.streaming import ModelStreamError, StreamRetryPolicy, get_stream_stats, guard_stream, is_transient_error
 import streamlit as st
 
+# asks the model to continue a reply whose stream was interrupted, sent after the partial reply
+_CONTINUE_PROMPT = ("Your previous reply was cut off. Continue it exactly where it stopped, without repeating any of "
+                    "it or commenting on the interruption.")
+
+
+def prompt_cache_usage(completion):
+    """
+    The prompt tokens of a completion and how many of them the provider served from its prompt cache, as
+    (prompt_tokens, cached_prompt_tokens), from the usage reported by the OpenAI API (prompt_tokens_details.cached_tokens)
+    or the Anthropic API (cache_read_input_tokens, which Anthropic reports separately from input tokens).
+    """
+    prompt_tokens = completion.prompt_tokens
+    extra = completion.message.extra if completion.message is not None else {}
+
+    usage = extra.get("openai_usage")
+    if usage is not None:
+        details = usage.get("prompt_tokens_details") or {}
+        return prompt_tokens, details.get("cached_tokens") or 0
+
+    message = extra.get("anthropic_message")
+    if message is not None:
+        cache_read = getattr(message.usage, "cache_read_input_tokens", None) or 0
+        cache_creation = getattr(message.usage, "cache_creation_input_tokens", None) or 0
+        return (prompt_tokens or 0) + cache_read + cache_creation, cache_read
+
+    return prompt_tokens, 0
+
+
 class EnhancedKani(Kani):
     def __init__(self,
                  *args,
@@ -13,6 +50,11 @@ class EnhancedKani(Kani):
                  user_avatar = "👤",
                  prompt_tokens_cost = None,
                  completion_tokens_cost = None,
+                 cached_prompt_tokens_cost = None,
+                 stable_prompt_prefix = False,
+                 stream_retry = None,
+                 usage_ledger = None,
+                 response_cache = None,
                  **kwargs):
         
         super().__init__(*args, **kwargs)
@@ -25,41 +67,432 @@ class EnhancedKani(Kani):
 
         self.prompt_tokens_cost = prompt_tokens_cost
         self.completion_tokens_cost = completion_tokens_cost
-        self.tokens_used_prompt = 0
+        # price of prompt tokens served from the provider's prompt cache; None bills them as other prompt tokens
+        self.cached_prompt_tokens_cost = cached_prompt_tokens_cost
+        self.tokens_used_prompt = 0  # including cached prompt tokens
+        self.tokens_used_prompt_cached = 0
         self.tokens_used_completion = 0
 
+        # keep the start of the prompt (system prompt, tool schemas, earliest history) byte-stable across turns, so
+        # that providers can serve it from their prompt cache
+        self.stable_prompt_prefix = stable_prompt_prefix
+        # with stable_prompt_prefix, the index of the first history message in the prompt once history is truncated
+        self._prompt_history_start = 0
+
+        # optional process-wide UsageLedger (see kani_utils.usage); usage_user is set by the server per session
+        self.usage_ledger = usage_ledger
+        self.usage_user = None
+
+        # optional response cache (see kani_utils.response_cache), for agents whose replies depend only on the
+        # conversation; hits replay the cached reply without calling the model
+        self.response_cache = response_cache
+        self.cache_hits = 0
+        self.tokens_saved_prompt = 0
+        self.tokens_saved_completion = 0
+
+        # timeouts and retries of model streams (see kani_utils.streaming.StreamRetryPolicy); None uses the default
+        # policy, False streams once, without timeouts
+        if stream_retry is None:
+            stream_retry = StreamRetryPolicy()
+        self.stream_retry = stream_retry or None
+
+        # text of the model stream in progress, kept for end_cancelled_round(); None when no stream is in progress.
+        # Its first _streamed_billed characters came from retried attempts, whose usage is already recorded
+        self._streamed_text = None
+        self._streamed_billed = 0
+        self._streamed_include_functions = True
+
     def update_system_prompt(self, system_prompt):
-        """Update the system prompt of the agent."""
+        """
+        Update the system prompt of the agent. With stable_prompt_prefix, once the conversation has started the new
+        prompt is added to the history as a system message instead, leaving the cached prompt prefix intact; it
+        replaces the system prompt when the chat is cleared (see reset_prompt_prefix()).
+        """
         self.system_prompt = system_prompt
+        if self.stable_prompt_prefix and self.chat_history:
+            self.chat_history.append(ChatMessage.system(f"The system prompt has been updated. From now on, follow these instructions instead:\n\n{system_prompt}"))
+            return
         self.always_included_messages = [ChatMessage(role="system", content=system_prompt)]
-            
+
+    def reset_prompt_prefix(self):
+        """Called by the server once the chat history has been cleared, to start the next prompt prefix afresh."""
+        self._prompt_history_start = 0
+        if self.stable_prompt_prefix and self.system_prompt is not None and \
+           self.always_included_messages[:1] != [ChatMessage(role="system", content=self.system_prompt)]:
+            self.update_system_prompt(self.system_prompt)
+
+    async def get_prompt(self, include_functions = True, **kwargs):
+        prompt = await super().get_prompt(include_functions = include_functions, **kwargs)
+        if not self.stable_prompt_prefix:
+            return prompt
+
+        # Kani drops the oldest messages one at a time as the history outgrows the context, which changes the start
+        # of the prompt on every turn. Here the start of the kept history only moves when it must, and then past a
+        # quarter of the kept messages more, so that the prompt prefix stays the same for the turns that follow.
+        kept = len(prompt) - len(self.always_included_messages)
+        start = len(self.chat_history) - kept
+        if self._prompt_history_start > len(self.chat_history):
+            self._prompt_history_start = 0
+        if start > self._prompt_history_start:
+            self._prompt_history_start = min(start + kept // 4, len(self.chat_history) - 1)
+        if start == self._prompt_history_start:
+            return prompt
+        return self.always_included_messages + self.chat_history[self._prompt_history_start:]
+
     def get_convo_cost(self):
         """Get the total cost of the conversation so far."""
+        return self._tokens_cost(self.tokens_used_prompt, self.tokens_used_completion, self.tokens_used_prompt_cached)
+
+    def _tokens_cost(self, prompt_tokens, completion_tokens, cached_prompt_tokens = 0):
         if self.prompt_tokens_cost is None or self.completion_tokens_cost is None:
             return None
-        
-        return (self.tokens_used_prompt / 1000.0) * self.prompt_tokens_cost + (self.tokens_used_completion / 1000.0) * self.completion_tokens_cost
+
+        cached_cost = self.cached_prompt_tokens_cost if self.cached_prompt_tokens_cost is not None else self.prompt_tokens_cost
+        return ((prompt_tokens - cached_prompt_tokens) / 1000.0) * self.prompt_tokens_cost + \
+               (cached_prompt_tokens / 1000.0) * cached_cost + \
+               (completion_tokens / 1000.0) * self.completion_tokens_cost
+
+    def _response_cache_key(self, include_functions, kwargs):
+        functions = self.get_enabled_functions() if include_functions else None
+        return response_cache_key(self.always_included_messages + self.chat_history,
+                                  functions = functions,
+                                  model = getattr(self.engine, "model", None),
+                                  hyperparams = kwargs)
+
+    async def get_model_completion(self, include_functions = True, **kwargs):
+        if self.response_cache is None:
+            return await super().get_model_completion(include_functions = include_functions, **kwargs)
+
+        key = self._response_cache_key(include_functions, kwargs)
+        response = self.response_cache.get(key)
+        if response is not None:
+            return cached_completion(response)
+
+        completion = await super().get_model_completion(include_functions = include_functions, **kwargs)
+        response = cacheable_response(completion)
+        if response is not None:
+            self.response_cache.set(key, response)
+        return completion
+
+    async def _live_model_stream(self, include_functions, kwargs):
+        self._streamed_text = []
+        self._streamed_billed = 0
+        self._streamed_include_functions = include_functions
+        policy = self.stream_retry
+        if policy is None:
+            async for elem in super().get_model_stream(include_functions = include_functions, **kwargs):
+                if isinstance(elem, str):
+                    self._streamed_text.append(elem)
+                else:
+                    self._streamed_text = None
+                yield elem
+            self._streamed_text = None
+            return
+
+        stats = get_stream_stats()
+        deadline = time.monotonic() + policy.deadline if policy.deadline is not None else None
+        retry = 0
+        while True:
+            # the text streamed by earlier attempts, which this one continues
+            partial = "".join(self._streamed_text)
+            attempt_text = []
+            try:
+                async for elem in guard_stream(self._model_stream_attempt(include_functions, kwargs, partial),
+                                               policy.idle_timeout, deadline, policy.first_token_timeout):
+                    if isinstance(elem, str):
+                        self._streamed_text.append(elem)
+                        attempt_text.append(elem)
+                    elif partial:
+                        elem = Completion(elem.message.copy_with(text = partial + (elem.message.text or "")),
+                                          prompt_tokens = elem.prompt_tokens,
+                                          completion_tokens = elem.completion_tokens)
+                    yield elem
+                self._streamed_text = None
+                return
+            except Exception as e:
+                stalled = isinstance(e, asyncio.TimeoutError)
+                out_of_time = deadline is not None and time.monotonic() >= deadline
+                stats._count(stalls = int(stalled))
+                if retry >= policy.max_retries or out_of_time or not is_transient_error(e):
+                    stats._count(failures = 1)
+                    # the partial reply is kept by end_cancelled_round()
+                    if out_of_time:
+                        reason = "did not finish in time"
+                    else:
+                        reason = "stalled" if stalled else f"failed ({type(e).__name__}: {e})"
+                    raise ModelStreamError(f"The model's reply {reason} after {retry + 1} attempt(s).") from e
+
+            # the provider bills the failed attempt, though it reported no usage
+            await self._record_interrupted_usage("".join(attempt_text), partial, include_functions)
+            self._streamed_billed = len(partial) + sum(len(token) for token in attempt_text)
+            retry += 1
+            stats._count(retries = 1, resumed = int(bool(self._streamed_text)))
+            delay = policy.delay(retry)
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            await asyncio.sleep(delay)
+
+    async def _model_stream_attempt(self, include_functions, kwargs, partial):
+        if not partial:
+            async for elem in super().get_model_stream(include_functions = include_functions, **kwargs):
+                yield elem
+            return
+
+        # as Kani.get_model_stream(), with the partial reply and a request to continue it after the prompt
+        messages = await self.get_prompt(include_functions = include_functions, **kwargs)
+        messages += [ChatMessage.assistant(partial), ChatMessage.user(_CONTINUE_PROMPT)]
+        if include_functions:
+            stream = self.engine.stream(messages = messages, functions = self.get_enabled_functions(), **kwargs)
+        else:
+            stream = self.engine.stream(messages = messages, **kwargs)
+        async for elem in stream:
+            yield elem
+
+    async def _record_interrupted_usage(self, text, partial = "", include_functions = True):
+        # usage of a model stream that ended without a completion, estimated with the engine's tokenizer
+        prompt = await self.get_prompt(include_functions = include_functions)
+        if partial:
+            prompt = prompt + [ChatMessage.assistant(partial), ChatMessage.user(_CONTINUE_PROMPT)]
+        functions = self.get_enabled_functions() if include_functions else None
+        prompt_tokens = await self.prompt_token_len(prompt, functions)
+        completion_tokens = await self.prompt_token_len([ChatMessage.assistant(text)]) if text else 0
+        self._record_usage(prompt_tokens, completion_tokens)
+
+    async def get_model_stream(self, include_functions = True, **kwargs):
+        if self.response_cache is None:
+            async for elem in self._live_model_stream(include_functions, kwargs):
+                yield elem
+            return
+
+        key = self._response_cache_key(include_functions, kwargs)
+        response = self.response_cache.get(key)
+        if response is not None:
+            # replayed word by word through the same path as a live stream
+            for i, word in enumerate(response["text"].split(" ")):
+                yield word if i == 0 else " " + word
+            yield cached_completion(response)
+            return
+
+        async for elem in self._live_model_stream(include_functions, kwargs):
+            if not isinstance(elem, str):
+                response = cacheable_response(elem)
+                if response is not None:
+                    self.response_cache.set(key, response)
+            yield elem
 
     # https://github.com/zhudotexe/kani/issues/29#issuecomment-2140905232
     async def add_completion_to_history(self, completion):
-        self.tokens_used_prompt += completion.prompt_tokens
-        self.tokens_used_completion += completion.completion_tokens
+        prompt_tokens, cached_prompt_tokens = prompt_cache_usage(completion)
+        self._record_usage(prompt_tokens, completion.completion_tokens, cached_prompt_tokens)
+
+        if isinstance(completion, CachedCompletion):
+            self.cache_hits += 1
+            self.tokens_saved_prompt += completion.saved_prompt_tokens
+            self.tokens_saved_completion += completion.saved_completion_tokens
+
         return await super().add_completion_to_history(completion)
 
+    def _record_usage(self, prompt_tokens, completion_tokens, cached_prompt_tokens = 0):
+        self.tokens_used_prompt += prompt_tokens
+        self.tokens_used_prompt_cached += cached_prompt_tokens
+        self.tokens_used_completion += completion_tokens
+
+        # in-memory only, the ledger flushes to its store in the background
+        if self.usage_ledger is not None:
+            self.usage_ledger.record(user = self.usage_user,
+                                     agent = self.name,
+                                     model = getattr(self.engine, "model", None),
+                                     prompt_tokens = prompt_tokens,
+                                     completion_tokens = completion_tokens,
+                                     cost = self._tokens_cost(prompt_tokens or 0, completion_tokens or 0, cached_prompt_tokens))
+
+    async def end_cancelled_round(self):
+        """
+        Bring the agent back to a consistent state after a round was cancelled (e.g. stopped by the user). The partial
+        reply of an interrupted model stream is kept in the chat history, and estimated token counts for it (from the
+        engine's tokenizer) are billed; tool calls left without results are dropped. Returns the partial reply, or None.
+        """
+        self._drop_unanswered_tool_calls()
+
+        if self._streamed_text is None:
+            return None
+
+        text = "".join(self._streamed_text)
+        self._streamed_text = None
+
+        # the history hasn't changed since the stream started, so this is the prompt that was sent (after the text of
+        # any retried attempts)
+        billed = text[:self._streamed_billed]
+        await self._record_interrupted_usage(text[len(billed):], billed, self._streamed_include_functions)
+        text = text.strip()
+
+        if not text:
+            return None
+        message = ChatMessage.assistant(text)
+        await self.add_to_history(message)
+        return message
+
+    def _drop_unanswered_tool_calls(self):
+        # only the last message requesting tool calls can be waiting on results, which follow it in the history
+        answered = set()
+        for index in range(len(self.chat_history) - 1, -1, -1):
+            message = self.chat_history[index]
+            if message.role == ChatRole.FUNCTION:
+                answered.add(message.tool_call_id)
+                continue
+
+            if message.role == ChatRole.ASSISTANT and message.tool_calls:
+                tool_calls = [tool_call for tool_call in message.tool_calls if tool_call.id in answered]
+                if len(tool_calls) < len(message.tool_calls):
+                    if tool_calls or message.text:
+                        self.chat_history[index] = message.copy_with(tool_calls = tool_calls or None)
+                    else:
+                        del self.chat_history[index]
+            return
+
+
+def prefetchable(func):
+    """
+    Mark an @ai_function as safe to start as soon as the model requests it, for agents created with
+    prefetch_tools = True. Each requested call still runs exactly once, but a prefetched result is discarded if the
+    round ends before tool calls are made (e.g. at max_function_rounds), so the function should be idempotent and
+    free of side effects that matter.
+    """
+    func.__prefetchable__ = True
+    return func
+
+
+# await_job waits at most this long (seconds) per call, so a round isn't held up indefinitely
+_MAX_JOB_WAIT = 300
+
+
+def _render_job(job):
+    def render():
+        if job.status in ("queued", "running"):
+            text = f"⏳ {job.name} ({job.id}): {job.message or job.status}"
+            st.progress(job.progress or 0.0, text = text)
+        elif job.status == "done":
+            st.markdown(f"✅ {job.name} ({job.id}) finished in {job.elapsed:.1f} s")
+        elif job.status == "failed":
+            st.error(f"{job.name} ({job.id}) failed: {job.error}")
+        else:
+            st.markdown(f"⏹️ {job.name} ({job.id}) was cancelled")
+
+    if not job.live:
+        render()
+        return
+
+    # while the job runs, its progress refreshes every second, and the page reruns once when it finishes
+    @st.fragment(run_every = 1)
+    def poll():
+        if not job.live:
+            st.rerun(scope = "app")
+        render()
+
+    poll()
+
 
 class StreamlitKani(EnhancedKani):
     def __init__(self,
                  *args,
+                 prefetch_tools = False,
+                 job_manager = None,
                  **kwargs):
 
         super().__init__(*args, **kwargs)
 
         self.display_messages = []
         self.delayed_display_messages = []
+
+        # start @prefetchable tool calls as soon as the model's message completes, rather than after the server has
+        # handled the message and the next round begins; tool_call_id -> task
+        self.prefetch_tools = prefetch_tools
+        self._prefetched = {}
+
+        # background jobs started by tools with start_job(), on job_manager (the process-wide JobManager by
+        # default); job id -> Job
+        self.job_manager = job_manager
+        self.jobs = {}
         # not working
         #self.buttons = []
 
 
+    async def add_completion_to_history(self, completion):
+        message = await super().add_completion_to_history(completion)
+
+        if self.prefetch_tools:
+            # results of an earlier message that were never collected
+            for task in self._prefetched.values():
+                task.cancel()
+            self._prefetched = {}
+
+            for tool_call in message.tool_calls or []:
+                f = self.functions.get(tool_call.function.name)
+                if f is not None and getattr(f.inner, "__prefetchable__", False):
+                    self._prefetched[tool_call.id] = asyncio.ensure_future(
+                        super().do_function_call(tool_call.function, tool_call_id = tool_call.id))
+
+        return message
+
+    async def do_function_call(self, call, tool_call_id = None):
+        task = self._prefetched.pop(tool_call_id, None)
+        if task is not None:
+            return await task
+        return await super().do_function_call(call, tool_call_id = tool_call_id)
+
+    async def end_cancelled_round(self):
+        # prefetched tool calls of the cancelled round, and UI elements of tools whose results were dropped, are discarded
+        for task in self._prefetched.values():
+            task.cancel()
+        self._prefetched = {}
+        self.delayed_display_messages = []
+        return await super().end_cancelled_round()
+
+    def start_job(self, name, func, *args, **kwargs):
+        """
+        Start func(*args, **kwargs) as a background job, for tools whose work would otherwise hold up the reply (see
+        kani_utils.jobs). Returns the Job at once; the tool should tell the model its id, which the model can pass to
+        check_job and await_job. Its progress, as reported by func with report_progress(), is shown in the chat.
+        func runs in a worker thread, so it must not call Streamlit.
+        """
+        if self.job_manager is None:
+            self.job_manager = get_default_job_manager()
+
+        job = self.job_manager.submit(name, func, *args, **kwargs)
+        self.jobs[job.id] = job
+        self.render_in_streamlit_chat(functools.partial(_render_job, job))
+        return job
+
+    def get_enabled_functions(self):
+        functions = super().get_enabled_functions()
+        if not self.jobs and not self.stable_prompt_prefix:
+            # the job tools are only offered to the model once a job has been started (always, with a stable
+            # prompt prefix, since tool schemas come first in the prompt)
+            functions = [f for f in functions if f.name not in ("check_job", "await_job")]
+        return functions
+
+    @ai_function()
+    def check_job(self, job_id: Annotated[str, AIParam(desc="The id of the job.")]):
+        """Check on a background job started by another function: its status and progress, or its result once finished."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return f"Error: no job with id '{job_id}'."
+        return job.describe()
+
+    @ai_function()
+    async def await_job(self,
+                        job_id: Annotated[str, AIParam(desc="The id of the job.")],
+                        timeout_seconds: Annotated[int, AIParam(desc="How long to wait, at most 300 seconds.")] = 60):
+        """Wait for a background job started by another function to finish, and return its result (or its progress, if it is still running after timeout_seconds)."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return f"Error: no job with id '{job_id}'."
+
+        if job.live:
+            # waiting doesn't cancel the job if the wait times out or the reply is stopped
+            await asyncio.wait({asyncio.wrap_future(job.future)}, timeout = min(timeout_seconds, _MAX_JOB_WAIT))
+        return job.describe()
+
     def render_in_streamlit_chat(self, func, delay = True):
         """Renders UI components in the chat. Takes a function that takes no parameters that should render the elements."""
         if not delay:
@@ -77,10 +510,23 @@ class StreamlitKani(EnhancedKani):
     def render_sidebar(self):
         st.markdown(self.description)
 
+
+    def render_cost_panel(self):
+        """
+        Renders the conversation cost, below the agent's sidebar. The server refreshes it after each turn without
+        rerunning the rest of the sidebar, so it must not contain widgets.
+        """
         cost = self.get_convo_cost()
+        cached_str = f" ({self.tokens_used_prompt_cached} cached)" if self.tokens_used_prompt_cached else ""
 
         if cost is not None:
             st.markdown(f"""
                         ### Conversation Cost: ${(0.01 + cost if cost > 0 else 0.00):.2f}
-                        Prompt tokens: {self.tokens_used_prompt}, Completion tokens: {self.tokens_used_completion}
+                        Prompt tokens: {self.tokens_used_prompt}{cached_str}, Completion tokens: {self.tokens_used_completion}
                         """)
+
+        if self.cache_hits:
+            saved = self._tokens_cost(self.tokens_saved_prompt, self.tokens_saved_completion)
+            saved_str = f", saving ${saved:.2f}" if saved is not None else ""
+            st.markdown(f"Cached responses: {self.cache_hits}{saved_str} ({self.tokens_saved_prompt} prompt, "
+                        f"{self.tokens_saved_completion} completion tokens)")
@@ -0,0 +1,369 @@
+import base64
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from kani import ChatMessage
+
+# the server persists agents' chat state as append-only logs of JSON records, one log per session token:
+#   {"agent": name, "type": "history", "messages": [...]}      messages appended to agent.chat_history
+#   {"agent": name, "type": "display", "messages": [...]}      chat messages appended to agent.display_messages
+#   {"agent": name, "type": "memory_set", "key": k, "value": b64 dill}
+#   {"agent": name, "type": "memory_del", "key": k}
+#   {"agent": name, "type": "counters", "prompt": n, "completion": n, "cached_prompt": n}
+#   {"agent": name, "type": "reset"}                           history was cleared or rewritten
+
+# releases a session lock only if it is still held by the given token
+_REDIS_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+# sessions whose read position FileCheckpointStore remembers
+_FILE_POSITIONS_SIZE = 4096
+
+
+class FileCheckpointStore:
+    """
+    Checkpoint logs as append-only JSON lines files, one per session, in a local directory. The store remembers where
+    in each file it last stopped reading, so that reading new records (e.g. on every rerun in shared session state
+    mode) seeks there rather than re-reading the log.
+    """
+    def __init__(self, directory = "kani_checkpoints"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+        self._positions = collections.OrderedDict()  # path -> (record index, byte position) of a record's start
+        self._positions_lock = threading.Lock()
+
+    def _path(self, session_key):
+        return os.path.join(self.directory, hashlib.sha256(session_key.encode()).hexdigest() + ".jsonl")
+
+    def append(self, session_key, records):
+        with open(self._path(session_key), "a", encoding = "utf-8") as f:
+            f.write("".join(record + "\n" for record in records))
+
+    def read(self, session_key, start = 0):
+        """Return the records of the session's log from index start on."""
+        path = self._path(session_key)
+        with self._positions_lock:
+            index, position = self._positions.get(path, (0, 0))
+        if index > start:
+            index, position = 0, 0
+
+        records = []
+        try:
+            with open(path, "rb") as f:
+                if position > os.fstat(f.fileno()).st_size:
+                    # the log was replaced
+                    index, position = 0, 0
+                f.seek(position)
+                while True:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        # the end of the log, or a record still being appended by another process
+                        break
+                    if index >= start:
+                        records.append(line[:-1].decode("utf-8"))
+                    index += 1
+                    position += len(line)
+        except FileNotFoundError:
+            return []
+
+        with self._positions_lock:
+            self._positions[path] = (index, position)
+            self._positions.move_to_end(path)
+            if len(self._positions) > _FILE_POSITIONS_SIZE:
+                self._positions.popitem(last = False)
+        return records
+
+    @contextlib.contextmanager
+    def lock(self, session_key, timeout = 60):
+        """Hold an exclusive lock on the session, across processes on this host."""
+        import fcntl
+
+        lock_path = self._path(session_key)[:-len(".jsonl")] + ".lock"
+        with open(lock_path, "a") as f:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Timed out waiting for the lock on session {session_key}")
+                    time.sleep(0.05)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RedisCheckpointStore:
+    """Checkpoint logs as Redis lists, one per session, expiring ttl_seconds after the last write."""
+    def __init__(self, client = None, url = None, prefix = "checkpoint:", ttl_seconds = 60 * 60 * 24 * 7):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+
+    def append(self, session_key, records):
+        self.client.rpush(self.prefix + session_key, *records)
+        self.client.expire(self.prefix + session_key, self.ttl_seconds)
+
+    def read(self, session_key, start = 0):
+        """Return the records of the session's log from index start on."""
+        records = self.client.lrange(self.prefix + session_key, start, -1)
+        return [record.decode("utf-8") if isinstance(record, bytes) else record for record in records]
+
+    @contextlib.contextmanager
+    def lock(self, session_key, timeout = 60, lease_seconds = 300):
+        """
+        Hold an exclusive lock on the session, across all workers using the database. The lock expires after
+        lease_seconds in case its holder dies.
+        """
+        lock_key = self.prefix + session_key + ":lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not self.client.set(lock_key, token, nx = True, px = int(lease_seconds * 1000)):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for the lock on session {session_key}")
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            # only release the lock if it is still ours
+            self.client.eval(_REDIS_RELEASE_SCRIPT, 1, lock_key, token)
+
+
+
+def _counters(agent):
+    return (agent.tokens_used_prompt, agent.tokens_used_completion, getattr(agent, "tokens_used_prompt_cached", 0))
+
+
+def _mark_checkpointed(agent, memory_seen):
+    agent._checkpointed = {"history": len(agent.chat_history),
+                           "display": len(getattr(agent, "display_messages", [])),
+                           "memory": memory_seen,
+                           "counters": _counters(agent)}
+
+
+class SessionCheckpointer:
+    """
+    Incrementally persists agents' chat state after each turn, and restores it for returning sessions.
+
+    checkpoint() only appends what changed since the agent's previous checkpoint: new chat_history and
+    display messages, memory keys that were set (a new object stored under the key) or deleted, and the token
+    counters. UI-only display messages (rendered Streamlit elements) are not persisted.
+
+    Memory changes are detected by object identity only, so a value mutated in place (e.g. a list appended to or a
+    DataFrame modified with inplace = True) is not checkpointed until a new object is stored under its key; tools
+    should store updated values as new objects, e.g. self.memory[key] = df.assign(...) rather than modifying df.
+
+    The checkpointer is meant to be shared between sessions, e.g. created in an @st.cache_resource function and
+    passed to initialize_app_config(session_checkpointer = ...).
+    """
+    def __init__(self, store = None):
+        self.store = store if store is not None else FileCheckpointStore()
+
+    def checkpoint(self, session_key, agent_name, agent):
+        """Append the agent's changes since its last checkpoint to the session's log. Returns the number of records."""
+        records = self.changes(agent_name, agent)
+        if records:
+            self.store.append(session_key, records)
+        return len(records)
+
+    def changes(self, agent_name, agent):
+        """Return the records describing the agent's changes since the last call, and mark them as seen."""
+        import dill
+
+        unseen = {"history": 0, "display": 0, "memory": {}, "counters": (0, 0, 0)}
+        seen = getattr(agent, "_checkpointed", None) or unseen
+        records = []
+
+        def add(record_type, **fields):
+            records.append(json.dumps({"agent": agent_name, "type": record_type, **fields}))
+
+        # a history shorter than at the last checkpoint was cleared or rewritten; start the agent over
+        if len(agent.chat_history) < seen["history"]:
+            add("reset")
+            seen = unseen
+
+        new_history = agent.chat_history[seen["history"]:]
+        if new_history:
+            add("history", messages = [m.model_dump(mode = "json") for m in new_history])
+
+        display_messages = getattr(agent, "display_messages", [])
+        new_display = [m for m in display_messages[seen["display"]:] if isinstance(m, ChatMessage)]
+        if new_display:
+            add("display", messages = [m.model_dump(mode = "json") for m in new_display])
+
+        memory = getattr(agent, "memory", None)
+        memory_seen = dict(seen["memory"])
+        if isinstance(memory, dict):
+            # a snapshot, since background jobs may change memory meanwhile
+            memory = dict(memory)
+            for key, value in memory.items():
+                # identity of the stored object stands in for a content hash, which would cost O(memory size) per turn;
+                # the object itself is kept rather than its id(), which a later object could reuse
+                if key not in memory_seen or memory_seen[key] is not value:
+                    add("memory_set", key = key, value = base64.b64encode(dill.dumps(value)).decode("ascii"))
+                    memory_seen[key] = value
+            for key in set(memory_seen) - set(memory):
+                add("memory_del", key = key)
+                del memory_seen[key]
+
+        counters = _counters(agent)
+        if counters != tuple(seen["counters"]):
+            add("counters", prompt = counters[0], completion = counters[1], cached_prompt = counters[2])
+
+        _mark_checkpointed(agent, memory_seen)
+        return records
+
+    def load(self, session_key, start = 0):
+        """
+        Read the session's log from record index start on, returning {agent_name: [records]} to be applied with
+        restore_agent().
+        """
+        by_agent = {}
+        for record in self.store.read(session_key, start):
+            record = json.loads(record)
+            by_agent.setdefault(record["agent"], []).append(record)
+        return by_agent
+
+    def lock(self, session_key, timeout = 60):
+        """Context manager holding the store's exclusive lock on the session, e.g. for the duration of a turn."""
+        return self.store.lock(session_key, timeout = timeout)
+
+    def restore_agent(self, agent, records):
+        """
+        Apply an agent's checkpoint records to a freshly created agent, or, to catch up with changes made by
+        another worker, apply the records following those the agent has already seen.
+        """
+        for record in records:
+            _apply_record(agent, record)
+        _mark_restored(agent)
+
+    def sync(self, session_key, agents, start = 0, on_error = None):
+        """
+        Catch {agent_name: agent} up with the session's log from record index start on, e.g. with the changes other
+        workers have checkpointed, returning the index of the next record to read.
+
+        Every record read is consumed exactly once, so calling sync() again from the returned index never applies a
+        record twice: a record that can't be applied (e.g. a memory value that no longer unpickles) is passed to
+        on_error(record, exception), or raised if on_error is None, and skipped.
+        """
+        records = self.store.read(session_key, start)
+        restored = {}
+        for record in records:
+            record = json.loads(record)
+            agent = agents.get(record["agent"])
+            if agent is None:
+                continue
+            try:
+                _apply_record(agent, record)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(record, e)
+            restored[id(agent)] = agent
+
+        for agent in restored.values():
+            _mark_restored(agent)
+        return start + len(records)
+
+
+def _apply_record(agent, record):
+    import dill
+
+    record_type = record["type"]
+    if record_type == "reset":
+        agent.chat_history = []
+        agent.display_messages = []
+        agent.tokens_used_prompt = 0
+        agent.tokens_used_prompt_cached = 0
+        agent.tokens_used_completion = 0
+        if isinstance(getattr(agent, "memory", None), dict):
+            agent.memory.clear()
+    elif record_type == "history":
+        agent.chat_history.extend(ChatMessage.model_validate(m) for m in record["messages"])
+    elif record_type == "display":
+        agent.display_messages.extend(ChatMessage.model_validate(m) for m in record["messages"])
+    elif record_type == "memory_set":
+        agent.memory[record["key"]] = dill.loads(base64.b64decode(record["value"]))
+    elif record_type == "memory_del":
+        agent.memory.pop(record["key"], None)
+    elif record_type == "counters":
+        agent.tokens_used_prompt = record["prompt"]
+        agent.tokens_used_prompt_cached = record.get("cached_prompt", 0)
+        agent.tokens_used_completion = record["completion"]
+
+
+def _mark_restored(agent):
+    # the restored state is already persisted
+    memory = getattr(agent, "memory", None)
+    _mark_checkpointed(agent, dict(memory) if isinstance(memory, dict) else {})
+
+
+def benchmark_checkpoints(store = None, session_sizes = (10, 100, 1000), message_chars = 500):
+    """
+    Measure checkpoint cost per turn and resume time as sessions grow, using a stand-in agent.
+
+    For each session size (in turns), simulates that many user/assistant turns, checkpointing after each, then
+    restores the session into a fresh agent. Returns a list of dicts with the mean and max checkpoint time per turn,
+    the log size in records and the resume time, all times in seconds.
+    """
+    import tempfile
+    import uuid
+
+    class _Agent:
+        def __init__(self):
+            self.chat_history = []
+            self.display_messages = []
+            self.memory = {}
+            self.tokens_used_prompt = 0
+            self.tokens_used_completion = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpointer = SessionCheckpointer(store if store is not None else FileCheckpointStore(directory))
+        results = []
+
+        for size in session_sizes:
+            session_key = uuid.uuid4().hex
+            agent = _Agent()
+            timings = []
+            for turn in range(size):
+                user, reply = ChatMessage.user("q" * message_chars), ChatMessage.assistant("a" * message_chars)
+                agent.chat_history.extend([user, reply])
+                agent.display_messages.extend([user, reply])
+                agent.memory[f"turn {turn}"] = "m" * message_chars
+                agent.tokens_used_prompt += message_chars
+                agent.tokens_used_completion += message_chars
+
+                start = time.perf_counter()
+                checkpointer.checkpoint(session_key, "agent", agent)
+                timings.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            records = checkpointer.load(session_key)
+            restored = _Agent()
+            checkpointer.restore_agent(restored, records.get("agent", []))
+            resume_seconds = time.perf_counter() - start
+
+            results.append({"turns": size,
+                            "restored_messages": len(restored.chat_history),
+                            "records": sum(len(r) for r in records.values()),
+                            "checkpoint_mean": sum(timings) / len(timings),
+                            "checkpoint_max": max(timings),
+                            "resume": resume_seconds})
+
+        return results
@@ -0,0 +1,132 @@
+"""Command line interface for kani-utils."""
+import json
+import os
+import subprocess
+import sys
+
+import click
+
+
+@click.group()
+def main():
+    """Utilities for serving and benchmarking Kani agents."""
+
+
+@main.command()
+@click.option("--users", default="1,10,100", show_default=True, help="Comma-separated numbers of simulated users.")
+@click.option("--turns", default=3, show_default=True, help="Prompts sent by each simulated user.")
+@click.option("--tokens-per-second", default=50.0, show_default=True, help="Streaming rate of the fake engine.")
+@click.option("--first-token-delay", default=0.2, show_default=True, help="Seconds before the fake engine's first token.")
+@click.option("--timeout", default=120.0, show_default=True, help="Timeout in seconds for each script run.")
+@click.option("--flush-interval", default=0.05, show_default=True,
+              help="Seconds between streamed updates to the browser; 0 sends each token.")
+@click.option("--stall-rate", default=0.0, show_default=True, help="Fraction of fake engine streams that stall midway.")
+@click.option("--idle-timeout", default=60.0, show_default=True,
+              help="Seconds without a token before the agent retries a stalled stream.")
+def loadtest(users, turns, tokens_per_second, first_token_delay, timeout, flush_interval, stall_rate, idle_timeout):
+    """Run the headless load test against the chat server with a fake LLM engine, printing JSON results."""
+    from kani_utils.loadtest import FakeEngine, default_agents_func, run_load_test
+    from kani_utils.streaming import FlushPolicy, StreamRetryPolicy
+
+    engine = FakeEngine(tokens_per_second=tokens_per_second, first_token_delay=first_token_delay, stall_rate=stall_rate)
+    agents_func = default_agents_func(engine, stream_retry=StreamRetryPolicy(idle_timeout=idle_timeout))
+    user_counts = [int(count) for count in users.split(",")]
+    app_config = {"stream_flush": FlushPolicy(interval=flush_interval) if flush_interval > 0 else None}
+
+    for result in run_load_test(agents_func=agents_func, engine=engine, user_counts=user_counts, turns_per_user=turns,
+                                timeout=timeout, app_config=app_config):
+        click.echo(json.dumps(result))
+
+
+@main.command("rerun-bench")
+@click.option("--history-turns", default="0,10,50", show_default=True,
+              help="Comma-separated chat history lengths, in turns, to measure reruns at.")
+@click.option("--reruns", default=50, show_default=True, help="Measured reruns per history length.")
+@click.option("--logo", default=None, help="Logo image shown in the sidebar.")
+@click.option("--background-image", default=None, help="Background image file or URL.")
+def rerun_bench(history_turns, reruns, logo, background_image):
+    """Measure the latency of reruns triggered from the sidebar, with a fake LLM engine, printing JSON results."""
+    from kani_utils.loadtest import run_rerun_benchmark
+
+    app_config = {"logo_path": logo}
+    if background_image:
+        app_config["background_image"] = background_image
+    turns = [int(count) for count in history_turns.split(",")]
+
+    for result in run_rerun_benchmark(history_turns=turns, reruns=reruns, app_config=app_config):
+        click.echo(json.dumps(result))
+
+
+@main.command("checkpoint-bench")
+@click.option("--sizes", default="10,100,1000", show_default=True, help="Comma-separated session sizes, in turns.")
+@click.option("--message-chars", default=500, show_default=True, help="Characters per simulated message.")
+@click.option("--redis-url", default=None, help="Benchmark a Redis checkpoint store instead of local files.")
+def checkpoint_bench(sizes, message_chars, redis_url):
+    """Measure session checkpoint cost per turn and resume time against session size, printing JSON results."""
+    from kani_utils.checkpoint import RedisCheckpointStore, benchmark_checkpoints
+
+    store = RedisCheckpointStore(url=redis_url) if redis_url else None
+    session_sizes = [int(size) for size in sizes.split(",")]
+
+    for result in benchmark_checkpoints(store=store, session_sizes=session_sizes, message_chars=message_chars):
+        click.echo(json.dumps(result))
+
+
+@main.command("eval")
+@click.argument("agents_func")
+@click.argument("prompts_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--output", "-o", default="eval_results.jsonl", show_default=True,
+              help="Results file, written as Parquet if it ends in .parquet and as JSON lines otherwise.")
+@click.option("--agent", default=None, help="Agent for prompts that don't name one (default: the first agent).")
+@click.option("--concurrency", default=8, show_default=True, help="Maximum number of conversations run at once.")
+def evaluate(agents_func, prompts_file, output, agent, concurrency):
+    """
+    Run the conversations in PROMPTS_FILE (JSON lines with a "prompt" or "prompts", and optionally an "id" and
+    "agent") against the agents returned by AGENTS_FUNC, given as module:function or file.py:function.
+    """
+    from kani_utils.evaluation import load_agents_func, read_prompts, run_evaluation, write_results
+
+    conversations = read_prompts(prompts_file)
+    results = run_evaluation(load_agents_func(agents_func), conversations, agent_name=agent, concurrency=concurrency)
+    write_results(results, output)
+
+    costs = [result["cost"] for result in results if result["cost"] is not None]
+    click.echo(json.dumps({"conversations": len(results),
+                           "errors": sum(result["error"] is not None for result in results),
+                           "prompt_tokens": sum(result["prompt_tokens"] or 0 for result in results),
+                           "cached_prompt_tokens": sum(result["cached_prompt_tokens"] or 0 for result in results),
+                           "completion_tokens": sum(result["completion_tokens"] or 0 for result in results),
+                           "cost": sum(costs) if costs else None,
+                           "output": output}))
+
+
+@main.command()
+@click.argument("app_script")
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True, help="Number of Streamlit processes.")
+@click.option("--base-port", default=8501, show_default=True, help="Port of the first worker; others follow.")
+def serve(app_script, workers, base_port):
+    """
+    Run APP_SCRIPT in one Streamlit process per worker on consecutive ports, to be put behind a reverse proxy.
+
+    Without sticky sessions at the proxy, the app should be configured with a session_checkpointer on a shared
+    store and shared_session_state = True, so that any worker can pick up a session.
+    """
+    processes = []
+    for port in range(base_port, base_port + workers):
+        command = [sys.executable, "-m", "streamlit", "run", app_script,
+                   "--server.port", str(port), "--server.headless", "true"]
+        processes.append(subprocess.Popen(command))
+        click.echo(f"Started worker on port {port}")
+
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
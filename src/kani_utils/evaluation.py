@@ -0,0 +1,136 @@
+import asyncio
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+
+from kani import ChatRole
+
+
+def load_agents_func(spec):
+    """
+    Load an agents factory (the function passed to set_app_agents) from a "module:function" or
+    "path/to/file.py:function" spec.
+    """
+    module_name, _, func_name = spec.rpartition(":")
+    if not module_name or not func_name:
+        raise ValueError(f"Expected an agents factory as module:function or file.py:function, got {spec!r}")
+
+    if module_name.endswith(".py"):
+        # make the file's neighbours importable, as they would be when run with streamlit
+        sys.path.insert(0, os.path.dirname(os.path.abspath(module_name)))
+        module_spec = importlib.util.spec_from_file_location(os.path.basename(module_name)[:-3], module_name)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(module_name)
+
+    return getattr(module, func_name)
+
+
+def read_prompts(path):
+    """
+    Read conversations from a JSONL file. Each line is an object with a "prompt" (a string) or "prompts" (a list of
+    user turns), and optionally an "id" and the name of the "agent" to run it against.
+    """
+    conversations = []
+    with open(path, encoding = "utf-8") as f:
+        for line_number, line in enumerate(f, start = 1):
+            if not line.strip():
+                continue
+            conversation = json.loads(line)
+            if "prompts" not in conversation:
+                conversation["prompts"] = [conversation.pop("prompt")]
+            conversation.setdefault("id", line_number)
+            conversations.append(conversation)
+    return conversations
+
+
+async def _run_conversation(agents_func, conversation, default_agent, semaphore):
+    async with semaphore:
+        result = {"id": conversation["id"], "agent": conversation.get("agent") or default_agent, "model": None,
+                  "turns": [], "error": None}
+        agent = None
+        start = time.perf_counter()
+
+        # any failure, including an unknown agent name or a failing agents factory, is recorded in the conversation's
+        # result rather than aborting the run
+        try:
+            # a fresh set of agents per conversation, as for each new session of the app
+            agents = agents_func()
+            result["agent"] = result["agent"] or next(iter(agents))
+            agent = agents[result["agent"]]
+            result["model"] = getattr(agent.engine, "model", None)
+
+            for prompt in conversation["prompts"]:
+                turn_start = time.perf_counter()
+                output, tool_calls, tool_results = [], [], {}
+
+                async for message in agent.full_round(prompt.strip()):
+                    if message.role == ChatRole.ASSISTANT:
+                        if message.text:
+                            output.append(message.text)
+                        for tool_call in message.tool_calls or []:
+                            tool_calls.append({"id": tool_call.id,
+                                               "name": tool_call.function.name,
+                                               "arguments": tool_call.function.kwargs})
+                    elif message.role == ChatRole.FUNCTION:
+                        tool_results[message.tool_call_id] = message.text
+
+                for tool_call in tool_calls:
+                    tool_call["result"] = tool_results.get(tool_call["id"])
+
+                result["turns"].append({"prompt": prompt,
+                                        "output": "\n".join(output),
+                                        "tool_calls": tool_calls,
+                                        "latency": time.perf_counter() - turn_start})
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+
+        result["latency"] = time.perf_counter() - start
+        result["prompt_tokens"] = getattr(agent, "tokens_used_prompt", None)
+        result["cached_prompt_tokens"] = getattr(agent, "tokens_used_prompt_cached", None)
+        result["completion_tokens"] = getattr(agent, "tokens_used_completion", None)
+        result["cost"] = agent.get_convo_cost() if hasattr(agent, "get_convo_cost") else None
+        return result
+
+
+async def run_evaluation_async(agents_func, conversations, agent_name = None, concurrency = 8):
+    """Async version of run_evaluation(), for use from a running event loop."""
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[_run_conversation(agents_func, conversation, agent_name, semaphore)
+                                  for conversation in conversations])
+
+
+def run_evaluation(agents_func, conversations, agent_name = None, concurrency = 8):
+    """
+    Run conversations against agents without the Streamlit UI, for regression and cost benchmarking.
+
+    agents_func is the agents factory passed to set_app_agents; it is called once per conversation, so each
+    conversation starts from fresh agents. conversations is a list of dicts as returned by read_prompts(); those
+    not naming an agent run against agent_name, or the factory's first agent. At most concurrency conversations run
+    at a time, on a single event loop.
+
+    Returns one result dict per conversation, in order, with the output, latency and tool calls (name, arguments,
+    result) of each turn, the total latency (seconds), the agent's token counters and cost, and the error, if any.
+    """
+    return asyncio.run(run_evaluation_async(agents_func, conversations, agent_name, concurrency))
+
+
+def write_results(results, path):
+    """Write evaluation results as JSON lines, or as a Parquet file (which requires pandas and pyarrow) for .parquet paths."""
+    if path.endswith(".parquet"):
+        import pandas as pd
+
+        # nested turns are kept as JSON text, since their tool arguments and results have no fixed schema; ids may
+        # mix line numbers and strings
+        df = pd.DataFrame([{**result, "id": str(result["id"]), "turns": json.dumps(result["turns"], default = str)}
+                           for result in results])
+        df.to_parquet(path, index = False)
+        return
+
+    with open(path, "w", encoding = "utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, default = str) + "\n")
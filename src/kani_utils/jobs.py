@@ -0,0 +1,144 @@
+import concurrent.futures
+import contextvars
+import threading
+import time
+import uuid
+
+# the Job run by the current worker thread, for report_progress()
+_current_job = contextvars.ContextVar("kani_utils_current_job", default = None)
+
+_default_job_manager = None
+_default_job_manager_lock = threading.Lock()
+
+
+def get_default_job_manager():
+    """The process-wide JobManager used by agents not given one, created on first use."""
+    global _default_job_manager
+    with _default_job_manager_lock:
+        if _default_job_manager is None:
+            _default_job_manager = JobManager()
+        return _default_job_manager
+
+
+def report_progress(progress = None, message = None):
+    """
+    Report the progress (a fraction from 0 to 1, or None if unknown) and a status message of the job running in the
+    calling thread. Does nothing outside a job, e.g. in a process pool.
+    """
+    job = _current_job.get()
+    if job is not None:
+        job.report(progress, message)
+
+
+class Job:
+    """
+    Handle of a background job: its status ("queued", "running", "done", "failed" or "cancelled"), progress, and
+    result or error once finished. Pickled (e.g. in a shared chat), a job keeps its state at that time but not its
+    future.
+    """
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.status = "queued"
+        self.progress = None
+        self.message = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.future = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["future"] = None
+        return state
+
+    @property
+    def live(self):
+        """Whether the job is still queued or running in this process."""
+        return self.future is not None and not self.future.done()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def report(self, progress = None, message = None):
+        if progress is not None:
+            self.progress = min(max(progress, 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    def _finish(self, future):
+        self.finished = time.time()
+        if self.started is None:
+            self.started = self.finished
+        if future.cancelled():
+            self.status = "cancelled"
+        elif future.exception() is not None:
+            error = future.exception()
+            self.error = f"{type(error).__name__}: {error}"
+            self.status = "failed"
+        else:
+            self.result = future.result()
+            self.progress = 1.0
+            self.status = "done"
+
+    def describe(self):
+        """The job's state as text for the model, including its result once done."""
+        header = f"Job '{self.id}' ({self.name})"
+        if self.status == "queued":
+            return f"{header} is queued and has not started yet."
+        if self.status == "running":
+            progress = f", {self.progress:.0%} done" if self.progress is not None else ""
+            message = f" ({self.message})" if self.message else ""
+            return f"{header} is running{progress}{message}, for {self.elapsed:.0f} s so far."
+        if self.status == "done":
+            return f"{header} finished in {self.elapsed:.1f} s. Result:\n\n{self.result}"
+        if self.status == "failed":
+            return f"{header} failed after {self.elapsed:.1f} s: {self.error}"
+        return f"{header} was cancelled."
+
+
+class JobManager:
+    """
+    Runs background jobs for the agents of all sessions of the process, in a thread pool of max_workers threads.
+
+    Jobs are independent of the script runs and agent rounds that start them: they keep running across reruns, and
+    when a reply is stopped, until their function returns. With processes = True jobs run in a process pool instead,
+    for CPU-bound work; their functions and arguments must then be picklable (e.g. module-level functions, not bound
+    methods of agents), and report_progress() has no effect.
+    """
+    def __init__(self, max_workers = 4, processes = False):
+        self.processes = processes
+        if processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = max_workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = "kani-job")
+
+    def submit(self, name, func, *args, **kwargs):
+        """Start func(*args, **kwargs) as a background job, returning its Job."""
+        job = Job(name)
+        if self.processes:
+            job.future = self.executor.submit(func, *args, **kwargs)
+            job.status = "running"
+            job.started = time.time()
+        else:
+            job.future = self.executor.submit(self._run, job, func, args, kwargs)
+        job.future.add_done_callback(job._finish)
+        return job
+
+    @staticmethod
+    def _run(job, func, args, kwargs):
+        job.status = "running"
+        job.started = time.time()
+        token = _current_job.set(job)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_job.reset(token)
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait = wait)
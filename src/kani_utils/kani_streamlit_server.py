@@ -1,16 +1,25 @@
 import streamlit as st
 import logging
 from kani import ChatRole, ChatMessage
-import asyncio
-from upstash_redis import Redis
 import base64
-import dill
+import collections
+import contextlib
+import copy
 import hashlib
 import urllib.parse
-from kani_utils.utils import _seconds_to_days_hours, _sync_generator_from_kani_streammanager
+from kani_utils.runtime import SessionLoop, get_default_runtime
+from kani_utils.share_index import ShareIndex
+from kani_utils.streaming import FlushPolicy, ModelStreamError, coalesce_stream
+from kani_utils.utils import _seconds_to_days_hours
 import json
 import datetime
+import functools
+import mimetypes
 import os
+import threading
+import time
+import uuid
+import zlib
 
 class UIOnlyMessage:
     def __init__(self, func, role=ChatRole.ASSISTANT, icon="💡", type = "ui_element"):
@@ -20,24 +29,110 @@ class UIOnlyMessage:
         self.type = type # the type of message, e.g. "ui_element" or "tool_use"
 
 
+# string fields of "Full context" messages longer than this are truncated when shown (the download has them in full)
+_CONTEXT_FIELD_CHARS = 2000
+
+
+def _truncate_fields(value, max_chars):
+    if isinstance(value, str) and len(value) > max_chars:
+        return value[:max_chars] + f"… [{len(value) - max_chars} more characters]"
+    if isinstance(value, dict):
+        return {key: _truncate_fields(item, max_chars) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_truncate_fields(item, max_chars) for item in value]
+    return value
+
+
+class _FullContext:
+    """
+    The messages of a turn, for the "Full context" view shown with show_function_calls. Stored once as compressed
+    JSON, and only decoded when the view is opened, so reruns and shared chats carry just the compressed bytes.
+    """
+    def __init__(self, messages):
+        self.id = uuid.uuid4().hex
+        self.message_count = len(messages)
+        self.data = zlib.compress(json.dumps([message.model_dump(mode = "json") for message in messages],
+                                             default = str).encode("utf-8"))
+
+    def render(self):
+        with st.expander("Full context"):
+            if not st.toggle(f"Show {self.message_count} messages", key = f"full_context_{self.id}"):
+                return
+
+            data = zlib.decompress(self.data)
+            st.json(_truncate_fields(json.loads(data), _CONTEXT_FIELD_CHARS))
+            st.download_button("Download full context", data, file_name = f"context-{self.id[:8]}.json",
+                               mime = "application/json", key = f"full_context_download_{self.id}")
+
+
+# static assets and styling are memoized at module level, keyed on file path and mtime, so the common
+# rerun path does not re-read or re-encode files or rebuild large HTML/CSS strings
+@functools.lru_cache(maxsize=32)
+def _read_img_as_base64(file_path, mtime):
+    with open(file_path, "rb") as f:
+        data = f.read()
+    return base64.b64encode(data).decode()
+
+
+# the mtimes of asset files are re-checked at most this often, so most reruns don't stat them either; a modified
+# logo or background shows up within this many seconds
+_ASSET_CHECK_SECONDS = 5
+_asset_mtimes = {}  # path -> (time.monotonic() of the check, mtime, or None if the path isn't a file)
+
+
+def _asset_mtime(file_path):
+    checked = _asset_mtimes.get(file_path)
+    now = time.monotonic()
+    if checked is None or now - checked[0] > _ASSET_CHECK_SECONDS:
+        mtime = os.path.getmtime(file_path) if os.path.isfile(file_path) else None
+        checked = _asset_mtimes[file_path] = (now, mtime)
+    return checked[1]
+
+
 def get_img_as_base64(file_path:str):
-    """Load an image file and return it as a base64 encoded string."""
+    """Load an image file and return it as a base64 encoded string. Cached until the file is modified."""
     try:
-        with open(file_path, "rb") as f:
-            data = f.read()
-        return base64.b64encode(data).decode()
+        mtime = _asset_mtime(file_path)
+        if mtime is None:
+            raise FileNotFoundError(f"No such file: {file_path}")
+        return _read_img_as_base64(file_path, mtime)
     except Exception as e:
         st.warning(f"Could not load image {file_path}: {str(e)}")
         return None
 
 
+def _asset_url(path_or_url):
+    """Return a URL for an image, inlining local files as (cached) data URIs."""
+    if _asset_mtime(path_or_url) is None:
+        return path_or_url
+
+    mime_type = mimetypes.guess_type(path_or_url)[0] or "image/png"
+    return f"data:{mime_type};base64,{get_img_as_base64(path_or_url)}"
+
+
+def _get_redis():
+    """Connect to the shared chats database. upstash_redis is imported here since sharing is optional."""
+    if st.session_state.get("redis_client") is not None:
+        return st.session_state.redis_client
+
+    from upstash_redis import Redis
+    return Redis.from_env()
+
+
+def _shared_chats_configured():
+    return st.session_state.get("redis_client") is not None or \
+           ("UPSTASH_REDIS_REST_URL" in os.environ and "UPSTASH_REDIS_REST_TOKEN" in os.environ)
+
+
 def initialize_app_config(**kwargs):
     """Initialize app configuration with support for custom pages."""
     _initialize_session_state(**kwargs)
 
     params_to_remove = [
         "show_function_calls", "share_chat_ttl_seconds", "show_function_calls_status",
-        "logo_path", "app_title", "background_image", "theme_color", "custom_pages"
+        "logo_path", "app_title", "background_image", "theme_color", "custom_pages",
+        "query_limiter", "usage_ledger", "redis_client", "session_checkpointer", "shared_session_state",
+        "shared_event_loop", "chat_fragment", "stream_flush",
     ]
 
     for param in params_to_remove:
@@ -83,10 +178,96 @@ def set_app_agents(agents_func, reinit = False):
         if not reinit:
             st.session_state.current_agent_name = list(st.session_state.agents.keys())[0]
 
+            # a returning session (token in the URL) is restored from its checkpoints, one agent at a time as it is
+            # used, once the user has logged in (see _checkpoint_key())
+            checkpointer = st.session_state.get("session_checkpointer")
+            if checkpointer is not None and "session_token" in st.query_params and not st.session_state.get("shared_session_state"):
+                st.session_state.restore_checkpoints = True
+
     if "current_agent_name" not in st.session_state and "agents" in st.session_state:
         st.session_state.current_agent_name = list(st.session_state.agents.keys())[0]
 
 
+def _session_token():
+    """Token identifying the session's checkpoints; kept in the URL so it survives refreshes and reconnects."""
+    if "session_token" not in st.session_state:
+        st.session_state.session_token = st.query_params.get("session_token") or uuid.uuid4().hex
+    if st.query_params.get("session_token") != st.session_state.session_token:
+        st.query_params["session_token"] = st.session_state.session_token
+    return st.session_state.session_token
+
+
+def _checkpoint_key():
+    """
+    The key of the session's checkpoint log: the session token bound to the logged-in user, so that a URL carrying
+    someone else's session_token (a shared link, a leaked browser history) starts an empty session instead of
+    restoring their agents.
+    """
+    username = st.session_state.get("username")
+    if username is None:
+        return _session_token()
+    return f"{username}/{_session_token()}"
+
+
+def _restore_current_agent():
+    if st.session_state.pop("restore_checkpoints", False):
+        st.session_state.pending_restores = st.session_state.session_checkpointer.load(_checkpoint_key())
+
+    pending_restores = st.session_state.get("pending_restores")
+    if not pending_restores or st.session_state.current_agent_name not in pending_restores:
+        return
+
+    records = pending_restores.pop(st.session_state.current_agent_name)
+    agent = st.session_state.agents[st.session_state.current_agent_name]
+    try:
+        st.session_state.session_checkpointer.restore_agent(agent, records)
+    except Exception as e:
+        st.session_state.logger.error(f"Could not restore agent {st.session_state.current_agent_name} from checkpoint: {e}")
+
+
+def _checkpoint_agent(agent_name, agent):
+    checkpointer = st.session_state.get("session_checkpointer")
+    if checkpointer is None:
+        return
+
+    try:
+        num_records = checkpointer.checkpoint(_checkpoint_key(), agent_name, agent)
+        # in shared mode the session lock is held and the agents are synced, so our records follow the ones we've seen
+        st.session_state.checkpoint_offset = st.session_state.get("checkpoint_offset", 0) + num_records
+    except Exception as e:
+        st.session_state.logger.error(f"Could not checkpoint agent {agent_name}: {e}")
+
+
+def _uses_shared_session_state():
+    return st.session_state.get("shared_session_state") and st.session_state.get("session_checkpointer") is not None
+
+
+def _session_lock(timeout = 60):
+    """In shared session state mode, hold the session's lock across workers; otherwise a no-op."""
+    if not _uses_shared_session_state():
+        return contextlib.nullcontext()
+    return st.session_state.session_checkpointer.lock(_checkpoint_key(), timeout = timeout)
+
+
+def _sync_session():
+    """In shared session state mode, apply the changes other workers have checkpointed for this session's agents."""
+    if not _uses_shared_session_state():
+        return
+
+    def skip_record(record, error):
+        st.session_state.logger.error(f"Could not apply checkpoint record of agent {record['agent']}: {error}")
+
+    checkpointer = st.session_state.session_checkpointer
+    try:
+        # records are consumed once each, so a record that fails to apply is skipped rather than retried, which
+        # would apply the records before it again
+        st.session_state.checkpoint_offset = checkpointer.sync(_checkpoint_key(), st.session_state.agents,
+                                                               st.session_state.get("checkpoint_offset", 0),
+                                                               on_error = skip_record)
+    except Exception as e:
+        st.session_state.logger.error(f"Could not sync session state: {e}")
+
+
 def set_custom_pages(pages_dict):
     st.session_state.custom_pages = pages_dict
 
@@ -99,22 +280,28 @@ def serve_app():  # Remove authenticator parameter
 
     _apply_visual_styling()
     assert "agents" in st.session_state, "No agents have been set. Use set_app_agents() to set agents prior to serve_app()"
-    loop = st.session_state.get("event_loop")
 
-    loop.run_until_complete(_main())
+    _main()
 
 
 def _apply_visual_styling():
     """Apply visual styling with customization options"""
     try:
-        background_url = st.session_state.get(
+        background_image = st.session_state.get(
             "background_image",
             "https://www.nayuki.io/res/animated-floating-graph-nodes/floating-graph-nodes.png"
         )
 
         theme_color = st.session_state.get("theme_color", "rgba(40, 40, 60, 0.85)")
 
-        page_bg_img = f"""
+        st.markdown(_styling_css(_asset_url(background_image), theme_color), unsafe_allow_html=True)
+    except Exception as e:
+        st.session_state.logger.warning(f"Could not set background: {str(e)}")
+
+
+@functools.lru_cache(maxsize=8)
+def _styling_css(background_url, theme_color):
+    return f"""
         <style>
         [data-testid="stAppViewContainer"] > .main {{
             background-image: linear-gradient({theme_color}, {theme_color}),
@@ -226,9 +413,6 @@ def _apply_visual_styling():
 
         </style>
         """
-        st.markdown(page_bg_img, unsafe_allow_html=True)
-    except Exception as e:
-        st.session_state.logger.warning(f"Could not set background: {str(e)}")
 
 
 def _initialize_session_state(**kwargs):
@@ -238,7 +422,13 @@ def _initialize_session_state(**kwargs):
         st.session_state.logger.setLevel(logging.INFO)
         st.session_state.logger.addHandler(logging.StreamHandler())
 
-    st.session_state.setdefault("event_loop", asyncio.new_event_loop())
+    # runs agent coroutines for the session (see kani_utils.runtime): its own event loop by default, or with
+    # shared_event_loop (True for the process-wide default, or an AgentRuntime) the runtime's long-lived loops
+    if "agent_runtime" not in st.session_state:
+        shared_event_loop = kwargs.get("shared_event_loop", False)
+        if shared_event_loop is True:
+            shared_event_loop = get_default_runtime()
+        st.session_state.agent_runtime = shared_event_loop or SessionLoop()
     st.session_state.setdefault("default_api_key", None)
     st.session_state.setdefault("ui_disabled", False)
     st.session_state.setdefault("lock_widgets", False)
@@ -256,6 +446,23 @@ def _initialize_session_state(**kwargs):
     st.session_state.setdefault("show_function_calls", kwargs.get("show_function_calls", False))
     st.session_state.setdefault("show_function_calls_status", kwargs.get("show_function_calls_status", True))
 
+    # process-wide QueryLimiter (see kani_utils.rate_limit); if set it replaces the per-session query_limits bookkeeping
+    st.session_state.setdefault("query_limiter", kwargs.get("query_limiter", None))
+    # process-wide UsageLedger (see kani_utils.usage) that all agents of the session report completions to
+    st.session_state.setdefault("usage_ledger", kwargs.get("usage_ledger", None))
+    # client for the shared chats database (upstash_redis API); defaults to Redis.from_env() if the UPSTASH_* vars are set
+    st.session_state.setdefault("redis_client", kwargs.get("redis_client", None))
+    # render the chat history and input in a fragment, so that a turn reruns only the chat area (and refreshes the
+    # sidebar's cost panel) instead of the whole script; opt-in, since the chat input is then no longer pinned to the
+    # bottom of the window and the sidebar stays usable (and interrupts the turn when clicked) while a reply streams
+    st.session_state.setdefault("chat_fragment", kwargs.get("chat_fragment", False))
+    # FlushPolicy (see kani_utils.streaming) batching streamed tokens into fewer browser updates; None sends each token
+    st.session_state.setdefault("stream_flush", kwargs.get("stream_flush", FlushPolicy()))
+    # process-wide SessionCheckpointer (see kani_utils.checkpoint) persisting agents' chat state after each turn
+    st.session_state.setdefault("session_checkpointer", kwargs.get("session_checkpointer", None))
+    # with a checkpointer on a shared store, keep each session's state in the store so that any worker can serve it
+    st.session_state.setdefault("shared_session_state", kwargs.get("shared_session_state", False))
+
     st.session_state.setdefault("current_page", "intro")
 
     default_pages = {
@@ -264,6 +471,8 @@ def _initialize_session_state(**kwargs):
         "tutorial": ("Tutorial", _show_tutorial_page, None),
         "about": ("About Us", _show_about_page, None),
     }
+    if _shared_chats_configured():
+        default_pages["shared"] = ("Shared Chats", _show_shared_chats_page, None)
 
     custom_pages = kwargs.get("custom_pages", {})
     all_pages = {**default_pages, **custom_pages}
@@ -332,11 +541,24 @@ def _render_message(message):
     return current_action
 
 
-async def _process_input(prompt):
+def _process_input(prompt):
     prompt = prompt.strip()
 
     # Query limit check
-    if "query_limits" in st.session_state and \
+    limiter = st.session_state.get("query_limiter")
+    uses_limiter = limiter is not None and bool(st.session_state.get("user_token"))
+    if uses_limiter:
+        # answered from the limiter's in-process buckets; syncing with the store happens in the background
+        token = st.session_state.get("user_token")
+        if not limiter.try_acquire(token):
+            st.session_state["query_limits"] = 0
+            st.error("🚫 You have reached your query limit. Please upgrade your account or wait for the hourly reset.")
+            st.toast("⚠️ Query limit reached. Please wait for the hourly reset or upgrade.", icon="⏳")
+            st.session_state.lock_widgets = False
+            return
+        st.session_state["query_limits"] = limiter.remaining(token)
+
+    elif "query_limits" in st.session_state and \
        "last_query_reset" in st.session_state and \
        "user_token" in st.session_state and \
        "update_user_query_limits_func" in st.session_state:
@@ -381,6 +603,10 @@ async def _process_input(prompt):
 
     agent = st.session_state.agents[st.session_state.current_agent_name]
 
+    if st.session_state.get("usage_ledger") is not None:
+        agent.usage_ledger = st.session_state.usage_ledger
+    agent.usage_user = st.session_state.get("username")
+
     user_message = ChatMessage.user(prompt)
     _render_message(user_message)
     agent.display_messages.append(user_message)
@@ -398,29 +624,55 @@ async def _process_input(prompt):
         orig_status = "Thinking..."
         status = st.status(orig_status)
 
-    with st.chat_message("assistant", avatar = agent.avatar):
-        async for stream in agent.full_round_stream(prompt):
-            if stream.role == ChatRole.ASSISTANT:
-                st.write_stream(_sync_generator_from_kani_streammanager(stream))
+    def handle_message(message):
+        if message is not None and message.tool_calls is not None and st.session_state.show_function_calls_status:
+            if(len(message.tool_calls) > 0):
+                all_tool_calls = [f"`{tool_call.function.name}`" for tool_call in message.tool_calls]
+                distinct_tool_calls = set(all_tool_calls)
+                status.update(label = f"Checking sources: {', '.join(distinct_tool_calls)}")
 
-            message = await stream.message()
+        messages.append(message)
 
-            if message is not None and message.tool_calls is not None and st.session_state.show_function_calls_status:
-                if(len(message.tool_calls) > 0):
-                    all_tool_calls = [f"`{tool_call.function.name}`" for tool_call in message.tool_calls]
-                    distinct_tool_calls = set(all_tool_calls)
-                    status.update(label = f"Checking sources: {', '.join(distinct_tool_calls)}")
+        info = {"session_id": session_id, "message": message.model_dump(), "agent": st.session_state.current_agent_name}
+        st.session_state.logger.info(info)
 
-            messages.append(message)
+    if not st.session_state.chat_fragment:
+        # in the chat fragment the Stop button is drawn outside of it instead, see _main()
+        _render_stop_button()
 
-            info = {"session_id": session_id, "message": message.model_dump(), "agent": st.session_state.current_agent_name}
-            st.session_state.logger.info(info)
+    # updated while waiting on the agent, since Streamlit only stops a script run (e.g. when Stop is clicked) at its
+    # next call
+    heartbeat = st.empty()
+
+    with st.chat_message("assistant", avatar = agent.avatar):
+        try:
+            # the round runs on the session's runner, handing tokens and messages back to this thread
+            rounds = st.session_state.agent_runtime.stream_rounds(agent, prompt, heartbeat = heartbeat.empty)
+            with contextlib.closing(rounds):
+                for stream in rounds:
+                    if stream.role == ChatRole.ASSISTANT:
+                        st.write_stream(coalesce_stream(stream, st.session_state.stream_flush))
+                    handle_message(stream.message())
+        except ModelStreamError as e:
+            # the model stalled or failed past its retries (see StreamRetryPolicy); the partial reply is kept, followed
+            # by the error, and the chat stays usable
+            _end_cancelled_turn(agent)
+            st.session_state.logger.error({"session_id": session_id, "error": str(e), "agent": st.session_state.current_agent_name})
+            agent.display_messages.append(UIOnlyMessage(functools.partial(_render_stream_error, f"{e} Please try again."), icon = "⚠️"))
+            if not st.session_state.chat_fragment:
+                st.rerun()
+            return None
+        except BaseException:
+            # the run was stopped or the round failed; closing the rounds has cancelled the round and its tool calls
+            _end_cancelled_turn(agent)
+            raise
 
     agent.display_messages.append(messages[-1])
     agent.render_delayed_messages()
 
-    # Decrement query limit after successful processing
-    if "query_limits" in st.session_state and \
+    # Decrement query limit after successful processing (a QueryLimiter has already charged the query up front)
+    if not uses_limiter and \
+       "query_limits" in st.session_state and \
        "user_token" in st.session_state and \
        "update_user_query_limits_func" in st.session_state:
         st.session_state["query_limits"] -= 1
@@ -439,25 +691,45 @@ async def _process_input(prompt):
             st.warning("User token not found, cannot sync query limit update.")
         elif not update_func:
             st.warning("Update function not found, cannot sync query limit update.")
-    elif "query_limits" in st.session_state : # if other conditions for update not met, still decrement locally
+    elif not uses_limiter and "query_limits" in st.session_state : # if other conditions for update not met, still decrement locally
         st.session_state["query_limits"] -=1
 
 
-    def render_messages():
-        with st.expander("Full context"):
-            all_json = [message.model_dump() for message in messages]
-            st.write(all_json)
-
-    render_context = UIOnlyMessage(render_messages, role=ChatRole.SYSTEM, icon="🛠️", type="tool_use")
+    render_context = UIOnlyMessage(_FullContext(messages).render, role=ChatRole.SYSTEM, icon="🛠️", type="tool_use")
     agent.display_messages.append(render_context)
 
+    _checkpoint_agent(st.session_state.current_agent_name, agent)
+
     st.session_state.lock_widgets = False
-    st.rerun()
+    if not st.session_state.chat_fragment:
+        st.rerun()
+
+    return messages
+
 
+def _handle_chat_input(given_prompt = None):
+    # in the chat fragment, the streamed turn is swapped for its final messages in place, rather than rerunning to
+    # redraw the whole history; both are drawn above the chat input, which a fragment can't pin to the page bottom
+    streamed_turn, final_turn = st.empty(), st.empty()
 
-async def _handle_chat_input(given_prompt = None):
     if prompt := st.chat_input(disabled=False, on_submit=_lock_ui):
-        await _process_input(prompt)
+        # in shared session state mode, the turn runs on the latest state and holds the session until checkpointed
+        with _session_lock():
+            _sync_session()
+            agent = st.session_state.agents[st.session_state.current_agent_name]
+            first_turn_message = len(agent.display_messages)
+            with streamed_turn.container():
+                messages = _process_input(prompt)
+
+        if messages and any(message.tool_calls for message in messages):
+            # tools may have changed what the agent's sidebar shows (e.g. its memory), so redraw the whole page
+            st.rerun()
+
+        if len(agent.display_messages) > first_turn_message:
+            streamed_turn.empty()
+            with final_turn.container():
+                for message in agent.display_messages[first_turn_message:]:
+                    _render_message(message)
         return
 
 
@@ -465,13 +737,50 @@ def _lock_ui():
     st.session_state.lock_widgets = True
 
 
+def _render_stream_error(message):
+    st.error(message)
+
+
+def _end_cancelled_turn(agent):
+    """Bring the agent back to a consistent state after its turn was interrupted, keeping the partial reply for display."""
+    st.session_state.lock_widgets = False
+    if not hasattr(agent, "end_cancelled_round"):
+        return
+
+    try:
+        partial_reply = st.session_state.agent_runtime.run(agent.end_cancelled_round(), agent)
+        if partial_reply is not None:
+            agent.display_messages.append(partial_reply)
+        _checkpoint_agent(st.session_state.current_agent_name, agent)
+    except Exception as e:
+        st.session_state.logger.error(f"Could not end the cancelled turn: {e}")
+
+
+def _stop_turn():
+    # by the time this callback runs, the click has stopped the script run and with it the turn (see _process_input)
+    st.session_state.lock_widgets = False
+
+
+def _render_stop_button():
+    st.button("⏹️ Stop", key = "stop_turn", on_click = _stop_turn,
+              help = "Stop the current reply, including any tools it is running.")
+
+
 def _clear_chat_current_agent():
-    current_agent = st.session_state.agents[st.session_state.current_agent_name]
-    current_agent.display_messages = []
-    current_agent.delayed_display_messages = []
-    current_agent.tokens_used_prompt = 0
-    current_agent.tokens_used_completion = 0
-    current_agent.chat_history = []
+    with _session_lock():
+        _sync_session()
+
+        current_agent = st.session_state.agents[st.session_state.current_agent_name]
+        current_agent.display_messages = []
+        current_agent.delayed_display_messages = []
+        # running jobs finish, but are forgotten with the conversation
+        current_agent.jobs = {}
+        current_agent.tokens_used_prompt = 0
+        current_agent.tokens_used_prompt_cached = 0
+        current_agent.tokens_used_completion = 0
+        current_agent.chat_history = []
+        current_agent.reset_prompt_prefix()
+        _checkpoint_agent(st.session_state.current_agent_name, current_agent)
 
 
 def _render_sidebar():  # Remove authenticator parameter
@@ -489,27 +798,8 @@ def _render_sidebar():  # Remove authenticator parameter
             logo_path = st.session_state.get("logo_path")
             app_title = st.session_state.get("app_title", "AI Assistant")
 
-            if logo_path:
-                logo_base64 = get_img_as_base64(logo_path)
-                if logo_base64:
-                    st.markdown(f"""
-                        <div style="display: flex; flex-direction: column; align-items: center; gap: 10px;">
-                            <img src="data:image/png;base64,{logo_base64}" alt="Logo" style="height: 150px;">
-                            <h1 style="margin: 0; font-size: 44px;">{app_title}</h1>
-                        </div>
-                    """, unsafe_allow_html=True)
-                else:
-                    st.markdown(f"""
-                        <div style="display: flex; flex-direction: column; align-items: center; gap: 10px;">
-                            <h1 style="margin: 0; font-size: 44px;">{app_title}</h1>
-                        </div>
-                    """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                    <div style="display: flex; flex-direction: column; align-items: center; gap: 10px;">
-                        <h1 style="margin: 0; font-size: 44px;">{app_title}</h1>
-                    </div>
-                """, unsafe_allow_html=True)
+            logo_base64 = get_img_as_base64(logo_path) if logo_path else None
+            st.markdown(_sidebar_header_html(logo_base64, app_title), unsafe_allow_html=True)
 
         st.markdown("---")
         st.markdown(f"👤 Welcome **{st.session_state.get('username', 'N/A')}**")
@@ -562,6 +852,9 @@ def _render_sidebar():  # Remove authenticator parameter
             if hasattr(current_agent, "render_sidebar"):
                current_agent.render_sidebar()
 
+            # filled in by the chat area, which refreshes it after each turn
+            cost_panel = st.empty()
+
             st.markdown("---")
             st.markdown("### Chat Controls")
 
@@ -577,11 +870,11 @@ def _render_sidebar():  # Remove authenticator parameter
 
             dbsize = None
 
-            # if UPSTASH_REDIS_REST_URL and UPSTASH_REDIS_REST_TOKEN are both set, we can connect to the Redis databaseAdd commentMore actions
+            # if a redis_client is configured, or UPSTASH_REDIS_REST_URL and UPSTASH_REDIS_REST_TOKEN are both set, we can connect to the Redis database
             # otherwise, we assume no database is configured
-            if "UPSTASH_REDIS_REST_URL" in os.environ and "UPSTASH_REDIS_REST_TOKEN" in os.environ:
+            if _shared_chats_configured():
                 try:
-                    redis = Redis.from_env()
+                    redis = _get_redis()
                     dbsize = redis.dbsize()
                     st.session_state.logger.info(f"Shared chats DB size: {dbsize}")
 
@@ -605,39 +898,159 @@ def _render_sidebar():  # Remove authenticator parameter
                     help="Display the detailed function calls and responses made by the assistant."
                 )
 
+            return cost_panel
+
+
+def _render_cost_panel(cost_panel, agent):
+    if cost_panel is not None and hasattr(agent, "render_cost_panel"):
+        with cost_panel.container():
+            agent.render_cost_panel()
+
+
+@st.fragment
+def _chat_fragment(cost_panel):
+    """
+    The chat history and input. Submitting a prompt reruns only this fragment, not the page styling or the sidebar;
+    the agent's cost panel in the sidebar (a placeholder, since fragments can't redraw the sidebar) is refreshed here.
+    """
+    current_agent = st.session_state.agents[st.session_state.current_agent_name]
+
+    for message in current_agent.display_messages:
+        _render_message(message)
+
+    _handle_chat_input()
+    _render_cost_panel(cost_panel, current_agent)
+
+
+@functools.lru_cache(maxsize=8)
+def _sidebar_header_html(logo_base64, app_title):
+    # logo_base64 is the cached string object for the logo, so hashing it for the lookup is cheap after the first call
+    if logo_base64:
+        return f"""
+            <div style="display: flex; flex-direction: column; align-items: center; gap: 10px;">
+                <img src="data:image/png;base64,{logo_base64}" alt="Logo" style="height: 150px;">
+                <h1 style="margin: 0; font-size: 44px;">{app_title}</h1>
+            </div>
+        """
+
+    return f"""
+        <div style="display: flex; flex-direction: column; align-items: center; gap: 10px;">
+            <h1 style="margin: 0; font-size: 44px;">{app_title}</h1>
+        </div>
+    """
+
+
+# shared chats are stored content-addressed: each page of display messages, the agent's greeting/system
+# prompt/avatar and each session state value is dill-encoded and stored once under blob:<sha256>, and a share record
+# (the header: summary, agent, cost) only holds a manifest of blob hashes, so re-sharing a conversation after a few
+# more messages only writes the new content
+_SHARE_BLOB_PREFIX = "blob:"
+_SHARE_PAGE_SIZE = 20
+
+# session state that belongs to the sharing session or the deployment, not to the chat; the agents (whose
+# chat_history duplicates the shared messages) are left out as well, the viewer renders with its own
+_UNSHARED_STATE_KEYS = {"agents", "agent_runtime", "session_token", "restore_checkpoints", "pending_restores",
+                        "checkpoint_offset", "query_limiter", "usage_ledger", "redis_client", "session_checkpointer",
+                        "stream_flush", "shared_chats_page", "shared_chats_query", "shared_chats_agent", "shared_chats_order",
+                        # the sharer's identity, credentials and quota, and the viewer's own navigation, which must
+                        # never be stored in a share or applied to a viewer's session
+                        "user_token", "logged_in", "username", "query_limits", "last_query_reset",
+                        "update_user_query_limits_func", "current_page", "lock_widgets", "shared_chat_viewed",
+                        "shared_chat_access_count", "shared_chat_pages_shown"}
+
+
+def _encode_blob(value):
+    import dill
+
+    data = base64.b64encode(dill.dumps(value)).decode('utf-8')
+    return hashlib.sha256(data.encode()).hexdigest(), data
+
+
+def _put_blobs(redis, blobs, ttl_seconds):
+    """Store {hash: data} blobs that aren't stored yet, and refresh the expiration of the others, in two round trips."""
+    hashes = list(blobs)
+    if not hashes:
+        return
+
+    pipe = redis.pipeline()
+    for blob_hash in hashes:
+        pipe.exists(_SHARE_BLOB_PREFIX + blob_hash)
+    exists = pipe.exec()
+
+    pipe = redis.pipeline()
+    for blob_hash, blob_exists in zip(hashes, exists):
+        if blob_exists:
+            pipe.expire(_SHARE_BLOB_PREFIX + blob_hash, ttl_seconds)
+        else:
+            pipe.set(_SHARE_BLOB_PREFIX + blob_hash, blobs[blob_hash], ex=ttl_seconds)
+    pipe.exec()
+
+
+def _get_blobs(redis, hashes):
+    """Fetch and decode blobs by hash in a single round trip, returning {hash: value}."""
+    import dill
+
+    hashes = list(dict.fromkeys(hashes))
+    if not hashes:
+        return {}
+
+    values = {}
+    for blob_hash, data in zip(hashes, redis.mget(*[_SHARE_BLOB_PREFIX + h for h in hashes])):
+        if data is None:
+            raise ValueError(f"Shared chat content {blob_hash} not found in database")
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        values[blob_hash] = dill.loads(base64.b64decode(data.encode('utf-8')))
+    return values
+
 
 def _share_chat():
     try:
         current_agent = st.session_state.agents[st.session_state.current_agent_name]
 
-        session_state_bytes_rep = dill.dumps(st.session_state)
-        session_state_str_rep = base64.b64encode(session_state_bytes_rep).decode('utf-8')
-
-        chat_data_dict = {"display_messages": current_agent.display_messages,
-                   "agent_greeting": current_agent.greeting,
-                   "agent_system_prompt": current_agent.system_prompt,
-                   "agent_avatar": current_agent.avatar,
-                   "session_state": session_state_str_rep,
-                   }
-
-        chat_data_bytes_rep = dill.dumps(chat_data_dict)
-        chat_data_str_rep = base64.b64encode(chat_data_bytes_rep).decode('utf-8')
+        blobs = {}
+
+        def add_blob(value):
+            blob_hash, data = _encode_blob(value)
+            blobs[blob_hash] = data
+            return blob_hash
+
+        session_state_hashes = {}
+        for state_key in list(st.session_state.keys()):
+            if state_key in _UNSHARED_STATE_KEYS:
+                continue
+            try:
+                session_state_hashes[state_key] = add_blob(st.session_state[state_key])
+            except Exception as e:
+                st.session_state.logger.warning(f"Not sharing session state value {state_key}: {e}")
+
+        # messages are stored in pages of _SHARE_PAGE_SIZE, so that viewers can fetch them progressively; pages
+        # are aligned from the start of the chat, so only the last page changes as a conversation grows
+        display_messages = current_agent.display_messages
+        pages = [add_blob(display_messages[i:i + _SHARE_PAGE_SIZE]) for i in range(0, len(display_messages), _SHARE_PAGE_SIZE)]
+
+        manifest = {"pages": pages,
+                    "message_count": len(display_messages),
+                    "agent": add_blob({"agent_greeting": current_agent.greeting,
+                                       "agent_system_prompt": current_agent.system_prompt,
+                                       "agent_avatar": current_agent.avatar}),
+                    "session_state": session_state_hashes,
+                    }
 
         async def summarize():
             agent_based_summary_prompt = "I am preparing to share this chat with others. Please summarize it in a few sentences."
             agent_based_summary = await current_agent.chat_round_str(agent_based_summary_prompt)
             return agent_based_summary
 
-        agent_based_summary = asyncio.run(summarize())
+        agent_based_summary = st.session_state.agent_runtime.run(summarize(), current_agent)
 
-        redis = Redis.from_env()
+        redis = _get_redis()
+        new_ttl_seconds = st.session_state.share_chat_ttl_seconds
 
-        key = st.session_state.page_title + "@" + current_agent.name + "@" + hashlib.md5(chat_data_str_rep.encode()).hexdigest()
-        keycheck = redis.get(key)
+        _put_blobs(redis, blobs, new_ttl_seconds)
 
-        access_count = 0
-        if keycheck is not None:
-            access_count = keycheck["access_count"] + 1
+        manifest_hash = hashlib.md5(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+        key = st.session_state.page_title + "@" + current_agent.name + "@" + manifest_hash
 
         agent_model = current_agent.engine.model if current_agent.engine.model else "Unknown"
         convo_cost = current_agent.get_convo_cost()
@@ -648,13 +1061,24 @@ def _share_chat():
                      "agent_chat_cost": convo_cost,
                      "agent_model": agent_model,
                      "agent_description": current_agent.description,
-                     "access_count": access_count,
-                     "chat_data": chat_data_str_rep,
+                     "manifest": manifest,
                      "chat_date": current_date_str,
                      }
 
-        new_ttl_seconds = st.session_state.share_chat_ttl_seconds
-        redis.set(key, save_dict, ex=new_ttl_seconds)
+        # the same conversation shared again keeps its record and access count; just reset the timer
+        created = bool(redis.set(key, save_dict, ex=new_ttl_seconds, nx=True))
+        if not created:
+            pipe = redis.pipeline()
+            pipe.expire(key, new_ttl_seconds)
+            pipe.expire(_access_count_key(key), new_ttl_seconds)
+            pipe.exec()
+
+        try:
+            # a kept record keeps its summary, and so its search terms
+            _share_index(redis).add(key, save_dict, replace=created)
+        except Exception as e:
+            # the chat is still reachable by its link
+            st.session_state.logger.error(f"Could not index shared chat {key}: {e}")
 
         url = urllib.parse.quote(key)
         ttl_human = _seconds_to_days_hours(new_ttl_seconds)
@@ -666,47 +1090,184 @@ def _share_chat():
         share_dialog()
 
     except Exception as e:
+        st.session_state.logger.error(f"Error saving chat: {e}")
         st.write(f"Error saving chat.")
 
 
+# share records and blobs are immutable once written (their keys are content hashes), so share headers (by share key)
+# and message pages (by hash) are kept in a small process-wide LRU; views then only increment the record's access
+# counter and refresh its expiration. The LRU holds them decoded, and is shared by all viewers: only what a viewing
+# session may change is copied, i.e. the session state values it restores and the message lists it is given
+_SHARED_CHAT_CACHE_SIZE = 64
+_shared_chat_cache = collections.OrderedDict()
+_shared_chat_cache_lock = threading.Lock()
+
+
+def _access_count_key(share_key):
+    return share_key + ":access_count"
+
+
+def _share_index(redis):
+    """The index of the app's shared chats (see kani_utils.share_index), kept in the shared chats database."""
+    return ShareIndex(redis, st.session_state.page_title)
+
+
+def _cache_get(cache_key):
+    with _shared_chat_cache_lock:
+        if cache_key not in _shared_chat_cache:
+            return None
+        _shared_chat_cache.move_to_end(cache_key)
+        return _shared_chat_cache[cache_key]
+
+
+def _cache_put(cache_key, value):
+    with _shared_chat_cache_lock:
+        _shared_chat_cache[cache_key] = value
+        while len(_shared_chat_cache) > _SHARED_CHAT_CACHE_SIZE:
+            _shared_chat_cache.popitem(last=False)
+
+
+def _load_shared_chat(redis, share_key):
+    """
+    Fetch and decode a share record's header: the record itself plus the agent's greeting/system prompt/avatar and
+    the shared session state. The first page of messages is fetched in the same round trip. Cached by share key.
+    """
+    import dill
+
+    cached = _cache_get(share_key)
+    if cached is not None:
+        return cached
+
+    session_dict_raw = redis.get(share_key)
+
+    # Ensure session_dict_raw is treated as bytes if it's not None, then decode
+    if session_dict_raw is None:
+        raise ValueError(f"Session Key {share_key} not found in database")
+    if isinstance(session_dict_raw, bytes):
+        session_dict_raw = session_dict_raw.decode('utf-8')
+    session_dict = json.loads(session_dict_raw) # Parse JSON string to dict
+
+    if "manifest" in session_dict:
+        manifest = session_dict["manifest"]
+        session_state_hashes = manifest["session_state"]
+        values = _get_blobs(redis, [manifest["agent"]] + list(session_state_hashes.values()) + manifest["pages"][:1])
+
+        chat_data = {**values[manifest["agent"]],
+                     "session_state": {state_key: values[h] for state_key, h in session_state_hashes.items()},
+                     }
+        for page_hash in manifest["pages"][:1]:
+            _cache_put(page_hash, values[page_hash])
+    else:
+        # records shared before the manifest format hold the whole chat, as a single page
+        chat_data_bytes_rep = base64.b64decode(session_dict["chat_data"].encode('utf-8'))
+        chat_data = dill.loads(chat_data_bytes_rep)
+        chat_data["session_state"] = dill.loads(base64.b64decode(chat_data["session_state"].encode('utf-8')))
+
+    loaded = (session_dict, chat_data)
+    _cache_put(share_key, loaded)
+    return loaded
+
+
+def _shared_chat_page_count(session_dict):
+    return len(session_dict["manifest"]["pages"]) if "manifest" in session_dict else 1
+
+
+def _load_shared_chat_page(redis, session_dict, chat_data, page):
+    """Fetch and decode a page of a shared chat's messages. Cached by the page's content hash; returns a new list."""
+    if "manifest" not in session_dict:
+        return list(chat_data["display_messages"])
+
+    page_hash = session_dict["manifest"]["pages"][page]
+    messages = _cache_get(page_hash)
+    if messages is None:
+        messages = _get_blobs(redis, [page_hash])[page_hash]
+        _cache_put(page_hash, messages)
+    return list(messages)
+
+
+def _shared_chat_blob_hashes(session_dict):
+    if "manifest" not in session_dict:
+        return []
+    manifest = session_dict["manifest"]
+    return list(dict.fromkeys(manifest["pages"] + [manifest["agent"]] + list(manifest["session_state"].values())))
+
+
+def _record_shared_chat_view(redis, share_key, blob_hashes, ttl_seconds, agent_name = None):
+    """
+    Count a view (also in the share index's popularity ranking, given the agent's name) and reset the expiration of
+    the record, its access counter and its blobs, in a single round trip. Returns the new access count, or None if
+    the record has expired.
+    """
+    index = _share_index(redis)
+
+    pipe = redis.pipeline()
+    pipe.incr(_access_count_key(share_key))
+    pipe.expire(_access_count_key(share_key), ttl_seconds)
+    pipe.expire(share_key, ttl_seconds)
+    # blobs may be shared by several records, keep them alive as long as this one
+    for blob_hash in blob_hashes:
+        pipe.expire(_SHARE_BLOB_PREFIX + blob_hash, ttl_seconds)
+    if agent_name is not None:
+        index.queue_view(pipe, share_key, agent_name)
+    results = pipe.exec()
+
+    if not results[2]:
+        with _shared_chat_cache_lock:
+            _shared_chat_cache.pop(share_key, None)
+        redis.delete(_access_count_key(share_key))
+        index.remove([share_key])
+        return None
+    return results[0]
+
+
+def _show_more_shared_chat_pages():
+    st.session_state.shared_chat_pages_shown += 1
+
+
 def _render_shared_chat():
     _apply_visual_styling()
     session_id = st.query_params["session_id"]
 
     try:
-        redis = Redis.from_env()
-        session_dict_raw = redis.get(session_id)
-
-        # Ensure session_dict_raw is treated as bytes if it's not None, then decode
-        if session_dict_raw is not None:
-            if isinstance(session_dict_raw, bytes):
-                session_dict_raw = session_dict_raw.decode('utf-8')
-            session_dict = json.loads(session_dict_raw) # Parse JSON string to dict
-        else:
-            session_dict = None # Explicitly set to None if key not found
-
-        if session_dict is None:
-            raise ValueError(f"Session Key {session_id} not found in database")
+        redis = _get_redis()
+        new_ttl_seconds = st.session_state.share_chat_ttl_seconds
 
-        chat_data_str_rep = session_dict["chat_data"]
-        chat_data_bytes_rep = base64.b64decode(chat_data_str_rep.encode('utf-8'))
-        chat_data = dill.loads(chat_data_bytes_rep)
+        session_dict, chat_data = _load_shared_chat(redis, session_id)
+
+        # a view is counted, and the shared session state restored, once per viewing session rather than on every
+        # rerun (e.g. when loading more messages)
+        if st.session_state.get("shared_chat_viewed") != session_id:
+            views = _record_shared_chat_view(redis, session_id, _shared_chat_blob_hashes(session_dict), new_ttl_seconds,
+                                             agent_name = session_dict.get("agent_name"))
+            if views is None:
+                raise ValueError(f"Session Key {session_id} not found in database")
+
+            shared_session_state = chat_data["session_state"]
+            if not isinstance(shared_session_state, dict):
+                # records shared before the manifest format hold the whole pickled session state
+                shared_session_state = dict(shared_session_state.items())
+            for state_key, value in shared_session_state.items():
+                # chats shared before these keys were excluded may still carry the sharer's credentials
+                if state_key in _UNSHARED_STATE_KEYS:
+                    continue
+                try:
+                    # a copy, as the decoded values are cached for other viewers
+                    st.session_state[state_key] = copy.deepcopy(value)
+                except Exception:
+                    # e.g. widget keys that can't be set programmatically
+                    pass
 
-        new_ttl_seconds = st.session_state.share_chat_ttl_seconds
-        access_count = session_dict["access_count"] + 1
-        session_dict["access_count"] = access_count
+            # records shared before the separate access counter keep their earlier count in the record
+            st.session_state.shared_chat_access_count = session_dict.get("access_count", 0) + views
+            st.session_state.shared_chat_pages_shown = 1
+            st.session_state.shared_chat_viewed = session_id
 
-        redis.set(session_id, session_dict, ex=new_ttl_seconds)
+        access_count = st.session_state.shared_chat_access_count
 
-        display_messages = chat_data["display_messages"]
         agent_system_prompt = chat_data["agent_system_prompt"]
         agent_greeting = chat_data["agent_greeting"]
         agent_avatar = chat_data["agent_avatar"]
 
-        st_session_state_str_rep = chat_data["session_state"]
-        st_session_state_bytes_rep = base64.b64decode(st_session_state_str_rep.encode('utf-8'))
-        st.session_state = dill.loads(st_session_state_bytes_rep)
-
         agent_name = session_dict["agent_name"]
         agent_description = session_dict["agent_description"]
         agent_chat_cost = session_dict["agent_chat_cost"]
@@ -718,7 +1279,8 @@ def _render_shared_chat():
             st.session_state.show_function_calls = False
             st.session_state.first_func_calls_off_flag = True
 
-        ttl_human = _seconds_to_days_hours(redis.ttl(session_id))
+        # the expiration was just reset
+        ttl_human = _seconds_to_days_hours(new_ttl_seconds)
 
         with st.expander("Details"):
             st.markdown(f"##### This chat record will expire in {ttl_human}. Revisiting this URL will reset the expiration timer.")
@@ -740,14 +1302,88 @@ def _render_shared_chat():
         with st.chat_message("assistant", avatar = agent_avatar):
             st.write(agent_greeting)
 
-        for message in display_messages:
-            _render_message(message)
+        page_count = _shared_chat_page_count(session_dict)
+        pages_shown = min(st.session_state.shared_chat_pages_shown, page_count)
+        for page in range(pages_shown):
+            for message in _load_shared_chat_page(redis, session_dict, chat_data, page):
+                _render_message(message)
+
+        if pages_shown < page_count:
+            st.button(f"Load more messages ({pages_shown} of {page_count} pages shown)",
+                      on_click=_show_more_shared_chat_pages)
 
     except Exception as e:
         st.session_state.logger.error(f"Error connecting to Redis: {e}")
         st.write(f"Error connecting to database.")
 
 
+_SHARED_CHATS_PAGE_SIZE = 10
+
+
+def _reset_shared_chats_page():
+    st.session_state.shared_chats_page = 0
+
+
+def _change_shared_chats_page(step):
+    st.session_state.shared_chats_page += step
+
+
+def _show_shared_chats_page():
+    """Recent and popular shared chats of the app, filtered by agent or searched by summary, from the share index."""
+    st.title("Shared Chats")
+    st.session_state.setdefault("shared_chats_page", 0)
+
+    agent_names = [agent.name for agent in st.session_state.get("agents", {}).values()]
+
+    col1, col2, col3 = st.columns([3, 2, 2])
+    with col1:
+        query = st.text_input("Search summaries", key="shared_chats_query", on_change=_reset_shared_chats_page)
+    with col2:
+        agent_filter = st.selectbox("Agent", ["All agents"] + agent_names, key="shared_chats_agent",
+                                    on_change=_reset_shared_chats_page)
+    with col3:
+        order = st.radio("Order", ["Most recent", "Most viewed"], key="shared_chats_order", horizontal=True,
+                         disabled=bool(query.strip()), on_change=_reset_shared_chats_page,
+                         help="Search results are shown most recent first.")
+
+    agent_name = None if agent_filter == "All agents" else agent_filter
+    page = st.session_state.shared_chats_page
+    offset = page * _SHARED_CHATS_PAGE_SIZE
+
+    try:
+        index = _share_index(_get_redis())
+        if query.strip():
+            chats, total = index.search(query, agent_name, offset, _SHARED_CHATS_PAGE_SIZE)
+        else:
+            chats, total = index.list("popular" if order == "Most viewed" else "date", agent_name, offset,
+                                      _SHARED_CHATS_PAGE_SIZE)
+    except Exception as e:
+        st.session_state.logger.error(f"Error listing shared chats: {e}")
+        st.write("Error connecting to database.")
+        return
+
+    if not chats:
+        st.markdown("*No shared chats found.*")
+
+    for share_key, record, access_count in chats:
+        with st.container(border=True):
+            url = urllib.parse.quote(share_key)
+            st.markdown(f"**[{record['agent_name']}](/?session_id={url})** · {record.get('chat_date', 'N/A')} · "
+                        f"{access_count} view{'' if access_count == 1 else 's'}")
+            st.markdown(str(record.get("summary")))
+
+    page_count = max(1, -(-total // _SHARED_CHATS_PAGE_SIZE))
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        st.button("← Previous", key="shared_chats_previous", disabled=page == 0,
+                  on_click=_change_shared_chats_page, args=(-1,), use_container_width=True)
+    with col2:
+        st.caption(f"Page {page + 1} of {page_count}")
+    with col3:
+        st.button("Next →", key="shared_chats_next", disabled=page + 1 >= page_count,
+                  on_click=_change_shared_chats_page, args=(1,), use_container_width=True)
+
+
 def _show_intro_page():
     st.markdown(
         """
@@ -842,7 +1478,7 @@ def _show_about_page():
     )
 
 
-async def _main():  # Remove authenticator parameter
+def _main():  # Remove authenticator parameter
     # Check for the new 'logged_in' state variable
     if 'logged_in' not in st.session_state or not st.session_state['logged_in']:
         st.error("Access denied. Please log in.")
@@ -853,7 +1489,21 @@ async def _main():  # Remove authenticator parameter
         return
 
     else:
-        _render_sidebar()  # Remove authenticator argument
+        if _uses_shared_session_state():
+            try:
+                with _session_lock(timeout = 1):
+                    _sync_session()
+            except TimeoutError:
+                # another worker is running a turn in this session; its changes are synced (under the lock) before
+                # this worker's next turn, or on a later rerun
+                pass
+        else:
+            _restore_current_agent()
+
+        if st.session_state.chat_fragment:
+            # turns run within the chat fragment, so a full run only starts during one if it was interrupted
+            st.session_state.lock_widgets = False
+        cost_panel = _render_sidebar()  # Remove authenticator argument
 
         current_page = st.session_state.current_page
 
@@ -876,10 +1526,17 @@ async def _main():  # Remove authenticator parameter
                         # Render the greeting text directly. Streamlit's chat_message handles the container.
                         st.markdown(current_agent.greeting, unsafe_allow_html=True)  # Keep unsafe_allow_html if greeting contains markdown/HTML
 
-                    for message in current_agent.display_messages:
-                        _render_message(message)
-
-                    await _handle_chat_input()
+                    if st.session_state.chat_fragment:
+                        _chat_fragment(cost_panel)
+                        # outside of the fragment, so that a click stops a turn running in it (clicks on widgets in a
+                        # fragment wait for its run to finish)
+                        _render_stop_button()
+                    else:
+                        _render_cost_panel(cost_panel, current_agent)
+                        for message in current_agent.display_messages:
+                            _render_message(message)
+
+                        _handle_chat_input()
                 else:
                     st.warning("The selected agent is not available. Please choose another agent.")
             else:
@@ -0,0 +1,509 @@
+import asyncio
+import contextlib
+import fnmatch
+import json
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from kani import ChatMessage, ChatRole, ToolCall
+from kani.engines.base import BaseEngine, Completion
+from kani_utils.streaming import get_stream_stats
+
+
+class FakeEngine(BaseEngine):
+    """
+    A deterministic stand-in for an LLM engine, for load tests.
+
+    Replies with a fixed text streamed at tokens_per_second after first_token_delay seconds. If tool_calls
+    (a list of (function_name, kwargs) tuples) is given, the first completion after each user message requests those
+    calls (skipping functions the agent doesn't define), and the completion after the results replies with the text.
+
+    The time of the first token of each round is recorded in first_token_times, keyed by the user message text.
+
+    To test recovery from provider stalls, a fraction stall_rate of streams stop sending after stall_after words
+    (without ending). Asked to continue a partial reply (which follows the prompt, as agents do when retrying a
+    stream), the engine streams the rest of its reply.
+    """
+    def __init__(self,
+                 reply = "This is a scripted reply from the fake engine, streamed one word at a time for load testing.",
+                 tokens_per_second = 50.0,
+                 first_token_delay = 0.2,
+                 tool_calls = None,
+                 model = "fake-model",
+                 max_context_size = 128000,
+                 stall_rate = 0.0,
+                 stall_after = 5,
+                 seed = 0):
+        self.reply = reply
+        self.tokens_per_second = tokens_per_second
+        self.first_token_delay = first_token_delay
+        self.tool_calls = tool_calls or []
+        self.model = model
+        self.max_context_size = max_context_size
+        self.stall_rate = stall_rate
+        self.stall_after = stall_after
+
+        self.first_token_times = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def prompt_len(self, messages, functions = None, **kwargs):
+        # rough estimate, 4 characters per token
+        return sum(len(m.text or "") for m in messages) // 4 + 10 * len(functions or [])
+
+    def _next_message(self, messages, functions):
+        last = messages[-1] if messages else None
+        available = {f.name for f in functions or []}
+        calls = [ToolCall.from_function(name, **kwargs) for name, kwargs in self.tool_calls if name in available]
+        if last is not None and last.role == ChatRole.USER and calls:
+            return ChatMessage.assistant(None, tool_calls = calls)
+        return ChatMessage.assistant(self.reply)
+
+    def _completion(self, messages, message):
+        return Completion(message,
+                          prompt_tokens = self.prompt_len(messages),
+                          completion_tokens = len((message.text or "").split()) + 10 * len(message.tool_calls or []))
+
+    async def predict(self, messages, functions = None, **hyperparams):
+        message = self._next_message(messages, functions)
+        await asyncio.sleep(self.first_token_delay + len((message.text or "").split()) / self.tokens_per_second)
+        return self._completion(messages, message)
+
+    async def stream(self, messages, functions = None, **hyperparams):
+        from kani_utils.base_kanis import _CONTINUE_PROMPT
+
+        message = self._next_message(messages, functions)
+        user_text = next((m.text for m in reversed(messages) if m.role == ChatRole.USER), None)
+
+        text = message.text or ""
+        # asked to continue a partial reply, which precedes the request; on other turns the message before the last
+        # may well be the full previous reply
+        if user_text == _CONTINUE_PROMPT and len(messages) >= 2 and messages[-2].role == ChatRole.ASSISTANT and \
+           messages[-2].text and text.startswith(messages[-2].text):
+            text = text[len(messages[-2].text):]
+            message = ChatMessage.assistant(text)
+        with self._lock:
+            stalls = self._random.random() < self.stall_rate
+
+        await asyncio.sleep(self.first_token_delay)
+        for i, word in enumerate(text.split(" ")):
+            if stalls and i == self.stall_after:
+                await asyncio.sleep(3600)
+            if i == 0:
+                with self._lock:
+                    self.first_token_times.setdefault(user_text, time.perf_counter())
+            else:
+                await asyncio.sleep(1.0 / self.tokens_per_second)
+            yield word if i == 0 else " " + word
+
+        yield self._completion(messages, message)
+
+
+class FakeRedis:
+    """
+    An in-process stand-in for the shared chats database, implementing the subset of the upstash_redis client
+    used by the server. Values that are not strings are stored JSON-encoded, as the upstash REST client does.
+    Safe to share between sessions.
+    """
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+    def _expire_stale(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    def get(self, key):
+        with self._lock:
+            self._expire_stale(key)
+            return self._data.get(key)
+
+    def mget(self, *keys):
+        if len(keys) == 1 and isinstance(keys[0], (list, tuple)):
+            keys = keys[0]
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex = None, nx = False):
+        with self._lock:
+            self._expire_stale(key)
+            if nx and key in self._data:
+                return None
+            self._data[key] = value if isinstance(value, str) else json.dumps(value)
+            if ex is not None:
+                self._expires[key] = time.time() + ex
+            else:
+                self._expires.pop(key, None)
+            return "OK"
+
+    def exists(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._expire_stale(key)
+            return sum(1 for key in keys if key in self._data)
+
+    def delete(self, *keys):
+        with self._lock:
+            count = 0
+            for key in keys:
+                self._expires.pop(key, None)
+                count += self._data.pop(key, None) is not None
+            return count
+
+    def incr(self, key):
+        with self._lock:
+            self._expire_stale(key)
+            value = int(self._data.get(key, 0)) + 1
+            self._data[key] = str(value)
+            return value
+
+    def expire(self, key, seconds):
+        with self._lock:
+            self._expire_stale(key)
+            if key not in self._data:
+                return 0
+            self._expires[key] = time.time() + seconds
+            return 1
+
+    def ttl(self, key):
+        with self._lock:
+            self._expire_stale(key)
+            if key not in self._data:
+                return -2
+            if key not in self._expires:
+                return -1
+            return int(self._expires[key] - time.time())
+
+    def dbsize(self):
+        with self._lock:
+            for key in list(self._data):
+                self._expire_stale(key)
+            return len(self._data)
+
+    # sorted sets are stored as {member: score} and sets as Python sets
+
+    def _collection(self, key, kind):
+        self._expire_stale(key)
+        return self._data.setdefault(key, kind())
+
+    def zadd(self, key, mapping, nx = False):
+        with self._lock:
+            zset = self._collection(key, dict)
+            added = 0
+            for member, score in mapping.items():
+                if member not in zset:
+                    added += 1
+                elif nx:
+                    continue
+                zset[member] = float(score)
+            return added
+
+    def zincrby(self, key, increment, member):
+        with self._lock:
+            zset = self._collection(key, dict)
+            zset[member] = zset.get(member, 0.0) + increment
+            return zset[member]
+
+    def zrevrange(self, key, start, stop, withscores = False):
+        with self._lock:
+            self._expire_stale(key)
+            items = sorted(self._data.get(key, {}).items(), key = lambda item: (item[1], item[0]), reverse = True)
+            items = items[start:stop + 1 if stop != -1 else None]
+            return items if withscores else [member for member, _ in items]
+
+    def zcard(self, key):
+        with self._lock:
+            self._expire_stale(key)
+            return len(self._data.get(key, {}))
+
+    def zscore(self, key, member):
+        with self._lock:
+            self._expire_stale(key)
+            return self._data.get(key, {}).get(member)
+
+    def _drop_if_empty(self, key):
+        # as in Redis, emptied collections are deleted
+        if not self._data.get(key, True):
+            self.delete(key)
+
+    def zrem(self, key, *members):
+        with self._lock:
+            self._expire_stale(key)
+            removed = sum(self._data.get(key, {}).pop(member, None) is not None for member in members)
+            self._drop_if_empty(key)
+            return removed
+
+    def sadd(self, key, *members):
+        with self._lock:
+            members_set = self._collection(key, set)
+            added = len(set(members) - members_set)
+            members_set.update(members)
+            return added
+
+    def srem(self, key, *members):
+        with self._lock:
+            self._expire_stale(key)
+            members_set = self._data.get(key, set())
+            removed = len(set(members) & members_set)
+            members_set.difference_update(members)
+            self._drop_if_empty(key)
+            return removed
+
+    def sinter(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._expire_stale(key)
+            sets = [self._data.get(key, set()) for key in keys]
+            return list(set.intersection(*sets)) if sets else []
+
+    def keys(self, pattern = "*"):
+        with self._lock:
+            return [key for key in list(self._data) if self.exists(key) and fnmatch.fnmatchcase(key, pattern)]
+
+    def pipeline(self):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    """Queues commands and runs them in order on execute(), like an upstash_redis pipeline."""
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._redis, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def exec(self):
+        with self._redis._lock:
+            results = [method(*args, **kwargs) for method, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+    execute = exec
+
+
+def _loadtest_app(agents_func, app_config):
+    # the body of this function is run as the app script by AppTest, so it must be self-contained
+    import kani_utils.kani_streamlit_server as ks
+
+    ks.initialize_app_config(**app_config)
+    ks.set_app_agents(agents_func)
+    ks.serve_app()
+
+
+@contextlib.contextmanager
+def _sticky_apptest_runtime():
+    # AppTest installs a mock Runtime singleton at the start of each run and removes it at the end, which breaks
+    # sessions running concurrently in other threads; keep answering with the last installed mock instead. Likewise,
+    # each run turns the global.appTest option on and restores it afterwards, so it is kept on for the whole test
+    from unittest import mock
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.testing.v1 import app_test
+
+    last = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            last["runtime"] = cls._instance
+        if "runtime" not in last:
+            raise RuntimeError("Runtime hasn't been created!")
+        return last["runtime"]
+
+    def exists(cls):
+        return cls._instance is not None or "runtime" in last
+
+    with app_test.patch_config_options({"global.appTest": True}), \
+         mock.patch.object(app_test, "patch_config_options", lambda options: contextlib.nullcontext()), \
+         mock.patch.object(Runtime, "instance", classmethod(instance)), \
+         mock.patch.object(Runtime, "exists", classmethod(exists)):
+        yield
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n = 100, method = "inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def default_agents_func(engine, **agent_kwargs):
+    """Return an agents factory serving a single StreamlitKani on the given engine, created with agent_kwargs."""
+    def get_agents():
+        from kani_utils.base_kanis import StreamlitKani
+        return {"Load Test Agent": StreamlitKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015, **agent_kwargs)}
+    return get_agents
+
+
+def run_load_test(agents_func = None,
+                  engine = None,
+                  user_counts = (1, 10, 100),
+                  turns_per_user = 3,
+                  prompt = "Hello, this is a load test.",
+                  app_config = None,
+                  timeout = 120,
+                  warmup = True):
+    """
+    Drive the chat server headlessly with Streamlit's AppTest, simulating concurrent users.
+
+    Each simulated user is its own AppTest session, which logs in, opens the chat page and submits turns_per_user
+    prompts through the chat input (so each turn runs _main and _process_input, including the rerun).
+    By default a single StreamlitKani on a FakeEngine is served and shared chats use a FakeRedis; pass agents_func
+    (and the engine it uses, to collect time-to-first-token) to test other agents.
+
+    Unless warmup is False, one unmeasured session is run first so imports and caches don't skew the results.
+
+    Returns one result dict per user count, with p50/p95/p99 turn latency and time-to-first-token (seconds),
+    memory retained per session (bytes, via tracemalloc), server CPU time per turn (seconds of process time, after all users
+    have logged in), streamed updates sent to the browser per turn and their bytes (see kani_utils.streaming), heartbeats
+    sent per turn while waiting on the agent, model streams retried and failed for good, and throughput (turns per second).
+
+    AppTest was written for one session at a time; its global mock Runtime is kept installed for the whole
+    test so that concurrent sessions can share it.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    engine = engine or FakeEngine()
+    agents_func = agents_func or default_agents_func(engine)
+    app_config = {"page_title": "Load Test", "redis_client": FakeRedis(), **(app_config or {})}
+
+    def simulate_user(user_index, logged_in = None):
+        at = AppTest.from_function(_loadtest_app, args = (agents_func, app_config), default_timeout = timeout)
+        at.session_state["logged_in"] = True
+        at.session_state["username"] = f"loadtest-user-{user_index}"
+        at.session_state["current_page"] = "chat"
+        at.run()
+
+        if logged_in is not None:
+            logged_in.wait()
+
+        turns = []
+        for turn in range(turns_per_user):
+            user_prompt = f"[user {user_index}, turn {turn}] {prompt}"
+            start = time.perf_counter()
+            at.chat_input[0].set_value(user_prompt).run()
+            end = time.perf_counter()
+
+            first_token = getattr(engine, "first_token_times", {}).get(user_prompt)
+            turns.append({"latency": end - start,
+                          "ttft": first_token - start if first_token is not None else None,
+                          "error": bool(at.exception)})
+        return at, turns
+
+    if warmup:
+        with _sticky_apptest_runtime():
+            simulate_user("warmup")
+
+    results = []
+    for user_count in user_counts:
+        # prompts repeat between runs (and calls), so that first token times from an earlier run must not be read
+        if hasattr(engine, "first_token_times"):
+            engine.first_token_times.clear()
+
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+
+        # CPU time is counted from when all users have logged in, so that it covers only their turns
+        cpu_start, stream_start = [], []
+
+        def all_logged_in():
+            cpu_start.append(time.process_time())
+            stream_start.append(get_stream_stats().snapshot())
+
+        logged_in = threading.Barrier(user_count, action = all_logged_in)
+
+        with _sticky_apptest_runtime(), ThreadPoolExecutor(max_workers = user_count) as pool:
+            sessions = list(pool.map(lambda user_index: simulate_user(user_index, logged_in), range(user_count)))
+
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start[0]
+        stream_end = get_stream_stats().snapshot()
+        memory_after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        turns = [turn for _, session_turns in sessions for turn in session_turns]
+        results.append({"users": user_count,
+                        "turns": len(turns),
+                        "errors": sum(turn["error"] for turn in turns),
+                        "latency": _percentiles([turn["latency"] for turn in turns]),
+                        "ttft": _percentiles([turn["ttft"] for turn in turns if turn["ttft"] is not None]),
+                        "memory_per_session": (memory_after - memory_before) / user_count,
+                        "cpu_per_turn": cpu / len(turns) if turns else None,
+                        "deltas_per_turn": (stream_end["deltas"] - stream_start[0]["deltas"]) / len(turns) if turns else None,
+                        "bytes_per_turn": (stream_end["bytes"] - stream_start[0]["bytes"]) / len(turns) if turns else None,
+                        "heartbeats_per_turn": (stream_end["heartbeats"] - stream_start[0]["heartbeats"]) / len(turns)
+                                               if turns else None,
+                        "stream_retries": stream_end["retries"] - stream_start[0]["retries"],
+                        "stream_failures": stream_end["failures"] - stream_start[0]["failures"],
+                        "throughput": len(turns) / elapsed})
+        # keep the sessions alive until memory is measured
+        del sessions
+
+    return results
+
+
+def run_rerun_benchmark(agents_func = None,
+                        history_turns = (0, 10, 50),
+                        reruns = 50,
+                        app_config = None,
+                        timeout = 120):
+    """
+    Measure the latency of a full script rerun triggered from the sidebar, as when the user toggles a sidebar control,
+    for sessions with growing chat histories.
+
+    For each history length, a single AppTest session logs in, submits history_turns prompts (unmeasured), then toggles
+    the sidebar's "show full message contexts" checkbox reruns times. Logo and background images can be given in
+    app_config (logo_path, background_image) to include the static asset path.
+
+    Returns one result dict per history length, with p50/p95/p99 rerun latency and server CPU time per rerun (seconds).
+    """
+    from streamlit.testing.v1 import AppTest
+
+    agents_func = agents_func or default_agents_func(FakeEngine(tokens_per_second = 10000, first_token_delay = 0))
+    app_config = {"page_title": "Rerun Benchmark", "redis_client": FakeRedis(), **(app_config or {})}
+
+    results = []
+    for turns in history_turns:
+        with _sticky_apptest_runtime():
+            at = AppTest.from_function(_loadtest_app, args = (agents_func, app_config), default_timeout = timeout)
+            at.session_state["logged_in"] = True
+            at.session_state["username"] = "rerun-benchmark"
+            at.session_state["current_page"] = "chat"
+            at.run()
+            for turn in range(turns):
+                at.chat_input[0].set_value(f"Prompt {turn}").run()
+
+            def toggle_sidebar_checkbox():
+                checkbox = at.checkbox(key = "show_function_calls")
+                checkbox.set_value(not checkbox.value).run()
+
+            # one unmeasured rerun, so that caches are warm
+            toggle_sidebar_checkbox()
+
+            latencies = []
+            cpu_start = time.process_time()
+            for _ in range(reruns):
+                start = time.perf_counter()
+                toggle_sidebar_checkbox()
+                latencies.append(time.perf_counter() - start)
+            cpu = time.process_time() - cpu_start
+
+        results.append({"history_turns": turns,
+                        "reruns": reruns,
+                        "errors": len(at.exception),
+                        "latency": _percentiles(latencies),
+                        "cpu_per_rerun": cpu / reruns if reruns else None})
+    return results
@@ -0,0 +1,105 @@
+import re
+import threading
+
+
+def _trigrams(text):
+    """
+    The trigrams of the words (runs of letters or digits, so that snake_case keys split) of a text, lowercased and
+    padded as in PostgreSQL's pg_trgm.
+    """
+    trigrams = set()
+    for word in set(re.findall(r"[^\W_]+", text.lower())):
+        padded = f"  {word} "
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def _value_text(value, max_chars):
+    if isinstance(value, str):
+        return value[:max_chars]
+    columns = getattr(value, "columns", None)
+    if columns is not None:
+        # tables are described by their columns rather than their (possibly large) contents
+        return "table " + " ".join(str(column) for column in columns)
+    return repr(value)[:max_chars]
+
+
+class _Entry:
+    def __init__(self, key, value, snippet_chars):
+        self.value = value
+        self.snippet = _value_text(value, snippet_chars)
+        self.key_trigrams = _trigrams(key)
+        self.trigrams = self.key_trigrams | _trigrams(self.snippet)
+
+
+class MemoryIndex:
+    """
+    Fuzzy search over the entries of an agent's memory dict, by their keys and the start of their values (the first
+    snippet_chars characters of text, the columns of tables).
+
+    An inverted index maps each trigram to the keys containing it. Like TableCatalog, sync() reconciles the index
+    with the memory dict by object identity, so only entries that are new or have changed are (re)indexed, however
+    they were stored.
+    """
+    def __init__(self, snippet_chars = 2000):
+        self.snippet_chars = snippet_chars
+        self._entries = {}  # key -> _Entry
+        self._postings = {}  # trigram -> set of keys
+        self._lock = threading.Lock()
+
+    def sync(self, memory):
+        """Bring the index up to date with the memory dict."""
+        with self._lock:
+            # a snapshot, since jobs may add memory keys meanwhile
+            memory = dict(memory)
+
+            for key in [key for key in self._entries if key not in memory]:
+                self._remove(key)
+
+            for key, value in memory.items():
+                entry = self._entries.get(key)
+                if entry is not None and entry.value is value:
+                    continue
+                if entry is not None:
+                    self._remove(key)
+                self._add(key, value)
+
+    def _add(self, key, value):
+        entry = _Entry(str(key), value, self.snippet_chars)
+        self._entries[key] = entry
+        for trigram in entry.trigrams:
+            self._postings.setdefault(trigram, set()).add(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for trigram in entry.trigrams:
+            keys = self._postings[trigram]
+            keys.discard(key)
+            if not keys:
+                del self._postings[trigram]
+
+    def search(self, query, k = 5, min_score = 0.4):
+        """
+        The k entries most similar to the query, as [(key, snippet, score)], best first. The score is the fraction of
+        the query's trigrams found in the entry, with those in its key counting double, scaled to 0-1.
+        """
+        query_trigrams = _trigrams(query)
+        if not query_trigrams:
+            return []
+
+        with self._lock:
+            matches = {}
+            for trigram in query_trigrams:
+                for key in self._postings.get(trigram, ()):
+                    matches[key] = matches.get(key, 0) + 1
+
+            results = []
+            for key, shared in matches.items():
+                entry = self._entries[key]
+                key_shared = len(query_trigrams & entry.key_trigrams)
+                score = (shared + key_shared) / (2 * len(query_trigrams))
+                if score >= min_score:
+                    results.append((key, entry.snippet, score))
+
+        results.sort(key = lambda result: result[2], reverse = True)
+        return results[:k]
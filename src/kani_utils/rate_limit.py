@@ -0,0 +1,177 @@
+import contextlib
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# token bucket update, run atomically server-side; returns the remaining tokens as a string
+# (redis truncates lua numbers to integers otherwise)
+_REDIS_CONSUME_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local amount = tonumber(ARGV[4])
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate) - amount
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(tokens)
+"""
+
+
+def _refill(tokens, ts, capacity, rate, now):
+    return min(capacity, tokens + max(0.0, now - ts) * rate)
+
+
+class SQLiteRateLimitStore:
+    """Token buckets kept in a SQLite file; each consume() runs in a single IMMEDIATE transaction."""
+    def __init__(self, path = "kani_rate_limits.db"):
+        self.path = path
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (user TEXT PRIMARY KEY, tokens REAL, ts REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+
+    def consume(self, user, amount, capacity, rate, now):
+        """Atomically refill and take amount tokens from the user's bucket. Returns the tokens left (may be negative)."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, ts FROM buckets WHERE user = ?", (user,)).fetchone()
+            tokens = capacity if row is None else _refill(row[0], row[1], capacity, rate, now)
+            tokens -= amount
+            conn.execute("INSERT OR REPLACE INTO buckets (user, tokens, ts) VALUES (?, ?, ?)", (user, tokens, now))
+            conn.execute("COMMIT")
+            return tokens
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+
+class RedisRateLimitStore:
+    """Token buckets kept in Redis hashes, updated by a Lua script so concurrent workers cannot race."""
+    def __init__(self, client = None, url = None, prefix = "ratelimit:"):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(_REDIS_CONSUME_SCRIPT)
+
+    def consume(self, user, amount, capacity, rate, now):
+        """Atomically refill and take amount tokens from the user's bucket. Returns the tokens left (may be negative)."""
+        result = self._script(keys = [self.prefix + user], args = [capacity, rate, now, amount])
+        return float(result.decode() if isinstance(result, bytes) else result)
+
+
+class QueryLimiter:
+    """
+    Process-wide token bucket limiter for user queries.
+
+    Checks are answered from in-process buckets under a lock, so concurrent tabs of the same user cannot race
+    and no network round trip is made on the request path. Consumed tokens are batched and pushed to the
+    (optional) atomic store by a background thread every sync_interval seconds, and the local buckets are then
+    reconciled with the store's totals, which keeps several workers in agreement.
+
+    on_sync, if given, is called from the background thread as on_sync(user, remaining, synced_at_iso) after each
+    user's bucket is synced, e.g. to mirror the count into an application user database.
+
+    The limiter is meant to be shared between sessions, e.g. created in an @st.cache_resource function and passed
+    to initialize_app_config(query_limiter = ...).
+    """
+    def __init__(self,
+                 capacity = 10,
+                 refill_seconds = 60 * 60,
+                 store = None,
+                 sync_interval = 2.0,
+                 on_sync = None):
+        self.capacity = capacity
+        self.rate = capacity / float(refill_seconds)
+        self.store = store
+        self.sync_interval = sync_interval
+        self.on_sync = on_sync
+
+        self._lock = threading.Lock()
+        self._buckets = {}  # user -> [tokens, ts]
+        self._pending = {}  # user -> tokens consumed locally but not yet synced
+        self._stop = threading.Event()
+        self._thread = None
+
+    def try_acquire(self, user, amount = 1):
+        """Take amount tokens from the user's bucket if available. Never blocks on I/O."""
+        now = time.time()
+        self._ensure_sync_thread()
+        with self._lock:
+            bucket = self._buckets.get(user)
+            if bucket is None:
+                bucket = self._buckets[user] = [float(self.capacity), now]
+            bucket[0] = _refill(bucket[0], bucket[1], self.capacity, self.rate, now)
+            bucket[1] = now
+
+            # users seen for the first time are synced even when rejected, to pick up their count from the store
+            self._pending.setdefault(user, 0)
+            if bucket[0] < amount:
+                return False
+            bucket[0] -= amount
+            self._pending[user] += amount
+
+        return True
+
+    def remaining(self, user):
+        """Whole tokens left for the user, as known locally."""
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(user)
+            if bucket is None:
+                return self.capacity
+            return max(0, int(_refill(bucket[0], bucket[1], self.capacity, self.rate, now)))
+
+    def flush(self):
+        """Push pending consumption to the store and reconcile local buckets. Called by the background thread."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for user, amount in pending.items():
+            now = time.time()
+            try:
+                if self.store is not None:
+                    remaining = self.store.consume(user, amount, self.capacity, self.rate, now)
+                    with self._lock:
+                        # anything consumed locally since the swap above has not reached the store yet
+                        self._buckets[user] = [remaining - self._pending.get(user, 0), now]
+                else:
+                    remaining = self.remaining(user)
+
+                if self.on_sync is not None:
+                    self.on_sync(user, max(0, int(remaining)), datetime.datetime.utcnow().isoformat())
+            except Exception as e:
+                logger.error(f"Failed to sync query limits for a user, will retry: {e}")
+                with self._lock:
+                    self._pending[user] = self._pending.get(user, 0) + amount
+
+    def close(self):
+        """Stop the background thread after a final flush."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _ensure_sync_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._sync_loop, name = "kani-query-limiter", daemon = True)
+                self._thread.start()
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.sync_interval):
+            self.flush()
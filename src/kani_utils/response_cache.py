@@ -0,0 +1,109 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from kani import ChatMessage
+from kani.engines.base import Completion
+
+
+class CachedCompletion(Completion):
+    """A completion replayed from a response cache, with the token counts of the original (saved) model call."""
+    def __init__(self, message, saved_prompt_tokens = 0, saved_completion_tokens = 0):
+        # nothing was sent to the model
+        super().__init__(message, prompt_tokens = 0, completion_tokens = 0)
+        self.saved_prompt_tokens = saved_prompt_tokens or 0
+        self.saved_completion_tokens = saved_completion_tokens or 0
+
+
+def _normalize_message(message):
+    # tool call ids are random per call, so they are left out; whitespace around content doesn't change the reply
+    return {"role": message.role.value,
+            "name": message.name,
+            "content": (message.text or "").strip(),
+            "tool_calls": [[tc.function.name, tc.function.arguments] for tc in message.tool_calls or []]}
+
+
+def response_cache_key(messages, functions = None, model = None, hyperparams = None):
+    """
+    Cache key for a model call: a hash of the model, the (normalized) messages including the system prompt, the tool
+    schemas and any hyperparameters passed to the engine.
+    """
+    tools_hash = hashlib.sha256(json.dumps([[f.name, f.desc, f.json_schema] for f in functions or []],
+                                           sort_keys = True, default = str).encode()).hexdigest()
+    payload = {"model": model,
+               "messages": [_normalize_message(m) for m in messages],
+               "tools": tools_hash,
+               "hyperparams": hyperparams or {}}
+    return hashlib.sha256(json.dumps(payload, sort_keys = True, default = str).encode()).hexdigest()
+
+
+class LRUResponseCache:
+    """In-process response cache holding up to max_entries responses for ttl_seconds each. Safe to share between sessions."""
+    def __init__(self, max_entries = 1024, ttl_seconds = 60 * 60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()  # key -> (expires, response)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, response):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+
+class RedisResponseCache:
+    """Response cache in Redis, shared by all workers using the database; entries expire after ttl_seconds."""
+    def __init__(self, client = None, url = None, prefix = "response_cache:", ttl_seconds = 60 * 60):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, response):
+        self.client.set(self.prefix + key, json.dumps(response), ex = self.ttl_seconds)
+
+
+def cacheable_response(completion):
+    """The cache entry for a completion, or None if it isn't cacheable (only plain text replies are)."""
+    message = completion.message
+    if message.tool_calls or not message.text:
+        return None
+    return {"text": message.text,
+            "prompt_tokens": completion.prompt_tokens,
+            "completion_tokens": completion.completion_tokens}
+
+
+def cached_completion(response):
+    return CachedCompletion(ChatMessage.assistant(response["text"]),
+                            saved_prompt_tokens = response["prompt_tokens"],
+                            saved_completion_tokens = response["completion_tokens"])
@@ -0,0 +1,246 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import itertools
+import queue
+import threading
+import time
+
+from kani_utils.streaming import get_stream_stats
+
+# while waiting on agent work, stream_rounds() checks for events this often (seconds), letting round streams yield
+# when idle
+_POLL_INTERVAL = 0.25
+
+# and calls its heartbeat at most this often (seconds); each call of a Streamlit heartbeat sends a message to the
+# browser, while a longer interval delays stopping the script by as much
+_HEARTBEAT_INTERVAL = 1.0
+
+_default_runtime = None
+_default_runtime_lock = threading.Lock()
+
+
+def get_default_runtime():
+    """The process-wide AgentRuntime used by initialize_app_config(shared_event_loop = True), created on first use."""
+    global _default_runtime
+    with _default_runtime_lock:
+        if _default_runtime is None:
+            _default_runtime = AgentRuntime()
+        return _default_runtime
+
+
+class _RoundStream:
+    """
+    Script-thread view of one kani StreamManager running on an event loop: iterating yields its tokens (e.g. for
+    st.write_stream), and an empty string whenever none arrived for a poll interval; message() blocks until the
+    round's message is complete.
+    """
+    def __init__(self, role, next_event):
+        self.role = role
+        self._next_event = next_event
+        self._message = None
+        self._done = False
+
+    def __iter__(self):
+        while not self._done:
+            event = self._next_event(idle = True)
+            if event is None:
+                # nothing arrived for a while; lets consumers that batch tokens send what they have
+                yield ""
+                continue
+            kind, value = event
+            if kind == "token":
+                yield value
+            elif kind == "message":
+                self._message = value
+                self._done = True
+            elif kind == "error":
+                self._done = True
+                raise value
+            else:
+                raise RuntimeError(f"Unexpected {kind} event in a round stream")
+
+    def message(self):
+        for _ in self:
+            pass
+        return self._message
+
+
+class _AgentRunner:
+    """
+    Common interface of SessionLoop and AgentRuntime, which run agent coroutines for the server's script thread.
+    stream_rounds() is built on the _events(), _start(), _get_event() and _cancel() of each.
+    """
+    def stream_rounds(self, agent, query, heartbeat = None, **kwargs):
+        """
+        Run agent.full_round_stream(query), yielding a stream for each round as it starts, to be consumed from the
+        calling (script) thread: iterate a stream for its tokens, and call its message() for the completed message.
+
+        While waiting on the agent (e.g. on its tools), heartbeat() is called once a second, and counted in the
+        process-wide StreamStats; with a Streamlit call as the heartbeat, the script can be stopped within a second. If
+        the consumer stops early, or heartbeat() raises, the round is cancelled, and stream_rounds() returns once it
+        has unwound.
+        """
+        events = self._events()
+
+        async def produce():
+            try:
+                # closed explicitly, so that a cancelled round releases the agent's lock
+                async with contextlib.aclosing(agent.full_round_stream(query, **kwargs)) as rounds:
+                    async for stream in rounds:
+                        events.put_nowait(("round", stream.role))
+                        async for token in stream:
+                            events.put_nowait(("token", token))
+                        events.put_nowait(("message", await stream.message()))
+            except Exception as e:
+                events.put_nowait(("error", e))
+            finally:
+                events.put_nowait(("end", None))
+
+        last_heartbeat = [time.monotonic()]
+
+        def next_event(idle = False):
+            # with idle, returns None if no event arrives within a poll interval
+            while True:
+                event = self._get_event(events, _POLL_INTERVAL)
+                if event is not None:
+                    return event
+                if heartbeat is not None and time.monotonic() - last_heartbeat[0] >= _HEARTBEAT_INTERVAL:
+                    last_heartbeat[0] = time.monotonic()
+                    get_stream_stats()._count(heartbeats = 1)
+                    heartbeat()
+                if idle:
+                    return None
+
+        handle = self._start(produce(), agent)
+        ended = False
+        try:
+            while True:
+                kind, value = next_event()
+                if kind == "end":
+                    ended = True
+                    break
+                if kind == "error":
+                    raise value
+                if kind == "round":
+                    stream = _RoundStream(value, next_event)
+                    yield stream
+                    # the consumer may not have read the round to its end
+                    stream.message()
+        finally:
+            if not ended:
+                self._cancel(handle)
+
+
+class SessionLoop(_AgentRunner):
+    """
+    Runs agent work on a session's own event loop, which is driven from the script thread while it waits on results.
+    This is the default; see AgentRuntime for a shared loop.
+    """
+    def __init__(self, loop = None):
+        self.loop = loop or asyncio.new_event_loop()
+
+    def run(self, coro, agent = None, timeout = None):
+        """Run a coroutine on the loop, blocking until it is done."""
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def _events(self):
+        return asyncio.Queue()
+
+    def _start(self, coro, agent):
+        return self.loop.create_task(coro)
+
+    def _get_event(self, events, timeout):
+        if not events.empty():
+            return events.get_nowait()
+        try:
+            return self.loop.run_until_complete(asyncio.wait_for(events.get(), timeout))
+        except asyncio.TimeoutError:
+            return None
+
+    def _cancel(self, task):
+        task.cancel()
+        self.loop.run_until_complete(asyncio.wait({task}))
+
+    def close(self):
+        self.loop.close()
+
+
+class AgentRuntime(_AgentRunner):
+    """
+    Long-lived event loops, each on its own daemon thread, that run agent coroutines for all sessions of the process.
+
+    Sessions hand work to the runtime instead of owning an event loop each. Work for an agent always runs on the same
+    loop, chosen by the agent's engine, so that agents sharing an engine (and its HTTP client) share a loop. loops
+    defaults to 1; more loops spread CPU-bound agent work (e.g. prompt building, parsing) over more threads.
+    """
+    def __init__(self, loops = 1):
+        self._loops = []
+        for index in range(loops):
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target = self._run_loop, args = (loop,), name = f"kani-agent-loop-{index}", daemon = True)
+            thread.start()
+            self._loops.append((loop, thread))
+
+        self._next_loop = itertools.count()
+        self._affinity = {}  # id(engine) -> loop index
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def loop_for(self, agent = None):
+        """The loop that runs work for the agent (or the first loop, for work not tied to an agent)."""
+        if agent is None or len(self._loops) == 1:
+            return self._loops[0][0]
+
+        key = id(getattr(agent, "engine", agent))
+        with self._lock:
+            if key not in self._affinity:
+                self._affinity[key] = next(self._next_loop) % len(self._loops)
+            return self._loops[self._affinity[key]][0]
+
+    def submit(self, coro, agent = None):
+        """Schedule a coroutine on the agent's loop, returning a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop_for(agent))
+
+    def run(self, coro, agent = None, timeout = None):
+        """Run a coroutine on the agent's loop, blocking the calling thread until it is done."""
+        return self.submit(coro, agent).result(timeout)
+
+    def _events(self):
+        return queue.Queue()
+
+    def _start(self, coro, agent):
+        # the task is created on the loop so that it can be cancelled and waited for, even before it has started
+        loop = self.loop_for(agent)
+        task = concurrent.futures.Future()
+        done = threading.Event()
+
+        def start():
+            task.set_result(loop.create_task(coro))
+            task.result().add_done_callback(lambda _: done.set())
+
+        loop.call_soon_threadsafe(start)
+        return loop, task, done
+
+    def _get_event(self, events, timeout):
+        try:
+            return events.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+    def _cancel(self, handle):
+        loop, task, done = handle
+        loop.call_soon_threadsafe(task.result().cancel)
+        done.wait()
+
+    def close(self):
+        """Stop the loops and wait for their threads."""
+        for loop, thread in self._loops:
+            loop.call_soon_threadsafe(loop.stop)
+        for loop, thread in self._loops:
+            thread.join()
+            loop.close()
@@ -0,0 +1,159 @@
+import json
+import re
+import time
+
+# summary words shorter than this aren't indexed for search
+_MIN_TERM_CHARS = 3
+_MAX_TERMS = 256
+
+
+def summary_terms(text):
+    """The search terms of a text: its distinct lowercase words of at least three letters or digits."""
+    terms = dict.fromkeys(term for term in re.findall(r"[a-z0-9]+", (text or "").lower()) if len(term) >= _MIN_TERM_CHARS)
+    return list(terms)[:_MAX_TERMS]
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class ShareIndex:
+    """
+    Secondary index of an app's shared chats, kept in the shared chats database (upstash_redis or redis-py API)
+    next to the share records, so that they can be listed and searched without scanning the keyspace.
+
+    Under share_index:<namespace>:, sorted sets of share keys by date and by access count (overall, and per agent)
+    serve listings, and a set of share keys per summary term serves search. Share records expire while the index
+    doesn't, so an entry per share records its agent and terms, and shares found to have expired when listed are
+    removed from the index then.
+    """
+    def __init__(self, redis, namespace):
+        self.redis = redis
+        self.prefix = f"share_index:{namespace}:"
+
+    def _order_key(self, order, agent_name = None):
+        if order not in ("date", "popular"):
+            raise ValueError(f"Unknown shared chat order {order!r}")
+        return self.prefix + order + (":agent:" + agent_name if agent_name else "")
+
+    def _term_key(self, term):
+        return self.prefix + "term:" + term
+
+    def _entry_key(self, share_key):
+        return self.prefix + "entry:" + share_key
+
+    def add(self, share_key, record, replace = True):
+        """
+        Index a share record (as saved by the server); sharing the same chat again keeps its date and count. With
+        replace = False, as when the existing record was kept, a share that is already indexed keeps its search terms.
+        """
+        agent_name = record["agent_name"]
+        terms = summary_terms(f"{record.get('summary')} {agent_name}")
+        shared = time.time()
+
+        entry = self.redis.get(self._entry_key(share_key))
+        old_terms = json.loads(_text(entry))["terms"] if entry is not None else []
+        if entry is not None and not replace:
+            terms = old_terms
+
+        pipe = self.redis.pipeline()
+        pipe.set(self._entry_key(share_key), json.dumps({"agent": agent_name, "terms": terms}))
+        # terms of the replaced summary no longer find the share
+        for term in set(old_terms) - set(terms):
+            pipe.srem(self._term_key(term), share_key)
+        for key in (self._order_key("date"), self._order_key("date", agent_name)):
+            pipe.zadd(key, {share_key: shared}, nx = True)
+        for key in (self._order_key("popular"), self._order_key("popular", agent_name)):
+            pipe.zadd(key, {share_key: 0}, nx = True)
+        for term in terms:
+            pipe.sadd(self._term_key(term), share_key)
+        pipe.exec()
+
+    def queue_view(self, pipe, share_key, agent_name):
+        """Add a view of a shared chat to its popularity, as part of the caller's pipeline."""
+        pipe.zincrby(self._order_key("popular"), 1, share_key)
+        pipe.zincrby(self._order_key("popular", agent_name), 1, share_key)
+
+    def list(self, order = "date", agent_name = None, offset = 0, count = 10):
+        """
+        A page of shared chats, most recent or most viewed first, optionally only those of one agent. Returns
+        ([(share_key, record, access_count)], total), where total (the number of indexed chats) may include a few
+        that have expired.
+        """
+        key = self._order_key(order, agent_name)
+        pipe = self.redis.pipeline()
+        pipe.zrevrange(key, offset, offset + count - 1)
+        pipe.zcard(key)
+        share_keys, total = pipe.exec()
+        return self._fetch([_text(share_key) for share_key in share_keys]), total
+
+    def search(self, query, agent_name = None, offset = 0, count = 10):
+        """
+        A page of the shared chats whose summaries contain all words of the query, most recent first, optionally
+        only those of one agent. Returns ([(share_key, record, access_count)], total); matches that have expired are
+        removed from the index and not counted.
+        """
+        terms = summary_terms(query)
+        if not terms:
+            return [], 0
+
+        share_keys = {_text(share_key) for share_key in self.redis.sinter(*[self._term_key(term) for term in terms])}
+        if not share_keys:
+            return [], 0
+
+        # rank by share date, from the date index (of the agent, which also filters the matches), checking in the same
+        # round trip which of the matches still exist
+        share_keys = list(share_keys)
+        pipe = self.redis.pipeline()
+        for share_key in share_keys:
+            pipe.zscore(self._order_key("date", agent_name), share_key)
+            pipe.exists(share_key)
+        results = pipe.exec()
+        dates, exists = results[0::2], results[1::2]
+
+        expired = [share_key for share_key, share_exists in zip(share_keys, exists) if not share_exists]
+        if expired:
+            self.remove(expired)
+
+        matches = sorted((float(date), share_key) for share_key, date, share_exists in zip(share_keys, dates, exists)
+                         if date is not None and share_exists)
+        page = [share_key for _, share_key in reversed(matches)][offset:offset + count]
+        return self._fetch(page), len(matches)
+
+    def _fetch(self, share_keys):
+        if not share_keys:
+            return []
+
+        pipe = self.redis.pipeline()
+        pipe.mget(*share_keys)
+        pipe.mget(*[share_key + ":access_count" for share_key in share_keys])
+        records, access_counts = pipe.exec()
+
+        chats, expired = [], []
+        for share_key, record, access_count in zip(share_keys, records, access_counts):
+            if record is None:
+                expired.append(share_key)
+                continue
+            record = json.loads(_text(record))
+            # records shared before the separate access counter keep their earlier count in the record
+            chats.append((share_key, record, record.get("access_count", 0) + int(access_count or 0)))
+
+        if expired:
+            self.remove(expired)
+        return chats
+
+    def remove(self, share_keys):
+        """Remove shares (e.g. expired ones) from the index."""
+        entries = self.redis.mget(*[self._entry_key(share_key) for share_key in share_keys])
+
+        pipe = self.redis.pipeline()
+        for share_key, entry in zip(share_keys, entries):
+            entry = json.loads(_text(entry)) if entry is not None else {"agent": None, "terms": []}
+            for order in ("date", "popular"):
+                pipe.zrem(self._order_key(order), share_key)
+                if entry["agent"]:
+                    pipe.zrem(self._order_key(order, entry["agent"]), share_key)
+            for term in entry["terms"]:
+                pipe.srem(self._term_key(term), share_key)
+            pipe.delete(self._entry_key(share_key))
+        pipe.exec()
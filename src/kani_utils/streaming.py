@@ -0,0 +1,215 @@
+import asyncio
+import random
+import threading
+import time
+
+# HTTP statuses of model API errors worth retrying: timeouts, conflicts, rate limits and server errors
+_TRANSIENT_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+# names of the connection and timeout errors of the provider SDKs and httpx, matched by name so that none of them
+# has to be imported
+_TRANSIENT_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "TransportError", "RemoteProtocolError",
+                          "ServiceUnavailableError", "InternalServerError", "RateLimitError", "OverloadedError"}
+
+
+class FlushPolicy:
+    """
+    When a coalesced stream (see coalesce_stream()) sends its buffered tokens to the browser: once interval seconds
+    have passed since its last update, or once min_chars characters are buffered, whichever comes first (None turns
+    either off). The first token of a stream is always sent at once.
+
+    With adaptive = True, the interval grows with the number of replies streaming in the process: above
+    adaptive_streams concurrent streams it is scaled by streams / adaptive_streams, up to max_interval.
+    """
+    def __init__(self, interval = 0.05, min_chars = None, adaptive = False, adaptive_streams = 10, max_interval = 0.25):
+        self.interval = interval
+        self.min_chars = min_chars
+        self.adaptive = adaptive
+        self.adaptive_streams = adaptive_streams
+        self.max_interval = max_interval
+
+    def current_interval(self, active_streams):
+        if self.interval is None or not self.adaptive or active_streams <= self.adaptive_streams:
+            return self.interval
+        return min(self.max_interval, self.interval * active_streams / self.adaptive_streams)
+
+    def should_flush(self, buffered_chars, elapsed, active_streams):
+        if self.min_chars is not None and buffered_chars >= self.min_chars:
+            return True
+        interval = self.current_interval(active_streams)
+        return interval is not None and elapsed >= interval
+
+
+class StreamRetryPolicy:
+    """
+    How agents recover when a model stream stalls or drops (see EnhancedKani's stream_retry). A stream that sends
+    nothing for idle_timeout seconds, or is still going deadline seconds after the model was first called (None turns
+    either off), or fails with a transient error (connection errors, timeouts, rate limits, server errors) is retried
+    up to max_retries times. Retries wait a random time of up to backoff * 2 ** (retry - 1) seconds, at most
+    max_backoff ("full jitter"), so that sessions hit by the same outage don't retry in step. If part of the reply
+    was already streamed, the retry asks the model to continue it rather than start over.
+
+    The idle timeout only applies once the first token has arrived: models that reason before replying may send
+    nothing for minutes, and retrying them would bill the prompt again. The wait for the first token is limited by
+    first_token_timeout instead, which by default (None) leaves it to the deadline.
+    """
+    def __init__(self, idle_timeout = 60.0, deadline = 600.0, max_retries = 2, backoff = 1.0, max_backoff = 10.0,
+                 first_token_timeout = None):
+        self.idle_timeout = idle_timeout
+        self.first_token_timeout = first_token_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, retry):
+        """Seconds to wait before the given retry (counted from 1)."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+
+class ModelStreamError(Exception):
+    """A model stream failed for good: it stalled, ran out of time or failed with an error, and retries ran out."""
+
+
+def is_transient_error(error):
+    """Whether a model stream error is worth retrying (see StreamRetryPolicy)."""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    if getattr(error, "status_code", None) in _TRANSIENT_STATUSES:
+        return True
+    return any(cls.__name__ in _TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+async def guard_stream(elems, idle_timeout = None, deadline = None, first_timeout = None):
+    """
+    Yield the elements of an async iterator, raising asyncio.TimeoutError if the first one doesn't arrive within
+    first_timeout seconds, a later one within idle_timeout seconds of the previous one, or any by the deadline (a
+    time.monotonic() time). None turns a limit off. The iterator is closed in any case.
+    """
+    iterator = elems.__aiter__()
+    first = True
+    try:
+        while True:
+            timeout = first_timeout if first else idle_timeout
+            first = False
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                elem = await asyncio.wait_for(iterator.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+            yield elem
+    finally:
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+class StreamStats:
+    """
+    Process-wide counters of streamed replies: streams started and in progress, tokens received, and updates
+    (deltas) sent to browsers with their size in bytes. st.write_stream re-sends the whole text so far with each
+    update and once more when the stream ends, which is what bytes counts.
+
+    Model streams that stalled (sent nothing for the idle timeout or ran past the deadline), were retried, were
+    resumed from a partial reply, or failed for good are counted too (see StreamRetryPolicy), as are the heartbeats
+    sent while waiting on agents (see AgentRuntime.stream_rounds).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.streams = 0
+        self.active_streams = 0
+        self.tokens = 0
+        self.deltas = 0
+        self.bytes = 0
+        self.stalls = 0
+        self.retries = 0
+        self.resumed = 0
+        self.failures = 0
+        self.heartbeats = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {"streams": self.streams,
+                    "active_streams": self.active_streams,
+                    "tokens": self.tokens,
+                    "deltas": self.deltas,
+                    "bytes": self.bytes,
+                    "stalls": self.stalls,
+                    "retries": self.retries,
+                    "resumed": self.resumed,
+                    "failures": self.failures,
+                    "heartbeats": self.heartbeats}
+
+    def _start(self):
+        with self._lock:
+            self.streams += 1
+            self.active_streams += 1
+
+    def _end(self):
+        with self._lock:
+            self.active_streams -= 1
+
+    def _count(self, tokens = 0, deltas = 0, sent_bytes = 0, stalls = 0, retries = 0, resumed = 0, failures = 0,
+               heartbeats = 0):
+        with self._lock:
+            self.tokens += tokens
+            self.deltas += deltas
+            self.bytes += sent_bytes
+            self.stalls += stalls
+            self.retries += retries
+            self.resumed += resumed
+            self.failures += failures
+            self.heartbeats += heartbeats
+
+
+_stream_stats = StreamStats()
+
+
+def get_stream_stats():
+    """The process-wide StreamStats of the chat server."""
+    return _stream_stats
+
+
+def coalesce_stream(tokens, policy = None, stats = None):
+    """
+    Yield the text of a token stream in batches, as the FlushPolicy allows, for st.write_stream; with no policy,
+    each token is yielded as it arrives. Empty tokens are never yielded, but give the policy a chance to send what is
+    buffered while the stream stalls. Updates are counted in stats (the process-wide StreamStats by default).
+    """
+    stats = stats or get_stream_stats()
+    stats._start()
+
+    buffer = []
+    buffered_chars = 0
+    last_flush = None
+    sent_bytes = 0  # size of the text sent so far, which each update carries in full
+
+    def flush():
+        nonlocal buffer, buffered_chars, last_flush, sent_bytes
+        chunk = "".join(buffer)
+        buffer = []
+        buffered_chars = 0
+        last_flush = time.monotonic()
+        sent_bytes += len(chunk.encode("utf-8"))
+        stats._count(deltas = 1, sent_bytes = sent_bytes)
+        return chunk
+
+    try:
+        for token in tokens:
+            if token:
+                buffer.append(token)
+                buffered_chars += len(token)
+                stats._count(tokens = 1)
+            if not buffer:
+                continue
+            if policy is None or last_flush is None or \
+               policy.should_flush(buffered_chars, time.monotonic() - last_flush, stats.active_streams):
+                yield flush()
+
+        if buffer:
+            yield flush()
+        if sent_bytes:
+            # st.write_stream's final update, replacing the streamed text
+            stats._count(deltas = 1, sent_bytes = sent_bytes)
+    finally:
+        stats._end()
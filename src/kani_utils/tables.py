@@ -0,0 +1,214 @@
+import os
+import shutil
+import tempfile
+import threading
+
+
+class ParquetTable:
+    """
+    A table kept on local disk as a Parquet file, for data too large to hold in memory. Stored in an agent's memory
+    in place of a DataFrame; queries read only the columns and row groups they need (requires duckdb and pyarrow).
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return f"ParquetTable({self.path!r})"
+
+
+def csv_to_parquet(source, path):
+    """
+    Convert a CSV file (a path or a file object, e.g. an uploaded file) to a Parquet file at path, streaming it with
+    duckdb rather than loading it in memory. Returns a ParquetTable.
+    """
+    import duckdb
+
+    with tempfile.TemporaryDirectory() as directory:
+        if not isinstance(source, str):
+            # duckdb reads CSVs from paths, so spool file objects to disk
+            csv_path = os.path.join(directory, "upload.csv")
+            with open(csv_path, "wb") as f:
+                shutil.copyfileobj(source, f)
+            source = csv_path
+
+        with duckdb.connect() as con:
+            con.execute("COPY (SELECT * FROM read_csv_auto(?)) TO '" + path.replace("'", "''") + "' (FORMAT PARQUET)",
+                        [source])
+
+    return ParquetTable(path)
+
+
+def _is_table(value):
+    if isinstance(value, ParquetTable):
+        return True
+    import pandas as pd
+    return isinstance(value, pd.DataFrame)
+
+
+class TableInfo:
+    """Catalog entry for a table: its schema, row count, dtype summary and preview, computed once at registration."""
+    def __init__(self, name, table, rows, columns, preview):
+        self.name = name
+        self.table = table
+        self.rows = rows
+        self.columns = columns  # [(column name, dtype name)]
+        self.preview = preview
+        self.stats = None  # describe() output, computed on first use
+
+    @property
+    def dtype_summary(self):
+        counts = {}
+        for _, dtype in self.columns:
+            counts[dtype] = counts.get(dtype, 0) + 1
+        return counts
+
+    def summary(self):
+        dtypes = ", ".join(f"{count} {dtype}" for dtype, count in self.dtype_summary.items())
+        return f"{self.name}: {self.rows} rows, {len(self.columns)} columns ({dtypes})"
+
+    def schema(self):
+        return ", ".join(f"{column} ({dtype})" for column, dtype in self.columns)
+
+
+class TableCatalog:
+    """
+    Catalog of the tables (pandas DataFrames, or ParquetTables on disk) stored in an agent's memory dict.
+
+    Tables are described once, when registered, so listing and describing them doesn't touch the data. Since other
+    tools may store, replace or remove memory keys directly, sync() reconciles the catalog with the memory dict by
+    object identity, only inspecting values that are new or have changed. The catalog may be used from background
+    jobs while the script renders it.
+
+    ParquetTables whose file can't be read (e.g. restored from a checkpoint on a host that doesn't have it) are left
+    out of the catalog by sync() and listed by unavailable() instead.
+    """
+    def __init__(self, preview_rows = 10):
+        self.preview_rows = preview_rows
+        self._tables = {}  # name -> TableInfo
+        self._not_tables = {}  # name -> memory value known not to be a table
+        self._unavailable = {}  # name -> (ParquetTable, error message)
+        self._lock = threading.RLock()
+
+    def register(self, name, df):
+        """Add or replace a table (a DataFrame or ParquetTable), returning its catalog entry."""
+        if isinstance(df, ParquetTable):
+            import pyarrow.parquet as pq
+
+            # row count and schema come from the file's footer; the preview only reads the first rows
+            parquet_file = pq.ParquetFile(df.path, memory_map = True)
+            first_rows = next(parquet_file.iter_batches(batch_size = self.preview_rows), None)
+            info = TableInfo(name = name,
+                             table = df,
+                             rows = parquet_file.metadata.num_rows,
+                             columns = [(field.name, str(field.type)) for field in parquet_file.schema_arrow],
+                             preview = first_rows.to_pandas().to_markdown() if first_rows is not None else "(empty)")
+        else:
+            info = TableInfo(name = name,
+                             table = df,
+                             rows = len(df),
+                             columns = [(str(column), str(dtype)) for column, dtype in df.dtypes.items()],
+                             preview = df.head(self.preview_rows).to_markdown())
+        with self._lock:
+            self._tables[name] = info
+            self._not_tables.pop(name, None)
+        return info
+
+    def sync(self, memory):
+        """Bring the catalog up to date with the memory dict."""
+        with self._lock:
+            # a snapshot, since jobs may add memory keys meanwhile
+            memory = dict(memory)
+
+            for name in [name for name in self._tables if name not in memory]:
+                del self._tables[name]
+            for name in [name for name in self._not_tables if name not in memory]:
+                del self._not_tables[name]
+            # files of unavailable tables are looked for again
+            self._unavailable.clear()
+
+            for name, value in memory.items():
+                info = self._tables.get(name)
+                if info is not None and info.table is value:
+                    continue
+                if info is None and self._not_tables.get(name) is value:
+                    continue
+
+                if not _is_table(value):
+                    self._tables.pop(name, None)
+                    self._not_tables[name] = value
+                    continue
+
+                try:
+                    self.register(name, value)
+                except (OSError, ValueError) as e:
+                    if not isinstance(value, ParquetTable):
+                        raise
+                    # pyarrow reports missing files as OSError and unreadable ones as ValueError (ArrowInvalid)
+                    self._tables.pop(name, None)
+                    self._unavailable[name] = (value, f"{type(e).__name__}: {e}")
+
+    def unavailable(self):
+        """{name: error message} for the ParquetTables in memory, as of the last sync(), whose file can't be read."""
+        with self._lock:
+            return {name: error for name, (_, error) in self._unavailable.items()}
+
+    def names(self):
+        with self._lock:
+            return list(self._tables)
+
+    def get(self, name):
+        return self._tables.get(name)
+
+    def tables(self):
+        """{name: table} for all cataloged tables."""
+        with self._lock:
+            return {name: info.table for name, info in self._tables.items()}
+
+    def describe(self, name):
+        """Summary statistics of each column of a table, as markdown. Computed once per table."""
+        info = self._tables[name]
+        if info.stats is None:
+            if isinstance(info.table, ParquetTable):
+                import duckdb
+
+                with duckdb.connect() as con:
+                    info.stats = con.execute("SUMMARIZE SELECT * FROM read_parquet(?)", [info.table.path]).df().to_markdown()
+            else:
+                info.stats = info.table.describe(include = "all").to_markdown()
+        return info.stats
+
+
+def query_tables(query, tables):
+    """
+    Run an SQL query over {name: table} (DataFrames or ParquetTables), returning a DataFrame.
+
+    If duckdb is installed, DataFrames are scanned in place and Parquet files are read lazily, touching only the
+    columns and row groups the query needs. Otherwise the query runs with pandasql (SQLite), which only supports
+    in-memory tables.
+
+    Queries are usually written by the model, so the DuckDB connection is locked down before running one: it can read
+    only the tables' Parquet files, and no other files, URLs, databases or extensions, and can't change its settings.
+    """
+    try:
+        import duckdb
+    except ImportError:
+        if any(isinstance(table, ParquetTable) for table in tables.values()):
+            raise RuntimeError("Querying tables stored on disk requires duckdb (pip install kani-utils[tables])")
+        from pandasql import sqldf
+        return sqldf(query, tables)
+
+    with duckdb.connect() as con:
+        paths = []
+        for name, table in tables.items():
+            if isinstance(table, ParquetTable):
+                quoted_name = '"' + name.replace('"', '""') + '"'
+                con.execute(f"CREATE VIEW {quoted_name} AS SELECT * FROM read_parquet('" + table.path.replace("'", "''") + "')")
+                paths.append(os.path.abspath(table.path))
+            else:
+                con.register(name, table)
+
+        # the views read their files lazily, so those stay allowed (also for writing, but no other path is)
+        con.execute("SET allowed_paths = ?", [paths])
+        con.execute("SET enable_external_access = false")
+        con.execute("SET lock_configuration = true")
+        return con.execute(query).df()
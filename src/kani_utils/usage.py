@@ -0,0 +1,228 @@
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = ("prompt_tokens", "completion_tokens", "cost", "requests")
+_GROUP_FIELDS = ("user", "agent", "model")
+
+
+def _empty_totals():
+    return {"prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "requests": 0}
+
+
+def _add_totals(into, other):
+    for field in _FIELDS:
+        into[field] += other[field]
+
+
+class SQLiteUsageStore:
+    """Usage rollups kept in a SQLite table, one row per (time bucket, user, agent, model)."""
+    def __init__(self, path = "kani_usage.db"):
+        self.path = path
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS usage (
+                                bucket INTEGER, user TEXT, agent TEXT, model TEXT,
+                                prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL, requests INTEGER,
+                                PRIMARY KEY (bucket, user, agent, model))""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout = 30)
+
+    def add(self, rows):
+        """Add a batch of {(bucket, user, agent, model): totals} to the stored rollups in one transaction."""
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.executemany("""INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (bucket, user, agent, model) DO UPDATE SET
+                                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                                    cost = cost + excluded.cost,
+                                    requests = requests + excluded.requests""",
+                             [(*key, *(totals[f] for f in _FIELDS)) for key, totals in rows.items()])
+
+    def rows(self, start_bucket, end_bucket):
+        """Yield ((bucket, user, agent, model), totals) for buckets in [start_bucket, end_bucket]."""
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM usage WHERE bucket >= ? AND bucket <= ?", (start_bucket, end_bucket)).fetchall()
+        for row in rows:
+            yield tuple(row[:4]), dict(zip(_FIELDS, row[4:]))
+
+
+class RedisUsageStore:
+    """Usage rollups kept in Redis hashes, with a sorted set indexing the hash keys by time bucket."""
+    def __init__(self, client = None, url = None, prefix = "usage:", ttl_seconds = 60 * 60 * 24 * 90):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0", decode_responses = True)
+        self.client = client
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+
+    def _key(self, key):
+        # unit separator keeps user/agent/model names with ':' in them unambiguous
+        return self.prefix + "\x1f".join(str(part) for part in key)
+
+    def add(self, rows):
+        """Add a batch of {(bucket, user, agent, model): totals} to the stored rollups in one pipeline."""
+        pipe = self.client.pipeline(transaction = False)
+        for key, totals in rows.items():
+            hkey = self._key(key)
+            pipe.hincrby(hkey, "prompt_tokens", totals["prompt_tokens"])
+            pipe.hincrby(hkey, "completion_tokens", totals["completion_tokens"])
+            pipe.hincrbyfloat(hkey, "cost", totals["cost"])
+            pipe.hincrby(hkey, "requests", totals["requests"])
+            pipe.expire(hkey, self.ttl_seconds)
+            pipe.zadd(self.prefix + "index", {hkey: key[0]})
+        pipe.execute()
+
+    def rows(self, start_bucket, end_bucket):
+        """Yield ((bucket, user, agent, model), totals) for buckets in [start_bucket, end_bucket]."""
+        hkeys = self.client.zrangebyscore(self.prefix + "index", start_bucket, end_bucket)
+        pipe = self.client.pipeline(transaction = False)
+        for hkey in hkeys:
+            pipe.hgetall(hkey)
+        for hkey, values in zip(hkeys, pipe.execute()):
+            if not values:
+                continue
+            bucket, user, agent, model = hkey[len(self.prefix):].split("\x1f")
+            totals = {f: (float(values.get(f, 0)) if f == "cost" else int(values.get(f, 0))) for f in _FIELDS}
+            yield (int(bucket), user, agent, model), totals
+
+
+class UsageLedger:
+    """
+    Process-wide ledger of prompt/completion tokens and cost by user, agent and model.
+
+    record() only updates in-memory rollups (per time bucket of bucket_seconds), so it is cheap enough to call on
+    every completion. A background thread flushes the accumulated deltas to the store (SQLiteUsageStore or
+    RedisUsageStore) every flush_interval seconds. Recent rollups are also retained in memory for retain_seconds,
+    which lets spent() answer budget checks without touching the store. Without a store, query() only covers the
+    rollups retained in memory.
+
+    The ledger is meant to be shared between sessions, e.g. created in an @st.cache_resource function and passed
+    to initialize_app_config(usage_ledger = ...).
+    """
+    def __init__(self,
+                 store = None,
+                 bucket_seconds = 60,
+                 flush_interval = 30.0,
+                 retain_seconds = 60 * 60 * 24):
+        self.store = store
+        self.bucket_seconds = bucket_seconds
+        self.flush_interval = flush_interval
+        self.retain_seconds = retain_seconds
+
+        self._lock = threading.Lock()
+        self._recent = {}  # (bucket, user, agent, model) -> totals recorded by this process
+        self._dirty = {}  # (bucket, user, agent, model) -> totals not yet flushed to the store
+        self._newest_bucket = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _bucket(self, timestamp):
+        return int(timestamp // self.bucket_seconds)
+
+    def record(self, user, agent, model, prompt_tokens, completion_tokens, cost = None, timestamp = None):
+        """Record the usage of a single completion."""
+        key = (self._bucket(timestamp or time.time()), str(user), str(agent), str(model))
+        delta = {"prompt_tokens": prompt_tokens or 0,
+                 "completion_tokens": completion_tokens or 0,
+                 "cost": cost or 0.0,
+                 "requests": 1}
+
+        with self._lock:
+            # rollups are pruned as new buckets start, so at most once per bucket_seconds, whether or not there is a
+            # store (and so a flush thread)
+            if self._newest_bucket is None or key[0] > self._newest_bucket:
+                self._newest_bucket = key[0]
+                self._prune()
+            _add_totals(self._recent.setdefault(key, _empty_totals()), delta)
+            if self.store is not None:
+                _add_totals(self._dirty.setdefault(key, _empty_totals()), delta)
+
+        self._ensure_flush_thread()
+
+    def spent(self, user = None, agent = None, model = None, window_seconds = 60 * 60):
+        """Totals recorded by this process over the last window_seconds (at most retain_seconds), from memory only."""
+        start_bucket = self._bucket(time.time() - min(window_seconds, self.retain_seconds))
+        totals = _empty_totals()
+        with self._lock:
+            for key, row in self._recent.items():
+                if key[0] >= start_bucket and self._matches(key, user, agent, model):
+                    _add_totals(totals, row)
+        return totals
+
+    def query(self, start = None, end = None, user = None, agent = None, model = None, group_by = _GROUP_FIELDS):
+        """
+        Totals between the start and end timestamps (default: everything), optionally filtered by user, agent
+        and model, grouped by any of "user", "agent", "model". Includes flushed rows of all processes sharing the
+        store plus this process's unflushed deltas. Returns a list of dicts.
+        """
+        start_bucket = self._bucket(start) if start is not None else 0
+        end_bucket = self._bucket(end if end is not None else time.time())
+
+        with self._lock:
+            if self.store is None:
+                unflushed = list(self._recent.items())
+            else:
+                unflushed = list(self._dirty.items())
+        rows = unflushed if self.store is None else list(self.store.rows(start_bucket, end_bucket)) + unflushed
+
+        groups = {}
+        for key, row in rows:
+            if not start_bucket <= key[0] <= end_bucket or not self._matches(key, user, agent, model):
+                continue
+            group = tuple(key[1 + _GROUP_FIELDS.index(field)] for field in group_by)
+            _add_totals(groups.setdefault(group, _empty_totals()), row)
+
+        return [{**dict(zip(group_by, group)), **totals} for group, totals in groups.items()]
+
+    def flush(self):
+        """Write unflushed deltas to the store and drop rollups older than retain_seconds."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._prune()
+
+        if not dirty or self.store is None:
+            return
+
+        try:
+            self.store.add(dirty)
+        except Exception as e:
+            logger.error(f"Failed to flush usage ledger, will retry: {e}")
+            with self._lock:
+                for key, row in dirty.items():
+                    _add_totals(self._dirty.setdefault(key, _empty_totals()), row)
+
+    def close(self):
+        """Stop the background thread after a final flush."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _prune(self):
+        # called with the lock held
+        oldest = self._bucket(time.time() - self.retain_seconds)
+        self._recent = {key: row for key, row in self._recent.items() if key[0] >= oldest}
+
+    @staticmethod
+    def _matches(key, user, agent, model):
+        return (user is None or key[1] == str(user)) and \
+               (agent is None or key[2] == str(agent)) and \
+               (model is None or key[3] == str(model))
+
+    def _ensure_flush_thread(self):
+        if self._thread is not None or self.store is None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._flush_loop, name = "kani-usage-ledger", daemon = True)
+                self._thread.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
@@ -1,8 +1,3 @@
-import asyncio
-from typing import Generator
-from kani.streaming import StreamManager
-import nest_asyncio
-
 def _seconds_to_days_hours(ttl_seconds):
     # we need to convert the time to a human-readable format, e.g. 28 days, 18 hours (rounded to nearest hour)
     # we don't want the default datetime.timedelta format
@@ -20,34 +15,3 @@ def _seconds_to_days_hours(ttl_seconds):
      
     return ttl_human
 
-
-def _sync_generator_from_kani_streammanager(kani_stream: StreamManager) -> Generator:
-    """
-    Converts an asynchronous StreamManager from Kani to a synchronous generator.
-    """
-
-    nest_asyncio.apply()
-
-    loop = asyncio.get_event_loop()
-    queue = asyncio.Queue()
-
-    async def put_items_in_queue():
-        async for item in kani_stream:
-            await queue.put(item)
-        await queue.put(None)  # Sentinel to signal the end of the queue
-
-    async def runner():
-        await put_items_in_queue()
-
-    def generator():
-        asyncio.ensure_future(runner())
-
-        while True:
-            item = loop.run_until_complete(queue.get())
-            if item is None:  # Check for the sentinel value
-                break
-            yield item
-
-    return generator()
-
-
@@ -0,0 +1,133 @@
+import multiprocessing
+import os
+import uuid
+
+import pytest
+from kani import ChatMessage
+
+from kani_utils.checkpoint import FileCheckpointStore, RedisCheckpointStore, SessionCheckpointer
+
+SESSION_KEY = "test-session"
+
+
+class StandInAgent:
+    """The state SessionCheckpointer persists, without a model behind it."""
+    def __init__(self):
+        self.chat_history = []
+        self.display_messages = []
+        self.memory = {}
+        self.tokens_used_prompt = 0
+        self.tokens_used_prompt_cached = 0
+        self.tokens_used_completion = 0
+
+
+def _make_store(kind, location):
+    if kind == "file":
+        return FileCheckpointStore(location)
+    return RedisCheckpointStore(url = location, prefix = "kani-test:")
+
+
+def _worker(kind, location, session_key, worker_id, turns):
+    # a worker process serving the session, as in the server's shared session state mode: sync under the session's
+    # lock, run a turn, checkpoint it
+    checkpointer = SessionCheckpointer(_make_store(kind, location))
+    agent = StandInAgent()
+    offset = 0
+    for turn in range(turns):
+        with checkpointer.lock(session_key):
+            offset = checkpointer.sync(session_key, {"agent": agent}, offset)
+            agent.chat_history.append(ChatMessage.user(f"{worker_id}:{turn}"))
+            agent.chat_history.append(ChatMessage.assistant(f"reply {worker_id}:{turn}"))
+            agent.memory[f"turns_{worker_id}"] = turn + 1
+            agent.tokens_used_prompt += 10
+            offset += checkpointer.checkpoint(session_key, "agent", agent)
+
+
+@pytest.mark.parametrize("kind", ["file", "redis"])
+def test_workers_share_session_without_duplicates(tmp_path, kind):
+    if kind == "file":
+        location = str(tmp_path)
+    else:
+        location = os.environ.get("KANI_TEST_REDIS_URL")
+        if not location:
+            pytest.skip("set KANI_TEST_REDIS_URL to test against Redis")
+    store = _make_store(kind, location)
+    session_key = uuid.uuid4().hex
+
+    num_workers, turns = 4, 10
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target = _worker,
+                               args = (kind, location, session_key, worker_id, turns))
+               for worker_id in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout = 120)
+        assert worker.exitcode == 0
+
+    try:
+        agent = StandInAgent()
+        SessionCheckpointer(store).sync(session_key, {"agent": agent})
+        user_messages = [m.content for m in agent.chat_history if m.role.value == "user"]
+        assert len(agent.chat_history) == num_workers * turns * 2
+        assert sorted(user_messages) == sorted(f"{w}:{t}" for w in range(num_workers) for t in range(turns))
+        assert agent.memory == {f"turns_{w}": turns for w in range(num_workers)}
+        assert agent.tokens_used_prompt == num_workers * turns * 10
+    finally:
+        if kind == "redis":
+            store.client.delete(store.prefix + session_key)
+
+
+def test_failed_record_is_skipped_not_reapplied(tmp_path):
+    store = FileCheckpointStore(str(tmp_path))
+    writer = SessionCheckpointer(store)
+    first, second = StandInAgent(), StandInAgent()
+    first.chat_history.append(ChatMessage.user("hello"))
+    second.chat_history.append(ChatMessage.user("hi"))
+    writer.checkpoint(SESSION_KEY, "first", first)
+    writer.checkpoint(SESSION_KEY, "second", second)
+    store.append(SESSION_KEY, ['{"agent": "second", "type": "memory_set", "key": "broken", "value": "not dill"}'])
+
+    reader = SessionCheckpointer(store)
+    agents = {"first": StandInAgent(), "second": StandInAgent()}
+    errors = []
+    offset = reader.sync(SESSION_KEY, agents, on_error = lambda record, error: errors.append(record["key"]))
+    assert errors == ["broken"]
+
+    # syncing again reads nothing new
+    assert reader.sync(SESSION_KEY, agents, offset) == offset
+    assert [m.content for m in agents["first"].chat_history] == ["hello"]
+    assert [m.content for m in agents["second"].chat_history] == ["hi"]
+
+
+def test_file_store_reads_from_remembered_position(tmp_path):
+    store = FileCheckpointStore(str(tmp_path))
+    store.append(SESSION_KEY, ["a", "b"])
+    assert store.read(SESSION_KEY) == ["a", "b"]
+    store.append(SESSION_KEY, ["c"])
+    assert store.read(SESSION_KEY, 2) == ["c"]
+    assert store.read(SESSION_KEY, 1) == ["b", "c"]
+
+    # a record still being appended is not read yet
+    with open(store._path(SESSION_KEY), "a", encoding = "utf-8") as f:
+        f.write('{"partial')
+    assert store.read(SESSION_KEY, 3) == []
+
+
+class _JobWritingMemory(dict):
+    """A memory dict that a background job writes to while it is being iterated."""
+    def items(self):
+        for item in super().items():
+            self[f"job_result_{len(self)}"] = "done"
+            yield item
+
+
+def test_checkpoint_snapshots_memory_written_by_jobs(tmp_path):
+    checkpointer = SessionCheckpointer(FileCheckpointStore(str(tmp_path)))
+    agent = StandInAgent()
+    agent.memory = _JobWritingMemory(table = "rows")
+    checkpointer.checkpoint(SESSION_KEY, "agent", agent)
+
+    restored = StandInAgent()
+    checkpointer.sync(SESSION_KEY, {"agent": restored})
+    assert restored.memory == {"table": "rows"}
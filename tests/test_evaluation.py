@@ -0,0 +1,72 @@
+import json
+
+import pytest
+from kani import ai_function
+
+from kani_utils.base_kanis import StreamlitKani
+from kani_utils.evaluation import load_agents_func, read_prompts, run_evaluation, write_results
+from kani_utils.loadtest import FakeEngine
+
+REPLY = "The weather is fine."
+
+
+class WeatherKani(StreamlitKani):
+    @ai_function()
+    def get_weather(self, city: str):
+        """Get the weather in a city."""
+        return f"sunny in {city}"
+
+
+def get_agents():
+    engine = FakeEngine(reply = REPLY, tokens_per_second = 10000, first_token_delay = 0,
+                        tool_calls = [("get_weather", {"city": "Lisbon"})])
+    return {"Weather": WeatherKani(engine, prompt_tokens_cost = 0.005, completion_tokens_cost = 0.015),
+            "Plain": StreamlitKani(engine)}
+
+
+def test_read_prompts(tmp_path):
+    path = tmp_path / "prompts.jsonl"
+    path.write_text('{"prompt": "hi"}\n\n{"id": "two", "prompts": ["a", "b"], "agent": "Plain"}\n')
+    assert read_prompts(str(path)) == [{"prompts": ["hi"], "id": 1},
+                                       {"id": "two", "prompts": ["a", "b"], "agent": "Plain"}]
+
+
+def test_conversations_record_turns_tool_calls_and_errors():
+    conversations = [{"id": 1, "prompts": ["weather?", "and tomorrow?"]},
+                     {"id": 2, "prompts": ["hello"], "agent": "Plain"},
+                     {"id": 3, "prompts": ["hello"], "agent": "Missing"}]
+    weather, plain, missing = run_evaluation(get_agents, conversations, concurrency = 2)
+
+    assert (weather["agent"], weather["model"], weather["error"]) == ("Weather", "fake-model", None)
+    assert [turn["output"] for turn in weather["turns"]] == [REPLY, REPLY]
+    [tool_call] = weather["turns"][0]["tool_calls"]
+    assert (tool_call["name"], tool_call["arguments"], tool_call["result"]) == \
+           ("get_weather", {"city": "Lisbon"}, "sunny in Lisbon")
+    assert weather["prompt_tokens"] > 0 and weather["cost"] > 0
+
+    assert plain["turns"][0]["tool_calls"] == []
+    # an unknown agent fails only its own conversation
+    assert missing["turns"] == [] and missing["error"].startswith("KeyError")
+
+
+def test_results_are_written_as_jsonl_or_parquet(tmp_path):
+    results = run_evaluation(get_agents, [{"id": "a", "prompts": ["hi"]}, {"id": 2, "prompts": ["hi"]}])
+
+    write_results(results, str(tmp_path / "results.jsonl"))
+    lines = (tmp_path / "results.jsonl").read_text().splitlines()
+    assert [json.loads(line)["id"] for line in lines] == ["a", 2]
+
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    write_results(results, str(tmp_path / "results.parquet"))
+    df = pd.read_parquet(tmp_path / "results.parquet")
+    assert list(df["id"]) == ["a", "2"]
+    assert json.loads(df["turns"][0])[0]["output"] == REPLY
+
+
+def test_agents_factory_is_loaded_from_a_file(tmp_path):
+    path = tmp_path / "my_agents.py"
+    path.write_text("def agents():\n    return {'A': None}\n")
+    assert load_agents_func(f"{path}:agents")() == {"A": None}
+    with pytest.raises(ValueError):
+        load_agents_func("no_function")
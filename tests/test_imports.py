@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+# optional backends and the demo agents' dependencies, imported on first use rather than with the server
+LAZY_MODULES = {"upstash_redis", "dill", "pandas", "pdfplumber"}
+
+# cumulative import time of the server module, including Streamlit and kani (about 0.5 s on a laptop)
+IMPORT_BUDGET_SECONDS = 2.0
+
+
+def test_server_import_is_lazy_and_within_budget():
+    src = os.path.join(os.path.dirname(__file__), "..", "src")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [src, os.environ.get("PYTHONPATH")]))}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import kani_utils.kani_streamlit_server"],
+                            capture_output = True, text = True, env = env, check = True)
+
+    # lines look like "import time:  self [us] | cumulative | imported package", nested imports indented
+    imported, server_microseconds = set(), None
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        module = module.strip()
+        imported.add(module.split(".")[0])
+        if module == "kani_utils.kani_streamlit_server":
+            server_microseconds = int(cumulative)
+
+    assert not imported & LAZY_MODULES
+    assert server_microseconds is not None
+    assert server_microseconds / 1e6 < IMPORT_BUDGET_SECONDS
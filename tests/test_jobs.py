@@ -0,0 +1,68 @@
+import asyncio
+import pickle
+import threading
+
+from kani_utils.base_kanis import StreamlitKani
+from kani_utils.jobs import JobManager, report_progress
+from kani_utils.loadtest import FakeEngine
+
+
+def _count_to(n, started = None, release = None):
+    if started is not None:
+        started.set()
+        release.wait(10)
+    report_progress(0.5, "halfway")
+    return n
+
+
+def _fail():
+    raise ValueError("bad input")
+
+
+def _wait(job):
+    # done callbacks run in order, so the job has finished once this one has run
+    finished = threading.Event()
+    job.future.add_done_callback(lambda future: finished.set())
+    assert finished.wait(10)
+
+
+def test_job_reports_progress_and_completes():
+    manager = JobManager(max_workers = 1)
+    started, release = threading.Event(), threading.Event()
+    job = manager.submit("count", _count_to, 3, started, release)
+    started.wait(10)
+    assert job.live and job.status == "running"
+    assert "is running" in job.describe()
+
+    release.set()
+    _wait(job)
+    assert (job.status, job.result, job.progress, job.message) == ("done", 3, 1.0, "halfway")
+    assert not job.live
+    assert job.describe().endswith("Result:\n\n3")
+
+    # pickled jobs keep their state, but not their future
+    restored = pickle.loads(pickle.dumps(job))
+    assert (restored.status, restored.result, restored.future) == ("done", 3, None)
+    manager.shutdown()
+
+
+def test_failed_job_reports_its_error():
+    manager = JobManager(max_workers = 1)
+    job = manager.submit("fail", _fail)
+    _wait(job)
+    assert (job.status, job.error) == ("failed", "ValueError: bad input")
+    assert "failed after" in job.describe()
+    manager.shutdown()
+
+
+def test_agent_jobs_are_awaited_and_checked_by_id():
+    manager = JobManager(max_workers = 1)
+    agent = StreamlitKani(FakeEngine(), job_manager = manager)
+    job = agent.start_job("count", _count_to, 5)
+
+    assert "Result:\n\n5" in asyncio.run(agent.await_job(job.id, timeout_seconds = 10))
+    assert agent.check_job(job.id) == job.describe()
+    assert agent.check_job("missing").startswith("Error")
+    # the job's progress is shown in the chat once the turn ends
+    assert len(agent.delayed_display_messages) == 1
+    manager.shutdown()
@@ -0,0 +1,48 @@
+import asyncio
+
+from kani import ChatRole
+
+from kani_utils.base_kanis import EnhancedKani
+from kani_utils.loadtest import FakeEngine, run_load_test
+from kani_utils.streaming import StreamRetryPolicy
+
+REPLY = "one two three four five six seven eight"
+
+
+async def _stream_round(agent, prompt):
+    text = ""
+    async for stream in agent.full_round_stream(prompt):
+        message = await stream.message()
+        if message.role == ChatRole.ASSISTANT:
+            text += message.text or ""
+    return text
+
+
+def test_fake_engine_replies_in_full_on_every_turn():
+    agent = EnhancedKani(FakeEngine(reply = REPLY, tokens_per_second = 10000, first_token_delay = 0))
+
+    async def session():
+        return [await _stream_round(agent, "first"), await _stream_round(agent, "second")]
+
+    assert asyncio.run(session()) == [REPLY, REPLY]
+
+
+def test_fake_engine_continues_a_stalled_reply():
+    # with this seed, the first stream stalls and the next ones don't
+    engine = FakeEngine(reply = REPLY, tokens_per_second = 10000, first_token_delay = 0, stall_rate = 0.5,
+                        stall_after = 3, seed = 1)
+    agent = EnhancedKani(engine, stream_retry = StreamRetryPolicy(idle_timeout = 0.1, max_retries = 1, backoff = 0))
+
+    async def session():
+        return [await _stream_round(agent, "first"), await _stream_round(agent, "second")]
+
+    assert asyncio.run(session()) == [REPLY, REPLY]
+    assert len(agent.chat_history) == 4
+
+
+def test_load_test_runs_measure_their_own_first_tokens():
+    engine = FakeEngine(tokens_per_second = 1000, first_token_delay = 0.2)
+    results = run_load_test(engine = engine, user_counts = (1, 1), turns_per_user = 2, warmup = False)
+    for result in results:
+        assert result["errors"] == 0
+        assert 0.2 <= result["ttft"]["p50"] < 2
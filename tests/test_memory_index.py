@@ -0,0 +1,47 @@
+import pandas as pd
+
+from kani_utils.memory_index import MemoryIndex
+
+
+def _keys(results):
+    return [key for key, _, _ in results]
+
+
+def test_search_ranks_keys_above_values_and_tolerates_typos():
+    index = MemoryIndex()
+    index.sync({"customer_orders": "a list of orders",
+                "notes": "the customer called about an order",
+                "weather": "sunny"})
+
+    assert _keys(index.search("customer order")) == ["customer_orders", "notes"]
+    assert _keys(index.search("custmer")) == ["customer_orders"]
+    assert index.search("zzz") == []
+
+
+def test_tables_are_indexed_by_their_columns():
+    index = MemoryIndex()
+    index.sync({"sales": pd.DataFrame({"revenue": [1], "region": ["north"]})})
+    [(key, snippet, _)] = index.search("revenue")
+    assert (key, snippet) == ("sales", "table revenue region")
+
+
+def test_sync_follows_added_changed_and_removed_entries():
+    index = MemoryIndex()
+    memory = {"plan": "visit Lisbon"}
+    index.sync(memory)
+    entry = index._entries["plan"]
+
+    # unchanged values are not reindexed
+    memory["budget"] = "two thousand euros"
+    index.sync(memory)
+    assert index._entries["plan"] is entry
+    assert _keys(index.search("euros")) == ["budget"]
+
+    memory["plan"] = "visit Porto"
+    del memory["budget"]
+    index.sync(memory)
+    assert index.search("lisbon") == []
+    assert index.search("euros") == []
+    assert _keys(index.search("porto")) == ["plan"]
+    # no postings are left behind by removed entries
+    assert all(keys <= {"plan"} for keys in index._postings.values())
@@ -0,0 +1,52 @@
+import time
+
+from kani_utils.rate_limit import QueryLimiter, SQLiteRateLimitStore
+
+
+def test_bucket_rejects_when_empty_and_refills_over_time():
+    limiter = QueryLimiter(capacity = 2, refill_seconds = 0.2, sync_interval = 3600)
+    assert limiter.try_acquire("ann")
+    assert limiter.try_acquire("ann")
+    assert not limiter.try_acquire("ann")
+    # other users have their own buckets
+    assert limiter.try_acquire("bob")
+
+    time.sleep(0.15)
+    assert limiter.try_acquire("ann")
+    limiter.close()
+
+
+def test_sync_thread_starts_on_a_rejected_first_attempt(tmp_path):
+    store = SQLiteRateLimitStore(str(tmp_path / "limits.db"))
+    # another worker has used up the user's bucket in the shared store
+    store.consume("ann", 2, 2, 2 / 3600, time.time())
+
+    synced = []
+    limiter = QueryLimiter(capacity = 2, refill_seconds = 3600, store = store, sync_interval = 0.05,
+                           on_sync = lambda user, remaining, synced_at: synced.append((user, remaining)))
+    # this worker has already seen the empty bucket, so the first attempt here is rejected
+    limiter._buckets["ann"] = [0.0, time.time()]
+    assert not limiter.try_acquire("ann")
+
+    # the background thread syncs the user, not just the final flush on close
+    deadline = time.time() + 5
+    while not synced and time.time() < deadline:
+        time.sleep(0.01)
+    assert synced[0] == ("ann", 0)
+    assert limiter.remaining("ann") == 0
+    limiter.close()
+
+
+def test_flush_reconciles_local_buckets_with_the_store(tmp_path):
+    store = SQLiteRateLimitStore(str(tmp_path / "limits.db"))
+    workers = [QueryLimiter(capacity = 3, refill_seconds = 3600, store = store, sync_interval = 3600)
+               for _ in range(2)]
+    assert workers[0].try_acquire("ann")
+    assert workers[1].try_acquire("ann")
+    for worker in workers:
+        worker.flush()
+
+    # the second flush saw both workers' tokens
+    assert workers[1].remaining("ann") == 1
+    for worker in workers:
+        worker.close()
@@ -0,0 +1,79 @@
+import asyncio
+
+from kani import ChatMessage
+
+from kani_utils.base_kanis import EnhancedKani
+from kani_utils.loadtest import FakeEngine
+from kani_utils.response_cache import LRUResponseCache, response_cache_key
+
+REPLY = "a cached reply"
+
+
+class CountingEngine(FakeEngine):
+    def __init__(self, **kwargs):
+        super().__init__(reply = REPLY, tokens_per_second = 10000, first_token_delay = 0, **kwargs)
+        self.calls = 0
+
+    async def predict(self, messages, functions = None, **hyperparams):
+        self.calls += 1
+        return await super().predict(messages, functions, **hyperparams)
+
+    async def stream(self, messages, functions = None, **hyperparams):
+        self.calls += 1
+        async for elem in super().stream(messages, functions, **hyperparams):
+            yield elem
+
+
+def test_same_prompt_prefix_hits_and_other_prefixes_miss():
+    cache, engine = LRUResponseCache(), CountingEngine()
+
+    def reply(prompt, system_prompt = "Be brief.", history = ()):
+        agent = EnhancedKani(engine, system_prompt = system_prompt, chat_history = list(history), response_cache = cache)
+        return asyncio.run(agent.chat_round_str(prompt)), agent
+
+    assert reply("hello")[0] == REPLY
+    text, agent = reply("hello")
+    assert text == REPLY and engine.calls == 1
+    assert agent.cache_hits == 1
+
+    # the key covers the whole prompt: the system prompt and earlier history as well as the query
+    reply("hello", system_prompt = "Be verbose.")
+    reply("hello", history = [ChatMessage.user("hi"), ChatMessage.assistant("hi there")])
+    reply("hello again")
+    assert engine.calls == 4
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+def test_streamed_replies_are_cached_and_replayed():
+    cache, engine = LRUResponseCache(), CountingEngine()
+
+    async def stream_reply():
+        agent = EnhancedKani(engine, response_cache = cache)
+        text = ""
+        async for stream in agent.full_round_stream("hello"):
+            async for token in stream:
+                text += token
+        return text
+
+    assert asyncio.run(stream_reply()) == REPLY
+    assert asyncio.run(stream_reply()) == REPLY
+    assert engine.calls == 1
+
+
+def test_key_ignores_whitespace_but_not_content():
+    base = response_cache_key([ChatMessage.user("hello")], model = "gpt")
+    assert response_cache_key([ChatMessage.user(" hello\n")], model = "gpt") == base
+    assert response_cache_key([ChatMessage.user("hello")], model = "other") != base
+    assert response_cache_key([ChatMessage.user("hello")], model = "gpt", hyperparams = {"temperature": 1}) != base
+
+
+def test_lru_evicts_oldest_and_expires_entries():
+    cache = LRUResponseCache(max_entries = 2)
+    for key in ["a", "b", "c"]:
+        cache.set(key, {"text": key})
+    assert cache.get("a") is None
+    assert cache.get("c") == {"text": "c"}
+
+    expired = LRUResponseCache(ttl_seconds = 0)
+    expired.set("a", {"text": "a"})
+    assert expired.get("a") is None
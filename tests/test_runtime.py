@@ -0,0 +1,89 @@
+import asyncio
+import threading
+
+import pytest
+from kani import ChatRole
+
+from kani_utils.base_kanis import EnhancedKani
+from kani_utils.loadtest import FakeEngine
+from kani_utils.runtime import AgentRuntime, SessionLoop
+from kani_utils.streaming import get_stream_stats
+
+
+def _reply(runner, agent, prompt, heartbeat = None):
+    text = ""
+    for stream in runner.stream_rounds(agent, prompt, heartbeat = heartbeat):
+        if stream.role == ChatRole.ASSISTANT:
+            text += "".join(stream)
+    return text
+
+
+@pytest.fixture(params = ["session_loop", "agent_runtime"])
+def runner(request):
+    runner = SessionLoop() if request.param == "session_loop" else AgentRuntime()
+    yield runner
+    runner.close()
+
+
+def test_stream_rounds_yields_the_reply(runner):
+    agent = EnhancedKani(FakeEngine(reply = "hi there", tokens_per_second = 1000, first_token_delay = 0))
+    assert _reply(runner, agent, "hello") == "hi there"
+    assert _reply(runner, agent, "again") == "hi there"
+    assert len(agent.chat_history) == 4
+
+
+def test_stopping_early_cancels_the_round(runner):
+    agent = EnhancedKani(FakeEngine(reply = "one two three four five", tokens_per_second = 20, first_token_delay = 0))
+    rounds = runner.stream_rounds(agent, "hello")
+    stream = next(rounds)
+    assert next(token for token in stream if token) == "one"
+    rounds.close()
+
+    # the cancelled round has released the agent, which can reply again
+    assert _reply(runner, agent, "again") == "one two three four five"
+
+
+def test_a_failing_heartbeat_cancels_the_round(runner):
+    agent = EnhancedKani(FakeEngine(reply = "hi", tokens_per_second = 1000, first_token_delay = 1.5))
+
+    def heartbeat():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        _reply(runner, agent, "hello", heartbeat = heartbeat)
+    assert _reply(runner, agent, "again") == "hi"
+
+
+def test_runtime_runs_work_of_many_threads_on_its_loops():
+    runtime = AgentRuntime(loops = 2)
+    engines = [FakeEngine(), FakeEngine()]
+    agents = [EnhancedKani(engine) for engine in engines + engines]
+    # agents sharing an engine share a loop
+    assert runtime.loop_for(agents[0]) is runtime.loop_for(agents[2])
+    assert runtime.loop_for(agents[0]) is not runtime.loop_for(agents[1])
+
+    async def loop_thread():
+        await asyncio.sleep(0.01)
+        return threading.current_thread().name
+
+    results = []
+    threads = [threading.Thread(target = lambda agent = agent: results.append(runtime.run(loop_thread(), agent)))
+               for agent in agents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == ["kani-agent-loop-0"] * 2 + ["kani-agent-loop-1"] * 2
+    runtime.close()
+
+
+def test_heartbeats_are_sent_at_most_once_a_second():
+    agent = EnhancedKani(FakeEngine(reply = "hi there", tokens_per_second = 1000, first_token_delay = 2.2))
+    runner = SessionLoop()
+    beats = []
+    before = get_stream_stats().snapshot()["heartbeats"]
+
+    assert _reply(runner, agent, "hello", heartbeat = lambda: beats.append(1)) == "hi there"
+    assert len(beats) == 2
+    assert get_stream_stats().snapshot()["heartbeats"] - before == 2
+    runner.close()
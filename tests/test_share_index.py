@@ -0,0 +1,70 @@
+import json
+
+from kani_utils.loadtest import FakeRedis
+from kani_utils.share_index import ShareIndex, summary_terms
+
+
+def _share(redis, index, share_key, summary, agent_name = "Agent", replace = True):
+    record = {"agent_name": agent_name, "summary": summary}
+    redis.set(share_key, json.dumps(record))
+    index.add(share_key, record, replace = replace)
+
+
+def _keys(chats):
+    return [share_key for share_key, _, _ in chats[0]]
+
+
+def test_summary_terms_are_distinct_lowercase_words():
+    assert summary_terms("The cat, the CAT and a dog!") == ["the", "cat", "and", "dog"]
+
+
+def test_search_follows_summary_updates():
+    redis = FakeRedis()
+    index = ShareIndex(redis, "app")
+    _share(redis, index, "a", "Planning a trip to Lisbon")
+    _share(redis, index, "b", "Lisbon restaurants", agent_name = "Other")
+
+    assert sorted(_keys(index.search("lisbon"))) == ["a", "b"]
+    assert _keys(index.search("lisbon", agent_name = "Other")) == ["b"]
+
+    # sharing again replaces the summary's terms, unless the earlier record was kept
+    _share(redis, index, "a", "Planning a trip to Porto")
+    assert _keys(index.search("lisbon")) == ["b"]
+    assert _keys(index.search("porto trip")) == ["a"]
+    _share(redis, index, "a", "Something else entirely", replace = False)
+    assert _keys(index.search("porto")) == ["a"]
+
+
+def test_views_rank_popular_listing():
+    redis = FakeRedis()
+    index = ShareIndex(redis, "app")
+    for share_key in ["a", "b", "c"]:
+        _share(redis, index, share_key, "summary")
+    pipe = redis.pipeline()
+    for share_key in ["b", "b", "c"]:
+        index.queue_view(pipe, share_key, "Agent")
+    pipe.exec()
+
+    assert _keys(index.list("popular")) == ["b", "c", "a"]
+    assert _keys(index.list("popular", agent_name = "Agent", offset = 1, count = 1)) == ["c"]
+    assert index.list("date")[1] == 3
+
+
+def test_removed_and_expired_shares_leave_the_index():
+    redis = FakeRedis()
+    index = ShareIndex(redis, "app")
+    for share_key in ["a", "b", "c"]:
+        _share(redis, index, share_key, "weather report")
+
+    index.remove(["a"])
+    assert sorted(_keys(index.search("weather"))) == ["b", "c"]
+
+    # expired records are pruned when found by a search or listing
+    redis.delete("b")
+    chats, total = index.search("weather")
+    assert (_keys((chats, total)), total) == (["c"], 1)
+    assert redis.sinter(index._term_key("weather")) == ["c"]
+    redis.delete("c")
+    assert index.list() == ([], 1)
+    assert index.list() == ([], 0)
+    assert redis.get(index._entry_key("c")) is None
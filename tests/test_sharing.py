@@ -0,0 +1,74 @@
+import json
+
+from streamlit.testing.v1 import AppTest
+
+from kani_utils import kani_streamlit_server
+from kani_utils.loadtest import FakeEngine, FakeRedis, _loadtest_app, _sticky_apptest_runtime, default_agents_func
+
+
+def _app(agents_func, config, **session_state):
+    app = AppTest.from_function(_loadtest_app, args = (agents_func, config), default_timeout = 60)
+    for state_key, value in {"logged_in": True, **session_state}.items():
+        app.session_state[state_key] = value
+    return app
+
+
+def test_viewers_share_decoded_chats_but_get_their_own_state():
+    redis = FakeRedis()
+    agents_func = default_agents_func(FakeEngine(tokens_per_second = 1000, first_token_delay = 0))
+    config = {"redis_client": redis, "page_title": "Test"}
+
+    with _sticky_apptest_runtime():
+        sharer = _app(agents_func, config, username = "ann", current_page = "chat", notes = ["ann"])
+        sharer.run()
+        sharer.chat_input[0].set_value("hello").run()
+        [button for button in sharer.button if button.label == "🔗 Share Chat"][0].click().run()
+        [share_key] = [key for key in redis._data if key.startswith("Test@") and ":" not in key]
+
+        for name in ["bob", "carol"]:
+            viewer = _app(agents_func, config, username = name)
+            viewer.query_params["session_id"] = share_key
+            viewer.run()
+            assert not viewer.exception
+            assert viewer.session_state["notes"] == ["ann"]
+            viewer.session_state["notes"].append(name)
+
+    # the cache holds decoded objects rather than pickles
+    session_dict, chat_data = kani_streamlit_server._cache_get(share_key)
+    assert chat_data["session_state"]["notes"] == ["ann"]
+
+
+def test_sharing_again_stores_only_new_content():
+    redis = FakeRedis()
+    agents_func = default_agents_func(FakeEngine(tokens_per_second = 1000, first_token_delay = 0))
+    config = {"redis_client": redis, "page_title": "Test"}
+
+    def blob_keys():
+        return {key for key in redis._data if key.startswith(kani_streamlit_server._SHARE_BLOB_PREFIX)}
+
+    def share_keys():
+        return {key for key in redis._data if key.startswith("Test@") and ":" not in key}
+
+    with _sticky_apptest_runtime():
+        sharer = _app(agents_func, config, username = "ann", current_page = "chat")
+        sharer.run()
+        sharer.chat_input[0].set_value("hello").run()
+        share = lambda: [button for button in sharer.button if button.label == "🔗 Share Chat"][0].click().run()
+        share()
+        first_blobs, [first_key] = blob_keys(), share_keys()
+
+        # the same conversation keeps its record and blobs
+        share()
+        assert (blob_keys(), share_keys()) == (first_blobs, {first_key})
+
+        # a longer one adds a record, its changed page and no copy of the agent blob
+        sharer.chat_input[0].set_value("more").run()
+        share()
+        [second_key] = share_keys() - {first_key}
+        first_manifest = json.loads(redis.get(first_key))["manifest"]
+        second_manifest = json.loads(redis.get(second_key))["manifest"]
+        assert second_manifest["agent"] == first_manifest["agent"]
+        assert second_manifest["pages"] != first_manifest["pages"]
+        new_blobs = blob_keys() - first_blobs
+        assert kani_streamlit_server._SHARE_BLOB_PREFIX + second_manifest["pages"][0] in new_blobs
+        assert len(new_blobs) < len(first_blobs)
@@ -0,0 +1,145 @@
+import asyncio
+import random
+import time
+
+import pytest
+
+from kani_utils.base_kanis import EnhancedKani
+from kani_utils.loadtest import FakeEngine
+from kani_utils.streaming import (FlushPolicy, ModelStreamError, StreamRetryPolicy, StreamStats, coalesce_stream,
+                                  guard_stream, is_transient_error)
+
+REPLY = "one two three four five six"
+
+
+def test_coalesce_stream_batches_tokens():
+    stats = StreamStats()
+    # the first token is sent at once, then every two characters
+    assert list(coalesce_stream(["a", "b", "c", "d"], FlushPolicy(interval = None, min_chars = 2), stats)) == ["a", "bc", "d"]
+
+    snapshot = stats.snapshot()
+    assert (snapshot["tokens"], snapshot["active_streams"]) == (4, 0)
+    # three updates plus st.write_stream's final one, each re-sending the text so far
+    assert (snapshot["deltas"], snapshot["bytes"]) == (4, 1 + 3 + 4 + 4)
+
+
+def test_coalesce_stream_flushes_when_the_model_pauses():
+    def tokens():
+        yield from ["a", "b"]
+        time.sleep(0.06)
+        # what a round stream yields while no token arrives
+        yield ""
+        yield "c"
+
+    assert list(coalesce_stream(tokens(), FlushPolicy(interval = 0.05), StreamStats())) == ["a", "b", "c"]
+
+
+def test_coalesce_stream_without_policy_yields_every_token():
+    assert list(coalesce_stream(["a", "", "b"], stats = StreamStats())) == ["a", "b"]
+
+
+def test_adaptive_interval_grows_with_concurrent_streams():
+    policy = FlushPolicy(interval = 0.05, adaptive = True, adaptive_streams = 10, max_interval = 0.25)
+    assert policy.current_interval(5) == 0.05
+    assert policy.current_interval(20) == 0.1
+    assert policy.current_interval(1000) == 0.25
+    assert not policy.should_flush(10, 0.06, 20)
+    assert policy.should_flush(10, 0.1, 20)
+
+
+async def _ticks(delays):
+    for i, delay in enumerate(delays):
+        await asyncio.sleep(delay)
+        yield i
+
+
+def _collect(elems):
+    async def collect():
+        return [elem async for elem in elems]
+    return asyncio.run(collect())
+
+
+def test_guard_stream_limits_the_first_and_later_elements_separately():
+    # a slow first element is fine with only an idle timeout
+    assert _collect(guard_stream(_ticks([0.1, 0, 0]), idle_timeout = 0.05)) == [0, 1, 2]
+    with pytest.raises(asyncio.TimeoutError):
+        _collect(guard_stream(_ticks([0.1]), first_timeout = 0.05))
+    with pytest.raises(asyncio.TimeoutError):
+        _collect(guard_stream(_ticks([0, 0.1]), idle_timeout = 0.05))
+    with pytest.raises(asyncio.TimeoutError):
+        _collect(guard_stream(_ticks([0.03] * 5), idle_timeout = 0.05, deadline = time.monotonic() + 0.1))
+
+
+def test_retry_delays_grow_with_full_jitter():
+    policy = StreamRetryPolicy(backoff = 1.0, max_backoff = 3.0)
+    random.seed(0)
+    for retry, limit in [(1, 1.0), (2, 2.0), (3, 3.0), (10, 3.0)]:
+        delays = [policy.delay(retry) for _ in range(200)]
+        assert 0 <= min(delays) and max(delays) <= limit
+        assert max(delays) > limit / 2
+
+
+def test_transient_errors_are_recognized():
+    class RateLimitError(Exception):
+        status_code = 429
+
+    assert is_transient_error(ConnectionError())
+    assert is_transient_error(RateLimitError())
+    assert not is_transient_error(ValueError())
+
+
+class FlakyEngine(FakeEngine):
+    """Fails its first streams with a connection error, after sending fail_after words."""
+    def __init__(self, failures, fail_after = 0, **kwargs):
+        super().__init__(reply = REPLY, tokens_per_second = 10000, first_token_delay = 0, **kwargs)
+        self.failures = failures
+        self.fail_after = fail_after
+        self.calls = 0
+
+    async def stream(self, messages, functions = None, **hyperparams):
+        self.calls += 1
+        sent = 0
+        async for elem in super().stream(messages, functions, **hyperparams):
+            if self.calls <= self.failures and sent == self.fail_after:
+                raise ConnectionError("connection reset")
+            sent += 1
+            yield elem
+
+
+async def _stream_round(agent, prompt):
+    text = ""
+    async for stream in agent.full_round_stream(prompt):
+        message = await stream.message()
+        text += message.text or ""
+    return text
+
+
+def test_failed_streams_are_retried_and_continued():
+    engine = FlakyEngine(failures = 1, fail_after = 3)
+    agent = EnhancedKani(engine, stream_retry = StreamRetryPolicy(max_retries = 2, backoff = 0))
+    assert asyncio.run(_stream_round(agent, "hello")) == REPLY
+    assert engine.calls == 2
+
+    engine = FlakyEngine(failures = 3)
+    agent = EnhancedKani(engine, stream_retry = StreamRetryPolicy(max_retries = 2, backoff = 0))
+    with pytest.raises(ModelStreamError):
+        asyncio.run(_stream_round(agent, "hello"))
+    assert engine.calls == 3
+
+
+def test_slow_first_token_is_not_retried():
+    # the idle timeout only applies once the first token has arrived
+    engine = FlakyEngine(failures = 0)
+    engine.first_token_delay = 0.2
+    agent = EnhancedKani(engine, stream_retry = StreamRetryPolicy(idle_timeout = 0.05, max_retries = 2, backoff = 0))
+    assert asyncio.run(_stream_round(agent, "hello")) == REPLY
+    assert engine.calls == 1
+
+    # unless a first token timeout is set
+    engine = FlakyEngine(failures = 0)
+    engine.first_token_delay = 0.2
+    agent = EnhancedKani(engine, stream_retry = StreamRetryPolicy(first_token_timeout = 0.05, max_retries = 1,
+                                                                   backoff = 0))
+    with pytest.raises(ModelStreamError):
+        asyncio.run(_stream_round(agent, "hello"))
+    assert engine.calls == 2
@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+
+from kani_utils.tables import ParquetTable, TableCatalog, csv_to_parquet, query_tables
+
+
+@pytest.fixture
+def parquet_table(tmp_path):
+    pytest.importorskip("duckdb")
+    pytest.importorskip("pyarrow")
+    csv_path = tmp_path / "numbers.csv"
+    csv_path.write_text("n,square\n1,1\n2,4\n3,9\n")
+    return csv_to_parquet(str(csv_path), str(tmp_path / "numbers.parquet"))
+
+
+def test_sync_lists_tables_with_missing_files_as_unavailable(tmp_path, parquet_table):
+    catalog = TableCatalog()
+    memory = {"NUMBERS": parquet_table, "GONE": ParquetTable(str(tmp_path / "gone.parquet"))}
+    catalog.sync(memory)
+
+    assert catalog.names() == ["NUMBERS"]
+    assert list(catalog.unavailable()) == ["GONE"]
+    assert catalog.get("NUMBERS").rows == 3
+
+    # the table becomes available once its file is back
+    pd.DataFrame({"x": [1]}).to_parquet(tmp_path / "gone.parquet")
+    catalog.sync(memory)
+    assert sorted(catalog.names()) == ["GONE", "NUMBERS"]
+    assert catalog.unavailable() == {}
+
+
+def test_sync_adds_replaces_and_removes_tables():
+    catalog = TableCatalog(preview_rows = 2)
+    numbers = pd.DataFrame({"n": [1, 2, 3], "half": [0.5, 1.0, 1.5]})
+    memory = {"NUMBERS": numbers, "NOTE": "not a table"}
+    catalog.sync(memory)
+
+    info = catalog.get("NUMBERS")
+    assert catalog.names() == ["NUMBERS"]
+    assert info.summary() == "NUMBERS: 3 rows, 2 columns (1 int64, 1 float64)"
+    assert "1.5" not in info.preview
+
+    # unchanged tables are not described again
+    memory["MORE"] = numbers.head(1)
+    catalog.sync(memory)
+    assert catalog.get("NUMBERS") is info
+    assert catalog.get("MORE").rows == 1
+
+    memory["NUMBERS"] = numbers.tail(2)
+    del memory["MORE"]
+    catalog.sync(memory)
+    assert catalog.names() == ["NUMBERS"]
+    assert catalog.get("NUMBERS").rows == 2
+
+    # a table replaced by another value leaves the catalog
+    memory["NUMBERS"] = "gone"
+    catalog.sync(memory)
+    assert catalog.names() == []
+
+
+def test_query_tables_joins_frames_and_parquet_files(parquet_table):
+    names = pd.DataFrame({"n": [1, 3], "name": ["one", "three"]})
+    result = query_tables('SELECT name, square FROM "NUMBERS" JOIN names USING (n) ORDER BY n',
+                          {"NUMBERS": parquet_table, "names": names})
+    assert result.to_dict("records") == [{"name": "one", "square": 1}, {"name": "three", "square": 9}]
+
+
+def test_queries_cannot_reach_other_files_or_settings(tmp_path, parquet_table):
+    import duckdb
+
+    secret = tmp_path / "secret.csv"
+    secret.write_text("password\nhunter2\n")
+    tables = {"NUMBERS": parquet_table}
+    for query in [f"SELECT * FROM read_csv('{secret}')",
+                  "SELECT * FROM read_csv('/etc/hostname')",
+                  f"COPY (SELECT 1) TO '{tmp_path / 'out.csv'}'",
+                  "SET enable_external_access = true"]:
+        with pytest.raises(duckdb.Error):
+            query_tables(query, tables)
+    assert not (tmp_path / "out.csv").exists()
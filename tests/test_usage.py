@@ -0,0 +1,38 @@
+import time
+
+from kani_utils.usage import SQLiteUsageStore, UsageLedger
+
+
+def test_record_rolls_up_by_bucket_user_agent_and_model():
+    ledger = UsageLedger()
+    now = time.time()
+    ledger.record("ann", "Agent", "gpt", 100, 10, cost = 0.5, timestamp = now)
+    ledger.record("ann", "Agent", "gpt", 50, 5, cost = 0.25, timestamp = now)
+    ledger.record("bob", "Agent", "gpt", 10, 1, cost = 0.1, timestamp = now)
+
+    assert ledger.spent(user = "ann") == {"prompt_tokens": 150, "completion_tokens": 15, "cost": 0.75, "requests": 2}
+    by_user = {row["user"]: row["requests"] for row in ledger.query(group_by = ("user",))}
+    assert by_user == {"ann": 2, "bob": 1}
+
+
+def test_rollups_are_pruned_without_a_store():
+    ledger = UsageLedger(bucket_seconds = 1, retain_seconds = 60)
+    now = time.time()
+    ledger.record("ann", "Agent", "gpt", 100, 10, timestamp = now - 3600)
+    ledger.record("ann", "Agent", "gpt", 1, 1, timestamp = now)
+
+    assert ledger._thread is None
+    assert len(ledger._recent) == 1
+    assert ledger.query()[0]["prompt_tokens"] == 1
+
+
+def test_flush_writes_deltas_to_the_store(tmp_path):
+    ledger = UsageLedger(store = SQLiteUsageStore(str(tmp_path / "usage.db")), flush_interval = 3600)
+    ledger.record("ann", "Agent", "gpt", 100, 10, cost = 0.5)
+    ledger.flush()
+    ledger.record("ann", "Agent", "gpt", 1, 1, cost = 0.5)
+
+    # flushed rows and unflushed deltas are both counted
+    [row] = ledger.query(group_by = ("user",))
+    assert (row["prompt_tokens"], row["requests"], row["cost"]) == (101, 2, 1.0)
+    ledger.close()